@@ -0,0 +1,139 @@
+import re
+import uuid
+from typing import Optional
+from urllib.parse import quote
+from fastapi import HTTPException, Request, Response, status
+from fastapi.responses import StreamingResponse
+from gridfs import AsyncGridFSBucket
+from gridfs.errors import NoFile
+
+from conditional import http_date, matches, not_modified
+from database import config_int
+
+# Large files (CVs, cover letters, interview notes, long job descriptions) are kept in GridFS, which splits them into
+# fixed-size chunks, instead of inline in the job application. The application only holds a reference string of the
+# form "gridfs:<file id>", so reading an application never pulls the files with it.
+REFERENCE_PREFIX = "gridfs:"
+CHUNK_SIZE = config_int("ATTACHMENT_CHUNK_BYTES", 255 * 1024)  # GridFS chunk size, and the size we stream in
+MAX_SIZE = config_int("ATTACHMENT_MAX_BYTES", 50 * 1024 * 1024)
+
+
+def attachment_bucket(database) -> AsyncGridFSBucket:
+    return AsyncGridFSBucket(database, bucket_name="attachments", chunk_size_bytes=CHUNK_SIZE)
+
+
+def reference(file_id: str) -> str:
+    return REFERENCE_PREFIX + file_id
+
+
+async def upload(request: Request, owner_id: str, filename: str) -> str:
+    """
+    Store the request body in GridFS chunk by chunk as it arrives, and return the new file's ID. Bodies larger than
+    MAX_SIZE are refused with 413 and whatever was written of them is removed
+    """
+    bucket = attachment_bucket(request.app.database)
+    file_id = str(uuid.uuid4())
+    metadata = {"owner_id": owner_id, "content_type": request.headers.get("content-type", "application/octet-stream")}
+    grid_in = bucket.open_upload_stream_with_id(file_id, filename, metadata=metadata)
+    size = 0
+    try:
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > MAX_SIZE:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    detail=f"Attachments are limited to {MAX_SIZE} bytes")
+            await grid_in.write(chunk)
+    except BaseException:
+        await grid_in.abort()
+        raise
+    await grid_in.close()
+    return file_id
+
+
+def parse_range(header: Optional[str], length: int) -> Optional[tuple[int, int]]:
+    """
+    Parse a single "bytes=start-end" Range header into an inclusive (start, end) pair. Returns None if there is no
+    Range header; multiple ranges aren't supported and are answered with the whole file, which HTTP allows
+    """
+    if not header or "," in header:
+        return None
+    if (match := re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())) is None:
+        return None
+    start, end = match.groups()
+    if not start:  # "bytes=-500" means the last 500 bytes
+        if not end:
+            return None
+        start, end = max(length - int(end), 0), length - 1
+    else:
+        start, end = int(start), min(int(end), length - 1) if end else length - 1
+    if start > end or start >= length:
+        raise HTTPException(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                            headers={"Content-Range": f"bytes */{length}"})
+    return start, end
+
+
+def content_disposition(filename: str) -> str:
+    """
+    Header values have to be latin-1 and can't contain line breaks, so filename= gets an ASCII stand-in for the name
+    and the name itself goes in filename* (RFC 5987), which clients prefer
+    """
+    fallback = re.sub(r'[^\x20-\x7e]|["\\]', "_", filename)
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+
+async def download(request: Request, owner_id: str, file_id: str) -> Response:
+    """
+    Stream a stored file back CHUNK_SIZE bytes at a time, honouring a Range header so clients can resume downloads
+    or fetch only part of a file. Stored files never change (a replaced attachment gets a new ID), so the ETag is
+    simply the file ID
+    """
+    try:
+        grid_out = await attachment_bucket(request.app.database).open_download_stream(file_id)
+    except NoFile:
+        grid_out = None
+    if grid_out is None or (grid_out.metadata or {}).get("owner_id") != owner_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Attachment with ID {file_id} not found")
+
+    tag, modified = f'"{file_id}"', http_date(grid_out.upload_date)
+    if matches(request.headers.get("if-none-match"), tag):
+        return not_modified(tag, modified)
+
+    length = grid_out.length
+    byte_range = parse_range(request.headers.get("range"), length)
+    start, end = byte_range or (0, length - 1)
+    await grid_out.seek(start)
+
+    async def generate():
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await grid_out.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    headers = {"Accept-Ranges": "bytes", "Content-Length": str(max(end - start + 1, 0)), "ETag": tag,
+               "Last-Modified": modified, "Content-Disposition": content_disposition(grid_out.filename)}
+    if byte_range is not None:
+        headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+    status_code = status.HTTP_206_PARTIAL_CONTENT if byte_range is not None else status.HTTP_200_OK
+    return StreamingResponse(generate(), status_code=status_code, media_type=grid_out.metadata.get("content_type"),
+                             headers=headers)
+
+
+async def owned_by(database, owner_id: str, file_id: str) -> bool:
+    files = database["attachments.files"]  # GridFS keeps each file's metadata in <bucket>.files
+    return await files.find_one({"_id": file_id, "metadata.owner_id": owner_id}, {"_id": 1}) is not None
+
+
+async def delete(database, file_id: str):
+    try:
+        await attachment_bucket(database).delete(file_id)
+    except NoFile:
+        pass
+
+
+async def delete_all(database, owner_id: str):
+    bucket = attachment_bucket(database)
+    async for grid_out in bucket.find({"metadata.owner_id": owner_id}):
+        await bucket.delete(grid_out._id)
@@ -0,0 +1,62 @@
+"""
+Measures the time encryption at rest adds to writing and reading one credential.
+
+    python -m benchmarks.encryption --iterations 10000 --budget-us 200   # exits with 1 if over budget
+
+Uses a random master key, so no .env is needed. Run it from the repository root.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import encryption
+from benchmarks.run import credential
+
+
+def measure(function, items: list) -> list[float]:
+    timings = []
+    for item in items:
+        start = time.perf_counter()
+        function(item)
+        timings.append((time.perf_counter() - start) * 1e6)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=10000)
+    parser.add_argument("--budget-us", type=float, default=200, help="maximum p95 microseconds per credential")
+    args = parser.parse_args()
+
+    encryption.MASTER_KEY = os.urandom(32)
+    seeded = {"countries": [{"name": "Norway"}], "areas": [{"name": "Banking"}],
+              "mailboxes": [{"address": "user@example.com"}]}
+    creds = [credential(seeded) for _ in range(args.iterations)]
+    encrypted = [encryption.encrypt_fields(cred["_id"], cred) for cred in creds]
+
+    # the cached run re-reads a working set that fits in the data key cache, so every lookup hits
+    working_set = encrypted[:encryption.unwrap.cache_info().maxsize or len(encrypted)]
+    rereads = [working_set[i % len(working_set)] for i in range(args.iterations)]
+
+    encryption.unwrap.cache_clear()
+    results = {
+        "encrypt": measure(lambda cred: encryption.encrypt_fields(cred["_id"], cred), creds),
+        "decrypt (key not cached)": measure(encryption.decrypt_fields, encrypted),
+    }
+    for doc in working_set:
+        encryption.decrypt_fields(doc)
+    results["decrypt (key cached)"] = measure(encryption.decrypt_fields, rereads)
+    over_budget = False
+    for name, timings in results.items():
+        p95 = statistics.quantiles(timings, n=100)[94]
+        over_budget |= p95 > args.budget_us
+        print(f"{name:26} p50 {statistics.median(timings):8.1f}us  p95 {p95:8.1f}us")
+    if over_budget:
+        print(f"p95 over the budget of {args.budget_us}us", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import asyncio
+import mongomock
+
+# In-process stand-in for the async PyMongo client, so the app can be benchmarked without an Atlas cluster.
+# mongomock does the actual query work; these wrappers only give it the async interface the routers use.
+
+
+class FakeCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self._cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, limit: int):
+        self._cursor.limit(limit)
+        return self
+
+    async def to_list(self, length=None):
+        docs = []
+        for doc in self._cursor:
+            docs.append(doc)
+            if length is not None and len(docs) >= length:
+                break
+        return docs
+
+    async def _iterate(self):
+        for count, doc in enumerate(self._cursor, 1):
+            if count % 100 == 0:
+                await asyncio.sleep(0)  # let other tasks run during long scans, as a real cursor's fetches would
+            yield doc
+
+    def __aiter__(self):
+        return self._iterate()
+
+
+class FakeCollection:
+    def __init__(self, collection):
+        self._collection = collection
+
+    def find(self, *args, **kwargs):
+        kwargs.pop("batch_size", None)  # only a network tuning knob, mongomock doesn't accept it
+        kwargs.pop("session", None)
+        return FakeCursor(self._collection.find(*args, **kwargs))
+
+    async def aggregate(self, pipeline, **kwargs):
+        return FakeCursor(self._collection.aggregate(pipeline))
+
+    async def bulk_write(self, requests, ordered=True, session=None):
+        # mongomock's bulk_write doesn't understand current PyMongo's operation objects, so apply them one at a time.
+        # Only UpdateOne is used (by write_behind)
+        for request in requests:
+            self._collection.update_one(request._filter, request._doc, upsert=bool(request._upsert))
+
+    def __getattr__(self, name):
+        # every other collection method (insert_one, find_one_and_update, ...) is the same call, made awaitable
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            kwargs.pop("session", None)  # mongomock doesn't support sessions, see FakeSession
+            return method(*args, **kwargs)
+
+        return call
+
+
+class FakeSession:
+    """
+    Stands in for a client session. Transactions simply run their callback; the fake has no other clients, so there
+    is nothing for them to be isolated from
+    """
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def with_transaction(self, callback):
+        return await callback(self)
+
+
+class FakeDatabase:
+    def __init__(self, database, client):
+        self._database = database
+        self.client = client
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        return FakeCollection(self._database[name])
+
+    async def command(self, name: str):
+        return {"ok": 1.0}  # only used for the readiness probe's ping
+
+
+class FakeClient:
+    def __init__(self):
+        self._client = mongomock.MongoClient()
+
+    def __getitem__(self, name: str) -> FakeDatabase:
+        return FakeDatabase(self._client[name], self)
+
+    def start_session(self):
+        return FakeSession()
+
+    async def close(self):
+        self._client.close()
@@ -0,0 +1,260 @@
+"""
+Latency/throughput benchmark for the API, run against an in-process fake MongoDB (see fake_mongo.py).
+
+    python -m benchmarks.run --docs 10000 --concurrency 1,10,50 --requests 1000 --output bench.json
+    python -m benchmarks.run --baseline bench_baseline.json   # exits with 1 if any p95 regressed
+    python -m benchmarks.run --url http://127.0.0.1:8000      # against a running server, e.g. serve.py
+
+Requires mongomock and httpx on top of the app's own dependencies. Run it from the repository root. With --url, the
+data is seeded through the API into whatever database the server uses, so point the server at a test database.
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+import main
+import serialization
+import write_behind
+from benchmarks.fake_mongo import FakeClient
+from database import config
+from models import SCHEMA_VERSION
+
+REFERENCE_COUNT = 50  # documents seeded into each reference collection
+
+
+async def seed(client: FakeClient, docs: int) -> dict:
+    """
+    Fill the fake database and return the IDs/names the scenarios pick from
+    """
+    database = client[config["DB_NAME"]]
+    seeded = {}
+    for collection, name_field, extra in (("countries", "name", {}),
+                                          ("areas", "name", {"description": "Seeded area"}),
+                                          ("mailboxes", "address", {"description": "Seeded mailbox"}),
+                                          ("personal_detail_type", "detail", {})):
+        batch = [{"_id": str(uuid.uuid4()), name_field: f"{collection}-{i}", **extra, "schema_version": SCHEMA_VERSION}
+                 for i in range(REFERENCE_COUNT)]
+        if collection == "mailboxes":
+            for doc in batch:
+                doc["address"] = f"user{doc['address']}@example.com"
+        await database[collection].insert_many(batch)
+        seeded[collection] = batch
+
+    creds = [credential(seeded) for _ in range(docs)]
+    await database["creds"].insert_many([dict(cred) for cred in creds])
+    seeded["creds"] = creds
+    return seeded
+
+
+async def seed_api(client: httpx.AsyncClient, docs: int) -> dict:
+    """
+    Like seed, but through the API of a running server
+    """
+    seeded = {}
+    for collection, path, make in (("countries", "/country/", lambda key: {"name": key}),
+                                   ("areas", "/area/", lambda key: {"name": key, "description": "Seeded area"}),
+                                   ("mailboxes", "/mailbox/",
+                                    lambda key: {"address": f"user{key}@example.com", "description": "Seeded mailbox"}),
+                                   ("personal_detail_type", "/personal_detail_types/", lambda key: {"detail": key})):
+        seeded[collection] = []
+        for _ in range(REFERENCE_COUNT):
+            response = await client.post(path, json=make(f"{collection}-{uuid.uuid4()}"))
+            response.raise_for_status()
+            seeded[collection].append(response.json())
+
+    creds = [credential(seeded) for _ in range(docs)]
+    body = "".join(json.dumps({k: v for k, v in cred.items() if k != "schema_version"}) + "\n" for cred in creds)
+    response = await client.post("/cred/bulk", content=body, headers={"Content-Type": "application/x-ndjson"},
+                                 timeout=None)
+    response.raise_for_status()
+    seeded["creds"] = creds
+    return seeded
+
+
+def credential(seeded: dict) -> dict:
+    return {
+        "_id": str(uuid.uuid4()),
+        "username": f"user{random.randrange(10 ** 6)}",
+        "email": random.choice(seeded["mailboxes"])["address"],
+        "password": uuid.uuid4().hex,
+        "country": random.choice(seeded["countries"])["name"],
+        "area": random.choice(seeded["areas"])["name"],
+        "login_override": "",
+        "personal_details": {"Location": "Oslo, Norway"},
+        "security_questions": {"What was the name of your first pet?": "Cthulhu"},
+        "schema_version": SCHEMA_VERSION,
+    }
+
+
+def scenarios(seeded: dict) -> dict:
+    """
+    name -> function returning the (method, url, json body) of one request. Covers reads and writes on every router
+    """
+    pdetails = "personal_detail_type"
+
+    def pick(collection):
+        return random.choice(seeded[collection])
+
+    def new_cred():
+        cred = credential(seeded)
+        del cred["_id"], cred["schema_version"]
+        return cred
+
+    return {
+        "GET /cred/": lambda: ("GET", "/cred/", None),
+        "GET /cred/{id}": lambda: ("GET", f"/cred/{pick('creds')['_id']}", None),
+        "GET /cred/?area=": lambda: ("GET", "/cred/", {"area": pick("areas")["name"]}),
+        "GET /cred/batch": lambda: ("GET", "/cred/batch", {"ids": ",".join(pick("creds")["_id"] for _ in range(10))}),
+        "POST /cred/": lambda: ("POST", "/cred/", new_cred()),
+        "PUT /cred/{id}": lambda: ("PUT", f"/cred/{pick('creds')['_id']}", {"password": uuid.uuid4().hex}),
+        "GET /country/": lambda: ("GET", "/country/", None),
+        "GET /country/{name}": lambda: ("GET", f"/country/{pick('countries')['name']}", None),
+        "GET /country/batch": lambda: ("GET", "/country/batch",
+                                       {"ids": ",".join(pick("countries")["_id"] for _ in range(10))}),
+        "PUT /country/{id}": lambda: ("PUT", f"/country/{(c := pick('countries'))['_id']}", {"name": c["name"]}),
+        "GET /area/": lambda: ("GET", "/area/", None),
+        "GET /area/{name}": lambda: ("GET", f"/area/{pick('areas')['name']}", None),
+        "POST /area/": lambda: ("POST", "/area/", {"name": f"area-{uuid.uuid4()}", "description": "Benchmark"}),
+        "GET /mailbox/": lambda: ("GET", "/mailbox/", None),
+        "GET /mailbox/{address}": lambda: ("GET", f"/mailbox/{pick('mailboxes')['address']}", None),
+        "GET /personal_detail_types/": lambda: ("GET", "/personal_detail_types/", None),
+        "PUT /personal_detail_types/{id}": lambda: ("PUT", f"/personal_detail_types/{(p := pick(pdetails))['_id']}",
+                                                    {"detail": p["detail"]}),
+    }
+
+
+async def send(client: httpx.AsyncClient, method: str, url: str, payload):
+    if method == "GET":
+        return await client.get(url, params=payload)
+    return await client.request(method, url, json=payload)
+
+
+async def run_scenario(client: httpx.AsyncClient, make_request, concurrency: int, requests: int) -> dict:
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            method, url, payload = make_request()
+            start = time.perf_counter()
+            response = await send(client, method, url, payload)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    cuts = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "p50_ms": round(cuts[49] * 1000, 3),
+        "p95_ms": round(cuts[94] * 1000, 3),
+        "p99_ms": round(cuts[98] * 1000, 3),
+        "rps": round(len(latencies) / elapsed, 1),
+        "errors": errors,
+    }
+
+
+async def benchmark(client: httpx.AsyncClient, seeded: dict, concurrency_levels: list[int], requests: int,
+                    only: list[str]) -> dict:
+    results = {}
+    for concurrency in concurrency_levels:
+        level = results[f"concurrency={concurrency}"] = {}
+        for name, make_request in scenarios(seeded).items():
+            if only and not any(part in name for part in only):
+                continue
+            level[name] = await run_scenario(client, make_request, concurrency, requests)
+            print(f"c={concurrency:<4} {name:<36} {level[name]}")
+    return results
+
+
+async def benchmark_in_process(fake: FakeClient, docs: int, *args) -> dict:
+    seeded = await seed(fake, docs)
+    async with main.app.router.lifespan_context(main.app):
+        await main.app.ready.wait()  # startup finishes in the background, see startup.py
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            return await benchmark(client, seeded, *args)
+
+
+async def benchmark_server(url: str, docs: int, *args) -> dict:
+    limits = httpx.Limits(max_connections=None)  # let the concurrency level decide
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        seeded = await seed_api(client, docs)
+        return await benchmark(client, seeded, *args)
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    found = []
+    for level, scenario_results in results.items():
+        for name, result in scenario_results.items():
+            if (before := baseline.get("results", {}).get(level, {}).get(name)) is None:
+                continue
+            if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+                found.append(f"{level} {name}: p95 {before['p95_ms']}ms -> {result['p95_ms']}ms")
+    return found
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the API against an in-process fake MongoDB, or a server")
+    parser.add_argument("--docs", type=int, default=1000, help="credentials to seed")
+    parser.add_argument("--concurrency", default="1,10,50", help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario per concurrency level")
+    parser.add_argument("--only", default="", help="comma separated substrings; only run scenarios matching one")
+    parser.add_argument("--fast-serialization", action="store_true",
+                        help="enable the FAST_SERIALIZATION read path (in-process only)")
+    parser.add_argument("--write-behind", action="store_true",
+                        help="queue PUT /cred/{id} in write-behind mode, journalled to a temporary directory")
+    parser.add_argument("--url", help="benchmark the server at this URL instead of the app in-process")
+    parser.add_argument("--output", default="bench_output.json", help="where to write the results")
+    parser.add_argument("--baseline", help="results file to compare against; exits with 1 on p95 regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 slowdown vs baseline (0.2 = 20%%)")
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    random.seed(0)
+    config["DB_NAME"] = "bench"
+    fake = FakeClient()
+    main.create_client = lambda: fake  # the lifespan handler connects to the fake instead of Atlas
+    serialization.FAST_SERIALIZATION = args.fast_serialization
+    write_behind.WRITE_BEHIND = args.write_behind
+    write_behind.JOURNAL_DIR = tempfile.mkdtemp(prefix="bench-journal-")
+
+    concurrency_levels = [int(c) for c in args.concurrency.split(",")]
+    only = [part for part in args.only.split(",") if part]
+    if args.url:
+        results = asyncio.run(benchmark_server(args.url, args.docs, concurrency_levels, args.requests, only))
+    else:
+        results = asyncio.run(benchmark_in_process(fake, args.docs, concurrency_levels, args.requests, only))
+
+    report = {"config": {"docs": args.docs, "requests": args.requests, "url": args.url,
+                         "fast_serialization": args.fast_serialization, "write_behind": args.write_behind},
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
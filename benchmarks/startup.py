@@ -0,0 +1,87 @@
+"""
+Measures how long a worker takes to start: importing the app, answering its first request, becoming ready, and
+answering its first request that reads from the database. Each run is a fresh Python process, so nothing is cached.
+
+    python -m benchmarks.startup --runs 10 --docs 10000
+    python -m benchmarks.startup --budget-ms 1500   # exits with 1 if the median time to ready is over budget
+
+Uses the in-process fake MongoDB (see fake_mongo.py), so Atlas round trips aren't included; the time to become ready
+is what rebuilding the caches and search indexes costs for --docs credentials. The fake answers each query in one go,
+so a long scan also holds up the first request; against Atlas, the first request is answered while startup is still
+waiting on the network. Run it from the repository root.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+
+async def measure_worker(docs: int) -> dict:
+    start = time.perf_counter()
+    import main as application  # the app module; timing this import is the point
+    imported = time.perf_counter()
+
+    import httpx
+    from benchmarks.fake_mongo import FakeClient
+    from benchmarks.run import seed
+    from database import config
+
+    config["DB_NAME"] = "bench"
+    fake = FakeClient()
+    application.create_client = lambda: fake
+    await seed(fake, docs)
+
+    timings = {"import_ms": (imported - start) * 1000}
+    begin = time.perf_counter()
+    async with application.app.router.lifespan_context(application.app):
+        transport = httpx.ASGITransport(app=application.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            (await client.get("/health/live")).raise_for_status()
+            timings["first_request_ms"] = (time.perf_counter() - begin) * 1000
+            while (await client.get("/health/ready")).status_code != 200:
+                await asyncio.sleep(0.001)
+            timings["ready_ms"] = (time.perf_counter() - begin) * 1000
+            (await client.get("/cred/", params={"limit": 10})).raise_for_status()
+            timings["first_read_ms"] = (time.perf_counter() - begin) * 1000
+            timings["openapi_ms"] = (await timed(client, "/openapi.json")) * 1000
+    return timings
+
+
+async def timed(client, url: str) -> float:
+    start = time.perf_counter()
+    (await client.get(url)).raise_for_status()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--docs", type=int, default=1000, help="credentials to seed")
+    parser.add_argument("--budget-ms", type=float, help="maximum median milliseconds from import to ready")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)  # one measurement, as JSON
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(asyncio.run(measure_worker(args.docs))))
+        return
+
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, "-m", "benchmarks.startup", "--worker", "--docs", str(args.docs)],
+                                check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))  # the app prints its own startup messages too
+    for name in runs[0]:
+        timings = [run[name] for run in runs]
+        print(f"{name:18} median {statistics.median(timings):8.1f}ms  max {max(timings):8.1f}ms")
+    total = statistics.median(run["import_ms"] + run["ready_ms"] for run in runs)
+    print(f"{'import to ready':18} median {total:8.1f}ms")
+    if args.budget_ms is not None and total > args.budget_ms:
+        print(f"Over the budget of {args.budget_ms}ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import json
+from typing import AsyncIterator
+from fastapi import HTTPException, Request, status
+from pydantic import BaseModel, ValidationError
+from pymongo.errors import BulkWriteError
+
+from database import config_int
+from models import to_document
+
+BULK_BATCH_SIZE = config_int("BULK_BATCH_SIZE", 1000)  # documents per insert_many call
+MAX_REPORTED_ERRORS = 1000  # only the first N failures are listed in the response; all are counted
+
+
+async def read_items(request: Request) -> AsyncIterator[tuple[int, object]]:
+    """
+    Yield (position, item) for each item in the request body. NDJSON bodies (application/x-ndjson) are read line by
+    line as they arrive, so memory use does not depend on the size of the upload. Any other body must be a JSON array,
+    which has to be read in full first. Lines that are not valid JSON are yielded as the exception instead of the item.
+    """
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        position = 0
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield position, parse_line(line)
+                    position += 1
+        if buffer.strip():
+            yield position, parse_line(buffer)
+        return
+
+    try:
+        items = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Body must be a JSON array or NDJSON")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Body must be a JSON array or NDJSON")
+    for position, item in enumerate(items):
+        yield position, item
+
+
+def parse_line(line: bytes):
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return e
+
+
+class BulkResult:
+    """
+    Running totals for a bulk import, with the first MAX_REPORTED_ERRORS failures kept for the response
+    """
+    def __init__(self):
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+
+    def add_error(self, position: int, error):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"index": position, "error": error})
+
+    def dict(self) -> dict:
+        return {"inserted": self.inserted, "failed": self.failed, "errors": self.errors}
+
+
+async def insert_batch(collection, batch: list[dict], positions: list[int], result: BulkResult, check_batch=None,
+                       on_insert=None):
+    if check_batch is not None and batch:
+        # drop documents that fail the extra check, e.g. references to other collections that don't exist
+        checked = list(zip(batch, positions, await check_batch(batch)))
+        for _, position, errors in checked:
+            if errors:
+                result.add_error(position, errors)
+        batch = [doc for doc, _, errors in checked if not errors]
+        positions = [position for _, position, errors in checked if not errors]
+    if not batch:
+        return
+    failed = set()
+    try:
+        # ordered=False lets the server carry on past a bad document and report every failure at once
+        inserted = await collection.insert_many(batch, ordered=False)
+        result.inserted += len(inserted.inserted_ids)
+    except BulkWriteError as e:
+        result.inserted += e.details["nInserted"]
+        for write_error in e.details["writeErrors"]:
+            result.add_error(positions[write_error["index"]], write_error["errmsg"])
+            failed.add(write_error["index"])
+    if on_insert is not None:
+        on_insert([doc for i, doc in enumerate(batch) if i not in failed])
+
+
+async def bulk_insert(request: Request, collection, model: type[BaseModel], batch_size: int,
+                      check_batch=None, on_insert=None) -> dict:
+    """
+    Validate every item in the request body against model and insert the valid ones in batches of batch_size.
+    check_batch, if given, is awaited with each batch and returns a list of errors for every document in it.
+    on_insert, if given, is called with the documents of each batch that were actually written.
+    Returns how many were inserted and which positions failed and why.
+    """
+    result = BulkResult()
+    batch, positions = [], []
+    async for position, item in read_items(request):
+        if isinstance(item, Exception):
+            result.add_error(position, f"Invalid JSON: {item}")
+            continue
+        try:
+            # already encrypted values, e.g. from an export, are kept if they decrypt for this document
+            batch.append(to_document(model.parse_obj(item), imported=True))
+            positions.append(position)
+        except ValidationError as e:
+            result.add_error(position, e.errors())
+            continue
+        except HTTPException as e:
+            result.add_error(position, e.detail)
+            continue
+        if len(batch) >= batch_size:
+            await insert_batch(collection, batch, positions, result, check_batch, on_insert)
+            batch, positions = [], []
+    await insert_batch(collection, batch, positions, result, check_batch, on_insert)
+    return result.dict()
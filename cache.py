@@ -0,0 +1,219 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from database import config_bool, config_int
+
+
+class ReferenceCache:
+    """
+    In-memory copy of a small, read-mostly lookup collection. Entries can be found by "_id" or by the collection's
+    name field, expire after ttl seconds, and the least recently used entry is dropped once max_size is reached.
+    """
+    def __init__(self, collection: str, name_field: str, ttl: int, max_size: int):
+        self.collection = collection
+        self.name_field = name_field
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: OrderedDict[str, tuple[dict, float]] = OrderedDict()  # _id -> (document, expiry time)
+        self.names: dict[str, str] = {}  # name field value -> _id
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Look up a document by _id, then by name. Returns None (and counts a miss) if absent or expired
+        """
+        doc_id = key if key in self.entries else self.names.get(key)
+        if doc_id is not None:
+            doc, expires = self.entries[doc_id]
+            if expires > time.monotonic():
+                self.entries.move_to_end(doc_id)
+                self.hits += 1
+                return doc
+            self.invalidate(doc_id)
+        self.misses += 1
+        return None
+
+    def put(self, doc: dict):
+        self.invalidate(doc["_id"])  # drop the old name mapping in case the name changed
+        self.entries[doc["_id"]] = (doc, time.monotonic() + self.ttl)
+        if (name := doc.get(self.name_field)) is not None:
+            self.names[name] = doc["_id"]
+        while len(self.entries) > self.max_size:
+            self.invalidate(next(iter(self.entries)))
+
+    def invalidate(self, doc_id: Optional[str] = None):
+        """
+        Drop a single document, or everything if no ID is given
+        """
+        if doc_id is None:
+            self.entries.clear()
+            self.names.clear()
+            return
+        if (entry := self.entries.pop(doc_id, None)) is not None:
+            name = entry[0].get(self.name_field)
+            if self.names.get(name) == doc_id:
+                del self.names[name]
+
+    async def load(self, database):
+        self.invalidate()
+        async for doc in database[self.collection].find(limit=self.max_size):
+            self.put(doc)
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class ResultCache:
+    """
+    Cache for computed results (e.g. aggregation pipeline output) keyed by the parameters that produced them. There is
+    no way to tell which results a write affects, so any write to the underlying collection clears all of them.
+    """
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.results: dict[tuple, tuple[object, float]] = {}  # key -> (result, expiry time)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        if (entry := self.results.get(key)) is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def put(self, key: tuple, result):
+        self.results[key] = (result, time.monotonic() + self.ttl)
+
+    def invalidate(self):
+        self.results.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self.results), "hits": self.hits, "misses": self.misses}
+
+
+class VersionMap:
+    """
+    ETag and Last-Modified of recently read or written documents of one collection, so conditional GETs can be
+    answered without a query, plus a generation number for the collection as a whole that changes on every write.
+    Like the other caches, entries (and the generation) only last ttl seconds, which bounds how long a write made by
+    another worker or directly in Atlas goes unnoticed when the change stream is off.
+    """
+    def __init__(self, ttl: int, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: OrderedDict[str, tuple[str, Optional[str], float]] = OrderedDict()  # _id -> (etag, mtime, expiry)
+        self.generation = 0
+        self.generation_expires = time.monotonic() + ttl
+
+    def get(self, doc_id: str) -> Optional[tuple[str, Optional[str]]]:
+        if (entry := self.entries.get(doc_id)) is not None:
+            if entry[2] > time.monotonic():
+                self.entries.move_to_end(doc_id)
+                return entry[0], entry[1]
+            del self.entries[doc_id]
+        return None
+
+    def put(self, doc_id: str, etag: str, last_modified: Optional[str]):
+        self.entries[doc_id] = (etag, last_modified, time.monotonic() + self.ttl)
+        self.entries.move_to_end(doc_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, doc_id: Optional[str] = None):
+        """
+        Record a write: forget a single document, or everything if no ID is given, and start a new generation
+        """
+        if doc_id is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(doc_id, None)
+        self.generation += 1
+        self.generation_expires = time.monotonic() + self.ttl
+
+    def current_generation(self) -> int:
+        if self.generation_expires <= time.monotonic():
+            self.invalidate()
+        return self.generation
+
+
+CACHE_TTL = config_int("CACHE_TTL_SECONDS", 300)
+CACHE_MAX_SIZE = config_int("CACHE_MAX_SIZE", 10000)
+
+# one cache per reference collection, keyed by collection name
+caches = {
+    "countries": ReferenceCache("countries", "name", CACHE_TTL, CACHE_MAX_SIZE),
+    "areas": ReferenceCache("areas", "name", CACHE_TTL, CACHE_MAX_SIZE),
+    "mailboxes": ReferenceCache("mailboxes", "address", CACHE_TTL, CACHE_MAX_SIZE),
+    "personal_detail_type": ReferenceCache("personal_detail_type", "detail", CACHE_TTL, CACHE_MAX_SIZE),
+}
+# cached aggregation results, keyed by the collection they are computed from
+result_caches = {
+    "jobhunt": ResultCache(CACHE_TTL),
+}
+# document versions behind the ETag headers, keyed by collection
+versions = {collection: VersionMap(CACHE_TTL, CACHE_MAX_SIZE)
+            for collection in ("creds", "jobhunt", "countries", "areas", "mailboxes", "personal_detail_type")}
+
+
+def change_stream_enabled() -> bool:
+    # on by default when running several workers (see serve.py), since each has its own caches
+    return config_bool("CACHE_CHANGE_STREAM", default=int(os.environ.get("WEB_CONCURRENCY") or 1) > 1)
+
+
+async def load_caches(database):
+    for cache in caches.values():
+        await cache.load(database)
+
+
+def invalidate_all():
+    for cache in [*caches.values(), *result_caches.values(), *versions.values()]:
+        cache.invalidate()
+
+
+async def watch_caches(database, search_indexes: Optional[dict] = None):
+    """
+    Follow a change stream on the cached collections so that writes made by other workers (or directly in
+    Atlas) invalidate our copy, and update the given search indexes (keyed by collection) to match. Reconnects after
+    errors, since the stream is long-lived.
+    """
+    search_indexes = search_indexes or {}
+    pipeline = [{"$match": {"ns.coll": {"$in": sorted({*caches, *result_caches, *versions, *search_indexes})}}}]
+    resync = False
+    while True:
+        try:
+            # updateLookup includes the whole updated document, which is what the search indexes need
+            async with await database.watch(pipeline, full_document="updateLookup") as stream:
+                if resync:
+                    # we may have missed changes while disconnected. The stream is open again, so nothing written
+                    # from here on is missed
+                    for collection, index in search_indexes.items():
+                        await index.rebuild(database[collection])
+                    resync = False
+                async for change in stream:
+                    collection = change.get("ns", {}).get("coll")
+                    if (doc_id := change.get("documentKey", {}).get("_id")) is None:
+                        # drop/rename/invalidate events don't carry a document, so start afresh
+                        invalidate_all()
+                        continue
+                    if collection in caches:
+                        caches[collection].invalidate(doc_id)
+                    if collection in result_caches:
+                        result_caches[collection].invalidate()
+                    if collection in versions:
+                        versions[collection].invalidate(doc_id)
+                    if collection in search_indexes:
+                        if (doc := change.get("fullDocument")) is not None:
+                            search_indexes[collection].add(doc)
+                        else:  # deleted (or deleted again before we looked it up)
+                            search_indexes[collection].remove(doc_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Cache change stream interrupted ({e}), reconnecting")
+            invalidate_all()  # we may have missed changes while disconnected
+            resync = True
+            await asyncio.sleep(1)
@@ -0,0 +1,140 @@
+import email.utils
+import os
+import uuid
+import zlib
+from datetime import datetime, timezone
+from typing import Optional
+from fastapi import HTTPException, Request, Response, status
+from pydantic import BaseModel
+
+from cache import versions
+from serialization import serialize
+
+# HTTP conditional requests. A document's ETag is its revision ("3"), and its Last-Modified is its modified_at time,
+# so a client that sends back the ETag it last saw in If-None-Match gets an empty 304 if nothing has changed. For
+# documents whose version is already in cache.versions this is answered without querying MongoDB at all.
+#
+# Lists, search results and statistics get a weak ETag built from the generation of the collection(s) they come from,
+# which changes on every write. It is only meaningful to the process that issued it, hence the BOOT_ID in it.
+#
+# On PUT and DELETE, If-Match makes the write conditional on the document still being at the given revision, and a
+# write that loses the race is refused with 412 instead of silently overwriting someone else's change.
+BOOT_ID = uuid.uuid4().hex[:8]
+
+
+def new_boot_id():
+    global BOOT_ID
+    BOOT_ID = uuid.uuid4().hex[:8]
+
+
+os.register_at_fork(after_in_child=new_boot_id)  # workers forked from one parent mustn't share it (see serve.py)
+
+
+def etag(doc: dict) -> str:
+    return f'"{doc.get("revision", 0)}"'  # documents written before revisions existed count as revision 0
+
+
+def http_date(moment: datetime) -> str:
+    if moment.tzinfo is None:  # PyMongo returns naive datetimes in UTC
+        moment = moment.replace(tzinfo=timezone.utc)
+    return email.utils.format_datetime(moment.astimezone(timezone.utc), usegmt=True)
+
+
+def last_modified(doc: dict) -> Optional[str]:
+    modified = doc.get("modified_at")
+    return http_date(modified) if isinstance(modified, datetime) else None
+
+
+def matches(header: Optional[str], tag: str) -> bool:
+    # If-None-Match uses weak comparison, so W/"1" matches "1"
+    if not header:
+        return False
+    tags = {t.strip().removeprefix("W/") for t in header.split(",")}
+    return "*" in tags or tag.removeprefix("W/") in tags
+
+
+def not_modified(tag: str, modified: Optional[str]) -> Response:
+    headers = {"ETag": tag} if modified is None else {"ETag": tag, "Last-Modified": modified}
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+
+def set_version_headers(response: Response, collection: str, doc: dict):
+    """
+    Send the ETag and Last-Modified of a document that was just read or written, and remember them
+    """
+    tag, modified = etag(doc), last_modified(doc)
+    versions[collection].put(doc["_id"], tag, modified)
+    response.headers["ETag"] = tag
+    if modified is not None:
+        response.headers["Last-Modified"] = modified
+
+
+def cached_not_modified(request: Request, collection: str, doc_id: str) -> Optional[Response]:
+    """
+    A 304 for a conditional GET of a document whose current version we already know, so no query is needed
+    """
+    header = request.headers.get("if-none-match")
+    if header and (known := versions[collection].get(doc_id)) is not None and matches(header, known[0]):
+        return not_modified(*known)
+    return None
+
+
+def respond(request: Request, response: Response, collection: str, doc: dict, model: type[BaseModel],
+            exclude_none: bool = False):
+    """
+    Return a document with its version headers, or a 304 if the client's copy is the current one. exclude_none is
+    passed on to serialize
+    """
+    set_version_headers(response, collection, doc)
+    if matches(request.headers.get("if-none-match"), response.headers["ETag"]):
+        return not_modified(response.headers["ETag"], response.headers.get("Last-Modified"))
+    return serialize(doc, model, response, exclude_none)
+
+
+def list_not_modified(request: Request, response: Response, *collections: str) -> Optional[Response]:
+    """
+    Set the weak ETag of a list/search/statistics response built from the given collections, and return a 304 if the
+    client already has it. Call before querying, so a write racing with the query can only cause a needless 200
+    """
+    generations = "-".join(str(versions[collection].current_generation()) for collection in collections)
+    query = zlib.crc32(f"{request.url.path}?{request.url.query}".encode())
+    tag = f'W/"{BOOT_ID}-{generations}-{query:08x}"'
+    if matches(request.headers.get("if-none-match"), tag):
+        return not_modified(tag, None)
+    response.headers["ETag"] = tag
+    return None
+
+
+def match_condition(request: Request) -> dict:
+    """
+    Extra filter for a PUT/DELETE sent with If-Match: the document must still be at one of the given revisions. Weak
+    or unrecognised ETags never match
+    """
+    header = request.headers.get("if-match")
+    if not header or header.strip() == "*":
+        return {}
+    revisions = []
+    for tag in header.split(","):
+        tag = tag.strip()
+        if len(tag) > 2 and tag[0] == tag[-1] == '"' and tag[1:-1].isdigit():
+            revisions.append(int(tag[1:-1]) or None)  # revision 0 means the field isn't there yet
+    return {"revision": {"$in": revisions}}
+
+
+async def check_precondition(collection, doc_id: str, condition: dict):
+    """
+    Call when a conditional write matched nothing: raises 412 if that's because the document has since changed, and
+    otherwise returns so the caller can answer 404
+    """
+    if condition and await collection.count_documents({"_id": doc_id}, limit=1):
+        raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED,
+                            detail=f"Document with ID {doc_id} has been modified since it was read")
+
+
+def record_write(response: Response, collection: str, doc_id: str, doc: Optional[dict] = None):
+    """
+    Start a new generation of the collection after a write, and send the new version of doc (None if deleted)
+    """
+    versions[collection].invalidate(doc_id)
+    if doc is not None:
+        set_version_headers(response, collection, doc)
@@ -0,0 +1,50 @@
+from typing import Optional
+from dotenv import dotenv_values
+from pymongo import AsyncMongoClient
+
+
+# using connection string in .env file (with username and password), login to our MongoDB
+config = dotenv_values(".env")
+
+
+def config_int(key: str, default: int) -> int:
+    """
+    Read an integer setting from the .env file, falling back to the default if it is missing or blank
+    """
+    value = config.get(key)
+    return int(value) if value else default
+
+
+def config_bool(key: str, default: bool = False) -> bool:
+    """
+    Read a true/false setting from the .env file (1/true/yes count as true)
+    """
+    value = config.get(key)
+    return value.lower() in ("1", "true", "yes") if value else default
+
+
+def create_client() -> AsyncMongoClient:
+    """
+    Build the async client used by every router. Pool size and timeouts can be tuned in .env
+    """
+    from metrics import event_listeners  # imported here since metrics itself reads settings from this module
+
+    return AsyncMongoClient(
+        config["ATLAS_URI"],
+        maxPoolSize=config_int("MONGO_MAX_POOL_SIZE", 100),
+        minPoolSize=config_int("MONGO_MIN_POOL_SIZE", 0),
+        connectTimeoutMS=config_int("MONGO_CONNECT_TIMEOUT_MS", 20000),
+        serverSelectionTimeoutMS=config_int("MONGO_SERVER_SELECTION_TIMEOUT_MS", 30000),
+        socketTimeoutMS=config_int("MONGO_SOCKET_TIMEOUT_MS", 0) or None,  # 0 => no timeout
+        waitQueueTimeoutMS=config_int("MONGO_WAIT_QUEUE_TIMEOUT_MS", 0) or None,
+        event_listeners=event_listeners(),  # command and pool checkout timings for /metrics
+    )
+
+
+async def find_by_id_or_name(collection, key: str, name_field: str) -> Optional[dict]:
+    """
+    Find a document whose "_id" or name field equals key, in a single query that can use both the "_id" index and
+    the unique index on the name field. If one document matches by "_id" and another by name, "_id" wins.
+    """
+    docs = await collection.find({"$or": [{"_id": key}, {name_field: key}]}).limit(2).to_list(None)
+    return next((doc for doc in docs if doc["_id"] == key), docs[0] if docs else None)
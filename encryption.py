@@ -0,0 +1,129 @@
+import base64
+import os
+from functools import lru_cache
+from typing import Optional
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from fastapi import HTTPException, status
+
+from database import config, config_int
+
+# Envelope encryption for the secret parts of a credential. Each write generates a random AES-256 data key, which
+# encrypts the values with AES-GCM; the data key itself is encrypted ("wrapped") with the master key from .env and
+# stored alongside each value, so a value can always be decrypted on its own:
+#
+#     enc:v1:<wrapped data key>:<nonce + ciphertext>
+#
+# Values are bound to their record and field (as AES-GCM associated data), so they can't be swapped between
+# credentials. Values sent through the API are always encrypted, even if they look encrypted already; only bulk
+# imports keep ciphertext (as exported by /cred/export), after checking that it decrypts for the record it is in.
+# Without MASTER_KEY in .env, values are stored in plaintext as before.
+PREFIX = "enc:v1:"
+ENCRYPTED_FIELDS = ("password",)
+ENCRYPTED_DICT_FIELDS = ("security_questions", "personal_details")  # only the values; keys stay searchable
+NONCE_SIZE = 12
+MASTER_KEY: Optional[bytes] = base64.b64decode(config["MASTER_KEY"]) if config.get("MASTER_KEY") else None
+
+
+def b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def new_data_key() -> tuple[AESGCM, str]:
+    key = AESGCM.generate_key(bit_length=256)
+    nonce = os.urandom(NONCE_SIZE)
+    wrapped = b64(nonce + AESGCM(MASTER_KEY).encrypt(nonce, key, b"data-key"))
+    return AESGCM(key), wrapped
+
+
+@lru_cache(maxsize=config_int("DATA_KEY_CACHE_SIZE", 4096))
+def unwrap(wrapped: str) -> AESGCM:
+    """
+    Decrypt a wrapped data key with the master key. Recently used keys are cached, so reading several values of one
+    credential (or re-reading a credential) only unwraps its key once
+    """
+    raw = base64.urlsafe_b64decode(wrapped)
+    return AESGCM(AESGCM(MASTER_KEY).decrypt(raw[:NONCE_SIZE], raw[NONCE_SIZE:], b"data-key"))
+
+
+def encrypt_value(key: AESGCM, wrapped: str, context: str, value: str) -> str:
+    nonce = os.urandom(NONCE_SIZE)
+    return f"{PREFIX}{wrapped}:{b64(nonce + key.encrypt(nonce, value.encode(), context.encode()))}"
+
+
+def decrypt_value(context: str, value: str) -> str:
+    if not value.startswith(PREFIX):  # stored before encryption was enabled
+        return value
+    if MASTER_KEY is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                            detail="Credential is encrypted but MASTER_KEY is not configured")
+    try:
+        wrapped, ciphertext = value[len(PREFIX):].split(":", 1)
+        raw = base64.urlsafe_b64decode(ciphertext)
+        key = unwrap(wrapped)
+    except (InvalidTag, ValueError):  # ValueError: not two parts, not base64, or not a key
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"{context} is not a valid encrypted value")
+    try:
+        return key.decrypt(raw[:NONCE_SIZE], raw[NONCE_SIZE:], context.encode()).decode()
+    except (InvalidTag, ValueError):
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                            detail=f"Could not decrypt {context}; wrong MASTER_KEY or tampered value")
+
+
+def protect_value(key: AESGCM, wrapped: str, context: str, value: str, imported: bool) -> str:
+    """
+    Encrypt a value sent by a client. Imported values may already be encrypted (e.g. from /cred/export); those are
+    kept as they are, but only once they have been shown to decrypt for this very credential and field
+    """
+    if imported and value.startswith(PREFIX):
+        decrypt_value(context, value)
+        return value
+    return encrypt_value(key, wrapped, context, value)
+
+
+def encrypt_fields(doc_id: str, fields: dict, imported: bool = False) -> dict:
+    """
+    Return a copy of fields (a whole credential, or the fields of an update) with the secret values encrypted under
+    a fresh data key. With imported, values that are already encrypted are checked and kept (see protect_value)
+    """
+    if MASTER_KEY is None:
+        check_plaintext(fields)
+        return fields
+    key, wrapped = new_data_key()
+    encrypted = dict(fields)
+    for field in ENCRYPTED_FIELDS:
+        if isinstance(encrypted.get(field), str):
+            encrypted[field] = protect_value(key, wrapped, f"{doc_id}:{field}", encrypted[field], imported)
+    for field in ENCRYPTED_DICT_FIELDS:
+        if isinstance(encrypted.get(field), dict):
+            encrypted[field] = {k: protect_value(key, wrapped, f"{doc_id}:{field}.{k}", v, imported)
+                                if isinstance(v, str) else v for k, v in encrypted[field].items()}
+    return encrypted
+
+
+def check_plaintext(fields: dict):
+    # stored in plaintext, a value starting with PREFIX would be taken for an encrypted one when it is read back
+    values = [fields.get(field) for field in ENCRYPTED_FIELDS]
+    for field in ENCRYPTED_DICT_FIELDS:
+        if isinstance(fields.get(field), dict):
+            values += fields[field].values()
+    if any(isinstance(value, str) and value.startswith(PREFIX) for value in values):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"Secret values can't start with {PREFIX!r} unless MASTER_KEY is configured")
+
+
+def decrypt_fields(doc: dict) -> dict:
+    """
+    Return a copy of a stored credential with its secret values decrypted. Only called when the secrets are actually
+    wanted, so listing credentials never pays for decryption
+    """
+    decrypted = dict(doc)
+    for field in ENCRYPTED_FIELDS:
+        if isinstance(decrypted.get(field), str):
+            decrypted[field] = decrypt_value(f"{doc['_id']}:{field}", decrypted[field])
+    for field in ENCRYPTED_DICT_FIELDS:
+        if isinstance(decrypted.get(field), dict):
+            decrypted[field] = {k: decrypt_value(f"{doc['_id']}:{field}.{k}", v) if isinstance(v, str) else v
+                                for k, v in decrypted[field].items()}
+    return decrypted
@@ -0,0 +1,82 @@
+import re
+from typing import Optional
+from fastapi import HTTPException, Response, status
+from pymongo import ASCENDING, DESCENDING
+
+from database import config_bool
+from indexes import INDEXES
+
+# If false (the default), list queries that no index can serve are refused with 400 instead of scanning the collection
+ALLOW_UNINDEXED_QUERIES = config_bool("ALLOW_UNINDEXED_QUERIES")
+
+
+def build_filter(params: dict[str, Optional[str]]) -> dict:
+    """
+    Turn query parameters into a Mongo filter. A value ending in "*" is a prefix match (which can still use an index,
+    since the regex is anchored); anything else is an exact match. Parameters that weren't given are ignored.
+    """
+    query = {}
+    for field, value in params.items():
+        if value is None:
+            continue
+        if value.endswith("*"):
+            query[field] = {"$regex": "^" + re.escape(value[:-1])}
+        else:
+            query[field] = value
+    return query
+
+
+def build_projection(fields: Optional[str], allowed: set[str]) -> Optional[dict]:
+    """
+    fields is a comma separated list of fields to return, e.g. "username,email". "_id" is always returned
+    """
+    if not fields:
+        return None
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    if unknown := [field for field in requested if field not in allowed]:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown fields {unknown}")
+    return {field: 1 for field in requested}
+
+
+def build_sort(sort: Optional[str], allowed: set[str]) -> list[tuple[str, int]]:
+    """
+    sort is a comma separated list of fields, each optionally prefixed with "-" for descending order, e.g. "-country"
+    """
+    if not sort:
+        return []
+    keys = []
+    for key in (key.strip() for key in sort.split(",") if key.strip()):
+        field, direction = (key[1:], DESCENDING) if key.startswith("-") else (key, ASCENDING)
+        if field not in allowed:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Cannot sort by {field}")
+        keys.append((field, direction))
+    return keys
+
+
+def leading_index_keys(collection: str) -> set[str]:
+    # a query can only use an index through its first key; "_id" always has an index
+    return {"_id"} | {next(iter(index.document["key"])) for index in INDEXES.get(collection, [])}
+
+
+def check_indexed(collection: str, query: dict, sort: list[tuple[str, int]], response: Response):
+    """
+    Make sure a filtered/sorted listing can be answered from an index rather than a collection scan. With a filter,
+    at least one filtered field must lead an index (the remaining fields are then checked on the few documents the
+    index returns). Without a filter, the first sort key must lead an index. Unindexed queries are rejected, or only
+    flagged in an X-Query-Warning header if ALLOW_UNINDEXED_QUERIES is set.
+    """
+    indexed = leading_index_keys(collection)
+    if query:
+        problem = None if indexed & set(query) else f"none of the filtered fields {sorted(query)} are indexed"
+    elif sort:
+        problem = None if sort[0][0] in indexed else f"sort field {sort[0][0]} is not indexed"
+    else:
+        problem = None
+    if problem is None:
+        return
+    if not ALLOW_UNINDEXED_QUERIES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Query would scan the whole {collection} collection: {problem}. "
+                                   f"Indexed fields are {sorted(indexed)}")
+    print(f"Unindexed query on {collection}: {problem}")
+    response.headers["X-Query-Warning"] = f"Unindexed query: {problem}"
@@ -0,0 +1,145 @@
+from datetime import datetime, timezone
+from typing import Optional
+from pymongo import UpdateOne
+
+from database import config_bool, config_int
+
+# History of credential changes, so a bad update (e.g. a password rotation gone wrong) or delete can be undone. Each
+# update or delete of a credential adds an entry to the cred_history collection, written in the same transaction as
+# the change itself. Entries are reverse deltas: they hold only the old values of the fields that changed, e.g.
+#
+#     {"cred_id": ..., "revision": 5, "op": "update", "at": ..., "before": {"password": <old>, "modified_at": ...}}
+#
+# so a past revision is rebuilt by starting from the current credential (or, once deleted, from the copy kept by its
+# delete entry) and undoing entries newest first. Secret values are stored encrypted, as in the credential itself.
+# Creating a credential overwrites nothing, so it needs no entry. Entries expire after CREDENTIAL_HISTORY_TTL_DAYS.
+HISTORY = config_bool("CREDENTIAL_HISTORY", default=True)
+HISTORY_COLLECTION = "cred_history"
+HISTORY_TTL_DAYS = config_int("CREDENTIAL_HISTORY_TTL_DAYS", 365)
+
+
+def history_enabled() -> bool:
+    return HISTORY
+
+
+def now() -> datetime:
+    # MongoDB keeps datetimes to the millisecond, so round here and what we return matches what is stored
+    at = datetime.now(timezone.utc)
+    return at.replace(microsecond=at.microsecond // 1000 * 1000)
+
+
+def stamped(fields: dict, at: datetime) -> dict:
+    """
+    Like models.versioned, but with the modified_at time given rather than the server's, so the new version of the
+    document can be worked out from the old one without reading it back
+    """
+    return {"$set": {**fields, "modified_at": at}, "$inc": {"revision": 1}}
+
+
+def updated(before: dict, fields: dict, at: datetime) -> dict:
+    return {**before, **fields, "revision": before.get("revision", 0) + 1, "modified_at": at}
+
+
+def update_entry(before: dict, fields: dict, at: datetime) -> dict:
+    entry = {"cred_id": before["_id"], "revision": before.get("revision", 0) + 1, "op": "update", "at": at,
+             "before": {k: before[k] for k in fields if k in before and before[k] != fields[k]}}
+    if "modified_at" in before:
+        entry["before"]["modified_at"] = before["modified_at"]
+    if unset := [k for k in [*fields, "modified_at"] if k not in before]:  # e.g. credentials from before versioning
+        entry["unset"] = unset
+    return entry
+
+
+async def in_transaction(database, callback):
+    async with database.client.start_session() as session:
+        return await session.with_transaction(callback)
+
+
+async def update_with_history(database, doc_id: str, condition: dict, fields: dict) -> Optional[dict]:
+    """
+    $set fields on a credential matching condition, recording the change. Returns the updated credential, or None if
+    nothing matched
+    """
+    at = now()
+
+    async def write(session):
+        before = await database["creds"].find_one_and_update({"_id": doc_id, **condition}, stamped(fields, at),
+                                                             session=session)
+        if before is not None:
+            await database[HISTORY_COLLECTION].insert_one(update_entry(before, fields, at), session=session)
+        return before
+
+    before = await in_transaction(database, write)
+    return updated(before, fields, at) if before is not None else None
+
+
+async def update_many_with_history(database, updates: dict[str, dict]):
+    """
+    Apply several updates ({_id: fields to $set}) with one bulk_write, recording each change. Used by the write-behind
+    queue, so a batch of merged updates becomes one history entry per credential
+    """
+    at = now()
+
+    async def write(session):
+        projection = {field: 1 for fields in updates.values() for field in fields} | {"revision": 1, "modified_at": 1}
+        befores = await database["creds"].find({"_id": {"$in": list(updates)}}, projection,
+                                                session=session).to_list(None)
+        requests = [UpdateOne({"_id": doc_id}, stamped(fields, at)) for doc_id, fields in updates.items()]
+        await database["creds"].bulk_write(requests, ordered=False, session=session)
+        if befores:
+            await database[HISTORY_COLLECTION].insert_many(
+                [update_entry(before, updates[before["_id"]], at) for before in befores], session=session)
+
+    await in_transaction(database, write)
+
+
+async def delete_with_history(database, doc_id: str, condition: dict) -> bool:
+    """
+    Delete a credential matching condition, keeping a copy of it in its history. Returns whether anything was deleted
+    """
+    async def write(session):
+        before = await database["creds"].find_one_and_delete({"_id": doc_id, **condition}, session=session)
+        if before is not None:
+            await database[HISTORY_COLLECTION].insert_one({"cred_id": doc_id, "revision": before.get("revision", 0),
+                                                           "op": "delete", "at": now(), "before": before},
+                                                          session=session)
+        return before is not None
+
+    return await in_transaction(database, write)
+
+
+def entries(database, doc_id: str):
+    # a delete and the update before it can share a millisecond (and a revision); the delete comes first, "d" < "u"
+    return database[HISTORY_COLLECTION].find({"cred_id": doc_id}).sort([("at", -1), ("revision", -1), ("op", 1)])
+
+
+async def list_revisions(database, doc_id: str, limit: int) -> list[dict]:
+    """
+    The recorded changes of a credential, newest first, with the names (not values) of the fields each one changed
+    """
+    found = await entries(database, doc_id).limit(limit).to_list(None)
+    return [{"revision": entry["revision"], "op": entry["op"], "at": entry["at"],
+             "changed": sorted(k for k in [*entry.get("before", {}), *entry.get("unset", [])] if k != "modified_at")
+             if entry["op"] == "update" else []} for entry in found]
+
+
+async def rebuild_revision(database, doc_id: str, revision: int) -> Optional[dict]:
+    """
+    A credential as it was at the given revision, by undoing the changes made since. None if that revision never
+    existed or the history back to it has expired
+    """
+    state = await database["creds"].find_one({"_id": doc_id})
+    async for entry in entries(database, doc_id):
+        if state is not None and state.get("revision", 0) <= revision:
+            break
+        if entry["op"] == "delete":
+            if state is not None:
+                break  # deleted before the current credential was created with the same ID
+            state = entry["before"]
+        elif state is None or entry["revision"] != state.get("revision", 0):
+            break  # a gap, where the entries in between have expired
+        else:
+            state = {**state, **entry.get("before", {}), "revision": entry["revision"] - 1}
+            for field in entry.get("unset", []):
+                state.pop(field, None)
+    return state if state is not None and state.get("revision", 0) == revision else None
@@ -0,0 +1,42 @@
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from history import HISTORY_COLLECTION, HISTORY_TTL_DAYS
+
+# Indexes each collection should have, keyed by collection name. They are applied by ensure_indexes() when the
+# application starts; create_indexes is a no-op for indexes that already exist with the same spec, so this is
+# safe to run on every startup. Add new indexes here rather than creating them by hand in Atlas.
+INDEXES = {
+    "countries": [
+        IndexModel([("name", ASCENDING)], unique=True, name="name_unique"),
+    ],
+    "areas": [
+        IndexModel([("name", ASCENDING)], unique=True, name="name_unique"),
+    ],
+    "mailboxes": [
+        IndexModel([("address", ASCENDING)], unique=True, name="address_unique"),
+    ],
+    "personal_detail_type": [
+        IndexModel([("detail", ASCENDING)], unique=True, name="detail_unique"),
+    ],
+    "creds": [
+        IndexModel([("area", ASCENDING)], name="area"),
+        IndexModel([("country", ASCENDING)], name="country"),
+        IndexModel([("email", ASCENDING)], name="email"),
+        IndexModel([("username", ASCENDING)], name="username"),
+    ],
+    "jobhunt": [
+        IndexModel([("status", ASCENDING), ("apply_date", ASCENDING)], name="status_apply_date"),
+        IndexModel([("medium", ASCENDING)], name="medium"),
+    ],
+    HISTORY_COLLECTION: [
+        IndexModel([("cred_id", ASCENDING), ("at", DESCENDING)], name="cred_id_at"),
+        # TTL index: MongoDB deletes entries this long after they were written. To change the TTL of an existing
+        # index, use collMod (or drop the index and let the next startup recreate it)
+        IndexModel([("at", ASCENDING)], expireAfterSeconds=HISTORY_TTL_DAYS * 24 * 3600, name="at_ttl"),
+    ],
+}
+
+
+async def ensure_indexes(database):
+    for collection, indexes in INDEXES.items():
+        await database[collection].create_indexes(indexes)
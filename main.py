@@ -1,32 +1,57 @@
-from fastapi import FastAPI
-from dotenv import dotenv_values
-from pymongo import MongoClient
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, status
+from pymongo.errors import ConnectionFailure
 
+from cache import caches, result_caches
+from database import config, create_client
+from metrics import render_metrics, time_request
+from ratelimit import LimitRequests
+from snapshot import (OfflineUnsupported, ServeOffline, mongodb_unreachable, offline_unsupported, refresh_loop,
+                      snapshot_enabled)
+from startup import check_ready, gave_up, wait_until_ready, warm_up
+from write_behind import credential_queue
 from routers.cred_router import router as c_router
 from routers.country_router import router as c2_router
 from routers.pdetail_router import router as p_router
 from routers.mailbox_router import router as m_router
 from routers.area_router import router as a_router
+from routers.jobhunt_router import router as j_router
 
 
-# using connection string in .env file (with username and password), login to our MongoDB
-config = dotenv_values(".env")
-
-app = FastAPI()
-
-
-# event handler to connect to Atlas cluster when application starts
-@app.on_event("startup")
-def startup_db_client():
-    app.mongodb_client = MongoClient(config["ATLAS_URI"])
+# Runs once in every worker process, after the fork when there are several (see serve.py), so each worker builds its
+# own client and connection pool, and its own caches and search indexes. Nothing here waits for MongoDB; the rest of
+# startup runs in the background, see startup.py
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the client connects to the Atlas cluster on its first operation, not here
+    app.mongodb_client = create_client()
     app.database = app.mongodb_client[config["DB_NAME"]]
-    print("Connected to the MongoDB database!")  # should see this message if successfully connected
+    app.ready = asyncio.Event()
+    app.startup_error = None
+    app.cache_watcher = None
+    app.warm_up = asyncio.create_task(warm_up(app))
+    # keep the local snapshot that reads fall back on when Atlas is unreachable up to date
+    app.snapshotter = asyncio.create_task(refresh_loop(app.database)) if snapshot_enabled() else None
+    yield
+    # disconnect from the Atlas cluster when the application ends
+    app.warm_up.cancel()
+    if app.snapshotter is not None:
+        app.snapshotter.cancel()
+    if app.cache_watcher is not None:
+        app.cache_watcher.cancel()
+    await credential_queue.stop()  # flush queued updates
+    await app.mongodb_client.close()
 
 
-# event handler to disconnect from Atlas cluster when application ends
-@app.on_event("shutdown")
-def shutdown_db_client():
-    app.mongodb_client.close()
+app = FastAPI(lifespan=lifespan)
+app.add_exception_handler(ConnectionFailure, mongodb_unreachable)  # 503 rather than 500, see snapshot.py
+app.add_exception_handler(OfflineUnsupported, offline_unsupported)
+# middleware added later runs first, so requests refused by the rate limiter still show up in the metrics (as 429s)
+app.middleware("http")(wait_until_ready)  # hold requests back until startup.warm_up has finished
+app.add_middleware(ServeOffline)  # answer GETs from the local snapshot while Atlas is unreachable
+app.add_middleware(LimitRequests)  # per-client rate and concurrency limits, see ratelimit.py
+app.middleware("http")(time_request)  # per-route latency, and how much of it was spent on MongoDB
 
 
 # add router for each collection
@@ -35,3 +60,29 @@ app.include_router(m_router, tags=["mailboxes"], prefix="/mailbox")
 app.include_router(a_router, tags=["areas"], prefix="/area")
 app.include_router(p_router, tags=["personal_detail_types"], prefix="/personal_detail_types")
 app.include_router(c2_router, tags=["countries"], prefix="/country")
+app.include_router(j_router, tags=["jobhunt"], prefix="/jobhunt")
+
+
+@app.get("/health/live", tags=["health"],
+         response_description="200 as long as the worker is serving requests, 503 if startup failed for good")
+def live(request: Request):
+    if gave_up(request.app):
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail=f"Startup failed: {request.app.startup_error}")
+    return {"status": "alive"}
+
+
+@app.get("/health/ready", tags=["health"],
+         response_description="200 once startup has finished and MongoDB answers, 503 until then")
+async def ready(request: Request):
+    return await check_ready(request.app)
+
+
+@app.get("/cache/stats", tags=["cache"], response_description="Hit/miss counters of the reference collection caches")
+def cache_stats():
+    return {name: cache.stats() for name, cache in [*caches.items(), *result_caches.items()]}
+
+
+@app.get("/metrics", tags=["metrics"], response_description="Latency histograms in Prometheus text format")
+def metrics():
+    return render_metrics()
@@ -0,0 +1,150 @@
+import bisect
+import time
+from contextvars import ContextVar
+from typing import Optional
+from fastapi import Request
+from fastapi.responses import PlainTextResponse
+from pymongo import monitoring
+
+from database import config_int
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+SLOW_QUERY_MS = config_int("SLOW_QUERY_MS", 0)  # log MongoDB commands slower than this; 0 disables the log
+
+
+class Histogram:
+    """
+    Prometheus-style latency histogram with one series per combination of label values
+    """
+    def __init__(self, name: str, description: str, labels: tuple[str, ...]):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.series: dict[tuple[str, ...], list] = {}  # label values -> [bucket counts, sum, count]
+
+    def observe(self, label_values: tuple[str, ...], seconds: float):
+        series = self.series.setdefault(label_values, [[0] * len(BUCKETS), 0.0, 0])
+        index = bisect.bisect_left(BUCKETS, seconds)
+        if index < len(BUCKETS):
+            series[0][index] += 1
+        series[1] += seconds
+        series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for label_values, (buckets, total, count) in self.series.items():
+            labels = ",".join(f'{k}="{v}"' for k, v in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, buckets):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+request_seconds = Histogram("http_request_duration_seconds", "Time to handle a request, by route",
+                            ("method", "route", "status"))
+request_mongo_seconds = Histogram("http_request_mongo_seconds",
+                                  "Time spent waiting on MongoDB while handling a request, by route",
+                                  ("method", "route"))
+command_seconds = Histogram("mongodb_command_duration_seconds", "MongoDB command round trip time",
+                            ("collection", "command", "outcome"))
+checkout_seconds = Histogram("mongodb_pool_checkout_seconds", "Time spent waiting for a pooled connection",
+                             ("outcome",))
+
+# MongoDB time accumulated by the request currently being handled (commands run in the request's own task)
+current_mongo_seconds: ContextVar[Optional[list[float]]] = ContextVar("current_mongo_seconds", default=None)
+
+
+class CommandTimer(monitoring.CommandListener):
+    def __init__(self):
+        self.collections: dict[int, str] = {}  # request_id -> collection; only the started event includes it
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self.collections[event.request_id] = collection if isinstance(collection, str) else ""
+
+    def record(self, event, outcome: str):
+        collection = self.collections.pop(event.request_id, "")
+        seconds = event.duration_micros / 1e6
+        command_seconds.observe((collection, event.command_name, outcome), seconds)
+        if (spent := current_mongo_seconds.get()) is not None:
+            spent[0] += seconds
+        if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+            print(f"Slow MongoDB command: {event.command_name} on {collection or event.database_name} "
+                  f"took {seconds * 1000:.1f}ms ({outcome})")
+
+    def succeeded(self, event):
+        self.record(event, "success")
+
+    def failed(self, event):
+        self.record(event, "failure")
+
+
+class PoolTimer(monitoring.ConnectionPoolListener):
+    # only the checkout events matter here; the rest of the pool lifecycle is ignored
+    def connection_checked_out(self, event):
+        checkout_seconds.observe(("success",), event.duration)
+
+    def connection_check_out_failed(self, event):
+        checkout_seconds.observe(("failure",), event.duration)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+def event_listeners() -> list:
+    return [CommandTimer(), PoolTimer()]
+
+
+async def time_request(request: Request, call_next):
+    """
+    Middleware recording how long each route takes, and how much of that was spent on MongoDB. The rest is our own
+    work (validation, serialization, etc)
+    """
+    spent = [0.0]
+    token = current_mongo_seconds.set(spent)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        current_mongo_seconds.reset(token)
+    elapsed = time.perf_counter() - start
+    # label by the route template (e.g. /cred/{id}) rather than the actual path, to keep the number of series bounded
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    request_seconds.observe((request.method, route, str(response.status_code)), elapsed)
+    request_mongo_seconds.observe((request.method, route), spent[0])
+    return response
+
+
+def render_metrics() -> PlainTextResponse:
+    lines = []
+    for histogram in (request_seconds, request_mongo_seconds, command_seconds, checkout_seconds):
+        lines.extend(histogram.render())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
@@ -1,6 +1,36 @@
 import uuid
-from typing import Optional
+from datetime import datetime, timezone
+from typing import Generic, Optional, TypeVar
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel, Field
+from pydantic.generics import GenericModel
+
+from encryption import encrypt_fields
+
+# Stamped on every document written through the API, to record that it passed validation against the models below.
+# Bump this whenever a model changes in a way that could make previously stored documents invalid.
+SCHEMA_VERSION = 1
+
+
+def to_document(model: BaseModel, imported: bool = False) -> dict:
+    """
+    Convert a validated model into the dict we store in MongoDB, with any secret fields (passwords etc.) encrypted.
+    imported is passed on to encrypt_fields
+    """
+    doc = jsonable_encoder(model)
+    doc = encrypt_fields(doc["_id"], doc, imported)
+    doc["schema_version"] = SCHEMA_VERSION
+    doc["revision"] = 1
+    doc["modified_at"] = datetime.now(timezone.utc)
+    return doc
+
+
+def versioned(update: dict) -> dict:
+    """
+    Add to a MongoDB update document the operators that bump the document's revision (1 when inserted) and set its
+    modified_at time. Its ETag and Last-Modified headers are made from these
+    """
+    return {**update, "$inc": {"revision": 1}, "$currentDate": {"modified_at": True}}
 
 
 # Basic models - Country, Area, PersonalDetails, Mailbox
@@ -104,18 +134,39 @@ class Credential(BaseModel):  # extend BaseModel from pydantic package
         }
 
 
+# Credential with its country, area and email resolved to the documents they refer to (see GET /cred/?expand=)
+class CredentialReferences(BaseModel):
+    country: Optional[Country]
+    area: Optional[Area]
+    email: Optional[Mailbox]
+
+
+class ExpandedCredential(Credential):
+    expanded: Optional[CredentialReferences]
+
+
+Document = TypeVar("Document", bound=BaseModel)
+
+
+# Answer to GET /<collection>/batch?ids=: the documents found, in the order they were asked for, and the IDs/names
+# that matched nothing
+class Batch(GenericModel, Generic[Document]):
+    found: list[Document]
+    missing: list[str]
+
+
 class JobHuntCredential(Credential):
     """
     Initialise model for JobHuntCredential class, which includes additional fields.
     """
     post_name: str = Field(...)
     contact_person: dict = Field(...)  # may be multiple contact people, so use dict
-    expected_salary: tuple[int]  # range of salary. tuple (x, y) denotes salary s such that x ≤ s ≤ y
+    expected_salary: tuple[int, int]  # range of salary. tuple (x, y) denotes salary s such that x ≤ s ≤ y
     reference_number: str = Field(...)
-    apply_date: str = Field(...)  # date
+    apply_date: str = Field(...)  # date, as YYYY-MM-DD
     status: str = Field(...)  # PENDING, OFFERED, REJECTED TODO base class?
     medium: str = Field(...)  # where did you find this job post? TODO base class?
-    follow_ups: dict = Field(...)  # use dict to store each follow up. key is Date, value is action taken
+    follow_ups: dict = Field(...)  # use dict to store each follow up. key is Date (YYYY-MM-DD), value is action taken
     # use dict to store. key is Date, value is relevant files (eg interview notes/telephone correspondence)
     follow_up_files: dict = Field(...)
 
@@ -124,13 +175,27 @@ class JobHuntCredential(Credential):
 
     class Config:
         allow_population_by_field_name = True
-        # TODO example
         schema_extra = {
             "example": {
-                "_id": "066de609-b04a-4b30-b46c-32537c7f1f6e",
-                "title": "Don Quixote",
-                "author": "Miguel de Cervantes",
-                "synopsis": "..."
+                "username": "rt_hon_lettuce_head_mp",
+                "password": "pleasehireme",
+                "email": "nevergonnagiveyouup@astley.co.uk",
+                "country": "United Kingdom",
+                "area": "Job Hunting",
+                "login_override": "",
+                "personal_details": {},
+                "security_questions": {},
+                "post_name": "Backend Engineer",
+                "contact_person": {"Recruiter": "Jane Doe"},
+                "expected_salary": [50000, 60000],
+                "reference_number": "REQ-1234",
+                "apply_date": "2022-11-01",
+                "status": "PENDING",
+                "medium": "LinkedIn",
+                "follow_ups": {"2022-11-08": "Emailed recruiter"},
+                "follow_up_files": {},
+                "job_description": "Build and run our Kafka data pipelines...",
+                "application_details": ["cv.pdf", "cover_letter.pdf"]
             }
         }
 
@@ -192,28 +257,31 @@ class PersonalDetailsUpdate(BaseModel):
 class CredentialUpdate(BaseModel):
     # don't include 'id' field since that shouldn't be updatable
     # optional fields during update
-    # TODO
-    title: Optional[str]
-    author: Optional[str]
-    synopsis: Optional[str]
+    username: Optional[str]
+    email: Optional[str]
+    password: Optional[str]
+    country: Optional[str]
+    area: Optional[str]
+    login_override: Optional[str]
+    personal_details: Optional[dict[str, str]]
+    security_questions: Optional[dict[str, str]]
 
     class Config:
         schema_extra = {
             "example": {
-                "title": "Don Quixote",
-                "author": "Miguel de Cervantes",
-                "synopsis": "Don Quixote is a Spanish novel by Miguel de Cervantes..."
+                "password": "pleasebuyadrinkfirst2",
+                "area": "Banking"
             }
         }
 
 
-class JobHuntCredentialUpdate(Credential):
+class JobHuntCredentialUpdate(CredentialUpdate):
     """
     Initialise model for JobHuntCredentialUpdate, which includes additional fields.
     """
     post_name: Optional[str]
     contact_person: Optional[dict]
-    expected_salary: Optional[tuple[int]]
+    expected_salary: Optional[tuple[int, int]]
     reference_number: Optional[str]
     apply_date: Optional[str]
     status: Optional[str]  # PENDING, OFFERED, REJECTED TODO base class?
@@ -224,12 +292,9 @@ class JobHuntCredentialUpdate(Credential):
     application_details: Optional[list[str]]  # stores list of files used in application, from cover letters to CVs
 
     class Config:
-        # TODO example
         schema_extra = {
             "example": {
-                "_id": "066de609-b04a-4b30-b46c-32537c7f1f6e",
-                "title": "Don Quixote",
-                "author": "Miguel de Cervantes",
-                "synopsis": "..."
+                "status": "OFFERED",
+                "follow_ups": {"2022-11-08": "Emailed recruiter", "2022-11-20": "Second interview"}
             }
         }
@@ -0,0 +1,105 @@
+import base64
+import binascii
+import json
+from typing import Optional
+from fastapi import HTTPException, Response, status
+from fastapi.responses import StreamingResponse
+from pymongo import ASCENDING
+
+from serialization import passthrough_headers
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500  # documents fetched from Atlas per getMore while streaming
+
+# Pages are keyset-paginated: documents are ordered by the requested sort keys with "_id" as the final tie-breaker,
+# and the cursor handed to the client holds the sort key values of the last document of the page it received,
+# wrapped in url-safe base64 so clients treat it as opaque. The next page starts strictly after those values.
+
+
+def full_sort(sort: Optional[list[tuple[str, int]]]) -> list[tuple[str, int]]:
+    sort = list(sort or [])
+    if all(field != "_id" for field, _ in sort):
+        sort.append(("_id", ASCENDING))  # "_id" is unique, so the order (and hence the cursor) is never ambiguous
+    return sort
+
+
+def encode_cursor(doc: dict, sort: list[tuple[str, int]]) -> str:
+    values = [doc.get(field) for field, _ in sort]
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def decode_cursor(cursor: str, sort: list[tuple[str, int]]) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        values = None
+    if not isinstance(values, list) or len(values) != len(sort):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid cursor {cursor}")
+    return values
+
+
+def keyset_query(cursor: Optional[str], query: Optional[dict], sort: list[tuple[str, int]]) -> dict:
+    query = dict(query or {})
+    if not cursor:
+        return query
+    values = decode_cursor(cursor, sort)
+    # documents after (v1, v2, ...) are: k1 past v1, OR k1 == v1 and k2 past v2, OR ...
+    after = []
+    for i, (field, direction) in enumerate(sort):
+        clause = {prev_field: value for (prev_field, _), value in zip(sort[:i], values[:i])}
+        clause[field] = {"$gt" if direction == ASCENDING else "$lt": values[i]}
+        after.append(clause)
+    return {"$and": [query, {"$or": after}]} if query else {"$or": after}
+
+
+def with_sort_keys(projection: Optional[dict], sort: list[tuple[str, int]]) -> Optional[dict]:
+    # the cursor is built from the sort keys, so they have to come back even if the caller didn't ask for them
+    if projection is None:
+        return None
+    return {**projection, **{field: 1 for field, _ in sort}}
+
+
+async def fetch_page(collection, response: Response, limit: int, cursor: Optional[str] = None,
+                     query: Optional[dict] = None, sort: Optional[list[tuple[str, int]]] = None,
+                     projection: Optional[dict] = None) -> list[dict]:
+    """
+    Return one page of documents. If there are more documents after this page, the cursor for the next page is sent
+    back in the X-Next-Cursor header
+    """
+    sort = full_sort(sort)
+    # fetch one extra document so we know whether there is a next page without a separate count
+    docs = await collection.find(keyset_query(cursor, query, sort), with_sort_keys(projection, sort)) \
+        .sort(sort).limit(limit + 1).to_list(None)
+    if len(docs) > limit:
+        docs = docs[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(docs[-1], sort)
+    return docs
+
+
+def stream_ndjson(collection, cursor: Optional[str] = None, query: Optional[dict] = None,
+                  sort: Optional[list[tuple[str, int]]] = None, projection: Optional[dict] = None) -> StreamingResponse:
+    """
+    Stream every matching document as newline-delimited JSON, straight off the Mongo cursor
+    """
+    sort = full_sort(sort)
+
+    async def generate():
+        async for doc in collection.find(keyset_query(cursor, query, sort), projection,
+                                         batch_size=STREAM_BATCH_SIZE).sort(sort):
+            yield json.dumps(doc, default=str) + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+async def list_documents(collection, response: Response, limit: int, cursor: Optional[str], stream: bool,
+                         query: Optional[dict] = None, sort: Optional[list[tuple[str, int]]] = None,
+                         projection: Optional[dict] = None):
+    """
+    Shared body of the list endpoints: either one page of documents, or every matching document as NDJSON
+    """
+    if stream:
+        streamed = stream_ndjson(collection, cursor, query, sort, projection)
+        streamed.headers.update(passthrough_headers(response))  # e.g. the list's ETag
+        return streamed
+    return await fetch_page(collection, response, limit, cursor, query, sort, projection)
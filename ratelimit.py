@@ -0,0 +1,121 @@
+import math
+import time
+from collections import OrderedDict
+from typing import Optional
+from fastapi import status
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+
+from database import config, config_int
+
+# Per-client rate limiting, so one runaway client can't take every worker slot and pooled connection from the rest.
+# Clients are told apart by their API key header if it holds one of RATE_LIMIT_API_KEYS, or else their IP address.
+# Each client gets, per route prefix:
+#
+# - a token bucket: it holds up to `burst` tokens, refilled at `rate` per second, and each request takes one
+# - a cap of `concurrency` requests in flight at once
+#
+# Limits are set in .env as RATE_LIMITS="/cred=20,40,10;/mailbox=50,100,20;/=100,200,20" (prefix=rate,burst,
+# concurrency); the longest matching prefix applies, and paths matching none aren't limited. Requests over a limit are
+# refused with 429 before they reach a router.
+KEY_HEADER = (config.get("RATE_LIMIT_KEY_HEADER") or "X-API-Key").lower()
+API_KEYS = {key.strip() for key in (config.get("RATE_LIMIT_API_KEYS") or "").split(",") if key.strip()}
+MAX_CLIENTS = config_int("RATE_LIMIT_MAX_CLIENTS", 10000)  # buckets kept; the least recently used are dropped
+
+
+class Limit:
+    def __init__(self, rate: float, burst: int, concurrency: int):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+
+
+def parse_limits(setting: Optional[str]) -> dict[str, Limit]:
+    limits = {}
+    for rule in (setting or "").split(";"):
+        if not rule.strip():
+            continue
+        prefix, values = rule.split("=")
+        rate, burst, concurrency = values.split(",")
+        limits[prefix.strip()] = Limit(float(rate), int(burst), int(concurrency))
+    return limits
+
+
+class RateLimiter:
+    """
+    Token buckets and in-flight counts per (client, route prefix). Only clients seen recently are kept, at most
+    max_clients of them, so memory stays constant however many clients come and go. A dropped client starts again
+    with a full bucket, which is what it would have had after idling anyway.
+    """
+    def __init__(self, limits: dict[str, Limit], max_clients: int):
+        self.limits = limits
+        self.prefixes = sorted(limits, key=len, reverse=True)  # longest first
+        self.max_clients = max_clients
+        # (client, prefix) -> [tokens, time of last refill, requests in flight], least recently used first
+        self.buckets: OrderedDict[tuple[str, str], list] = OrderedDict()
+
+    def prefix_for(self, path: str) -> Optional[str]:
+        for prefix in self.prefixes:
+            if path.startswith(prefix):
+                return prefix
+        return None
+
+    def acquire(self, client: str, prefix: str) -> Optional[int]:
+        """
+        Take a token and an in-flight slot. Returns None if allowed, otherwise the seconds to wait before retrying
+        """
+        limit = self.limits[prefix]
+        now = time.monotonic()
+        key = (client, prefix)
+        if (bucket := self.buckets.get(key)) is None:
+            bucket = self.buckets[key] = [float(limit.burst), now, 0]
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+            bucket[1] = now
+        if bucket[2] >= limit.concurrency:
+            return 1
+        if bucket[0] < 1:
+            return math.ceil((1 - bucket[0]) / limit.rate) if limit.rate > 0 else 60
+        bucket[0] -= 1
+        bucket[2] += 1
+        return None
+
+    def release(self, client: str, prefix: str):
+        if (bucket := self.buckets.get((client, prefix))) is not None:
+            bucket[2] -= 1
+
+
+rate_limiter = RateLimiter(parse_limits(config.get("RATE_LIMITS")), MAX_CLIENTS)
+
+
+def client_key(scope) -> str:
+    # only keys we issued count, otherwise any client could get a fresh allowance by sending a new made-up key
+    if (api_key := Headers(scope=scope).get(KEY_HEADER)) in API_KEYS:
+        return f"key:{api_key}"
+    return f"ip:{scope['client'][0] if scope.get('client') else 'unknown'}"
+
+
+class LimitRequests:
+    """
+    Middleware applying rate_limiter. Plain ASGI, so a request holds its in-flight slot until the whole response body
+    has been sent, streamed responses (e.g. /cred/export) included. Cheap enough to run on every request: one dict
+    lookup and some arithmetic
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (prefix := rate_limiter.prefix_for(scope["path"])) is None:
+            return await self.app(scope, receive, send)
+        client = client_key(scope)
+        if (retry_after := rate_limiter.acquire(client, prefix)) is not None:
+            response = JSONResponse({"detail": "Too many requests"}, status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                    headers={"Retry-After": str(retry_after)})
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            rate_limiter.release(client, prefix)
@@ -0,0 +1,101 @@
+from typing import Optional
+from fastapi import HTTPException, status
+
+from cache import caches
+from database import config_int
+
+# Credential fields that refer to a document in another collection, by that document's "_id" or name
+CREDENTIAL_REFERENCES = {"country": "countries", "area": "areas", "email": "mailboxes"}
+MAX_BATCH_IDS = config_int("MAX_BATCH_IDS", 1000)  # most IDs/names one /batch request can ask for
+
+
+def parse_expand(expand: Optional[str]) -> list[str]:
+    """
+    expand is a comma separated list of reference fields to resolve, e.g. "country,area"
+    """
+    if not expand:
+        return []
+    fields = [field.strip() for field in expand.split(",") if field.strip()]
+    if unknown := [field for field in fields if field not in CREDENTIAL_REFERENCES]:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Cannot expand {unknown}, only {list(CREDENTIAL_REFERENCES)}")
+    return fields
+
+
+async def resolve(database, collection: str, keys: set[str]) -> dict[str, dict]:
+    """
+    Map each key (an "_id" or name) to the document it refers to in collection. Keys are looked up in the reference
+    cache first, and all the misses are fetched with a single $in query. Keys that don't exist are left out.
+    """
+    cache = caches[collection]
+    found = {}
+    missing = []
+    for key in keys:
+        if (doc := cache.get(key)) is not None:
+            found[key] = doc
+        else:
+            missing.append(key)
+    if missing:
+        query = {"$or": [{"_id": {"$in": missing}}, {cache.name_field: {"$in": missing}}]}
+        async for doc in database[collection].find(query):
+            cache.put(doc)
+            if doc.get(cache.name_field) in missing:
+                found.setdefault(doc[cache.name_field], doc)
+            if doc["_id"] in missing:
+                found[doc["_id"]] = doc  # a match on "_id" wins over a match on name
+    return found
+
+
+def parse_ids(ids: str) -> list[str]:
+    """
+    ids is a comma separated list of IDs (or names), e.g. "a,b,c". Repeats are dropped, keeping the first
+    """
+    keys = list(dict.fromkeys(key.strip() for key in ids.split(",") if key.strip()))
+    if not keys or len(keys) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"ids must list between 1 and {MAX_BATCH_IDS} IDs")
+    return keys
+
+
+def batch_result(keys: list[str], found: dict[str, dict]) -> dict:
+    # the documents in the order they were asked for, and the keys that matched nothing (see models.Batch)
+    return {"found": [found[key] for key in keys if key in found], "missing": [key for key in keys if key not in found]}
+
+
+async def resolve_all(database, creds: list[dict], fields) -> dict[str, dict[str, dict]]:
+    # field -> {referenced value -> document}, with one lookup per referenced collection for the whole batch
+    return {
+        field: await resolve(database, CREDENTIAL_REFERENCES[field],
+                             {cred[field] for cred in creds if cred.get(field)})
+        for field in fields
+    }
+
+
+async def expand_references(database, creds: list[dict], fields: list[str]):
+    """
+    Add an "expanded" dict to each credential holding the documents its reference fields point to (None if missing)
+    """
+    if not fields:
+        return
+    resolved = await resolve_all(database, creds, fields)
+    for cred in creds:
+        cred["expanded"] = {field: resolved[field].get(cred.get(field)) for field in fields}
+
+
+async def unknown_references(database, creds: list[dict]) -> list[list[str]]:
+    """
+    For each credential, list the reference fields whose value doesn't match any document in the referenced collection.
+    Only the reference fields present in each credential are checked, so this works for partial updates too.
+    """
+    fields = [field for field in CREDENTIAL_REFERENCES if any(cred.get(field) for cred in creds)]
+    resolved = await resolve_all(database, creds, fields)
+    return [
+        [f"{field} {cred[field]!r} not found in {CREDENTIAL_REFERENCES[field]}"
+         for field in fields if cred.get(field) and cred[field] not in resolved[field]]
+        for cred in creds
+    ]
+
+
+async def check_references(database, cred: dict):
+    if errors := (await unknown_references(database, [cred]))[0]:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=errors)
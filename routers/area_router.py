@@ -1,63 +1,103 @@
-from fastapi import APIRouter, Body, Request, Response, HTTPException, status
-from fastapi.encoders import jsonable_encoder
-from models import Area, AreaUpdate
+from typing import Optional
+from fastapi import APIRouter, Body, Query, Request, Response, HTTPException, status
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from models import Batch, Area, AreaUpdate, to_document, versioned
+from cache import caches
+from conditional import check_precondition, list_not_modified, match_condition, record_write, respond
+from database import find_by_id_or_name
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, list_documents
+from references import batch_result, parse_ids, resolve
+from serialization import serialize
 
 router = APIRouter()
+cache = caches["areas"]
 
 
 @router.post("/", response_description="Create a new area", status_code=status.HTTP_201_CREATED,
              response_model=Area)
-def create_area(request: Request, cred: Area = Body(...)):
-    cred = jsonable_encoder(cred)
-    new_cred = request.app.database["areas"].insert_one(cred)
-    created_cred = request.app.database["areas"].find_one(
-        {"_id": new_cred.inserted_id}
-    )
-    return created_cred
+async def create_area(request: Request, response: Response, cred: Area = Body(...)):
+    cred = to_document(cred)
+    try:
+        await request.app.database["areas"].insert_one(cred)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="Area with this ID or name already exists")
+    # cred already holds everything that was written (including the generated "_id"), so no need to re-read it
+    cache.put(cred)
+    record_write(response, "areas", cred["_id"], cred)
+    return cred
 
 
 @router.get("/", response_description="List all areas", response_model=list[Area])
-def list_area(request: Request):
-    creds = list(request.app.database["areas"].find(limit=100))
-    return creds
-
-
-@router.get("/{id/name}", response_description="Get a single area by ID/name", response_model=Area)
-def find_area(area_name: str, request: Request):
-    # search for a match with the key, "_id", first
-    if (cred := request.app.database["areas"].find_one({"_id": area_name})) is not None:
-        return cred
-    # else search for match by name
-    if (cred := request.app.database["areas"].find_one({"name": area_name})) is not None:
-        return cred
+async def list_area(request: Request, response: Response,
+                    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                    stream: bool = False):
+    if (unchanged := list_not_modified(request, response, "areas")) is not None:
+        return unchanged
+    creds = await list_documents(request.app.database["areas"], response, limit, cursor, stream)
+    return serialize(creds, Area, response)
+
+
+@router.get("/batch", response_description="Get several areas by ID/name at once",
+            response_model=Batch[Area])
+async def find_areas(request: Request, response: Response, ids: str = Query(...)):
+    """
+    Look up a comma separated list of IDs/names with at most one query (none if they are all cached). Results come
+    back in the order asked for, and the IDs/names that matched nothing are listed under "missing"
+    """
+    if (unchanged := list_not_modified(request, response, "areas")) is not None:
+        return unchanged
+    keys = parse_ids(ids)
+    return batch_result(keys, await resolve(request.app.database, "areas", set(keys)))
+
+
+@router.get("/{area_name}", response_description="Get a single area by ID/name", response_model=Area)
+async def find_area(area_name: str, request: Request, response: Response):
+    if (cred := cache.get(area_name)) is not None:
+        return respond(request, response, "areas", cred, Area)
+    # match on "_id" or name with one indexed query
+    if (cred := await find_by_id_or_name(request.app.database["areas"], area_name, "name")) is not None:
+        cache.put(cred)
+        return respond(request, response, "areas", cred, Area)
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Area with ID/name {area_name} not found")
 
 
 @router.put("/{id}", response_description="Update an area", response_model=Area)
-def update_area(id: str, request: Request, cred: AreaUpdate = Body(...)):
+async def update_area(id: str, request: Request, response: Response, cred: AreaUpdate = Body(...)):
+    condition = match_condition(request)  # If-Match
     cred = {k: v for k, v in cred.dict().items() if v is not None}
     if len(cred) >= 1:
-        update_result = request.app.database["areas"].update_one(
-            {"_id": id}, {"$set": cred}
-        )
-
-        if update_result.modified_count == 0:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Area with ID {id} not found")
-
-    if (
-        existing_cred := request.app.database["areas"].find_one({"_id": id})
-    ) is not None:
+        # apply the update and get the updated document back in the same round trip
+        try:
+            existing_cred = await request.app.database["areas"].find_one_and_update(
+                {"_id": id, **condition}, versioned({"$set": cred}), return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail="Area with this name already exists")
+    else:
+        existing_cred = await request.app.database["areas"].find_one({"_id": id, **condition})
+
+    if existing_cred is not None:
+        cache.put(existing_cred)
+        record_write(response, "areas", id, existing_cred)
         return existing_cred
 
+    await check_precondition(request.app.database["areas"], id, condition)
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Area with ID {id} not found")
 
 
 @router.delete("/{id}", response_description="Delete an area")
-def delete_area(id: str, request: Request, response: Response):
-    delete_result = request.app.database["areas"].delete_one({"_id": id})
+async def delete_area(id: str, request: Request, response: Response):
+    condition = match_condition(request)  # If-Match
+    delete_result = await request.app.database["areas"].delete_one({"_id": id, **condition})
 
+    cache.invalidate(id)
+    record_write(response, "areas", id)
     if delete_result.deleted_count == 1:
         response.status_code = status.HTTP_204_NO_CONTENT
         return response
 
+    await check_precondition(request.app.database["areas"], id, condition)
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Area with ID {id} not found")
@@ -1,67 +1,254 @@
-from fastapi import APIRouter, Body, Request, Response, HTTPException, status
-from fastapi.encoders import jsonable_encoder
-from models import Credential, CredentialUpdate
+from typing import Optional
+import orjson
+from fastapi import APIRouter, Body, Query, Request, Response, HTTPException, status
+from fastapi.responses import JSONResponse
+from pymongo import ReturnDocument
+from models import Batch, Credential, CredentialUpdate, ExpandedCredential, to_document, versioned
+from bulk import BULK_BATCH_SIZE, bulk_insert
+from cache import versions
+from conditional import (cached_not_modified, check_precondition, list_not_modified, match_condition, record_write,
+                         respond)
+from filters import build_filter, build_projection, build_sort, check_indexed
+from history import delete_with_history, history_enabled, list_revisions, rebuild_revision, update_with_history
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, list_documents, stream_ndjson
+from encryption import decrypt_fields, encrypt_fields
+from search import credential_index
+from write_behind import credential_queue
+from references import (CREDENTIAL_REFERENCES, batch_result, check_references, expand_references, parse_expand,
+                        parse_ids, unknown_references)
+from serialization import passthrough_headers, serialize
 
 # build REST API
 router = APIRouter()  # initialise APIRouter object from fastapi
 
 # request.app.database[X] corresponds to database creds_db.X (aka collection X) where X is some string
 
+CRED_FIELDS = {field.alias for field in Credential.__fields__.values()}  # stored field names, e.g. "_id"
+CRED_FILTER_FIELDS = {"area", "country", "email", "username", "login_override"}  # fields that can be filtered/sorted on
+
 
 @router.post("/", response_description="Create a new credential", status_code=status.HTTP_201_CREATED,
              response_model=Credential)
-def create_credential(request: Request, cred: Credential = Body(...)):
+async def create_credential(request: Request, response: Response, cred: Credential = Body(...)):
     """
     Create a new credential and add it to the database
     """
-    cred = jsonable_encoder(cred)
-    new_cred = request.app.database["creds"].insert_one(cred)
-    created_cred = request.app.database["creds"].find_one(
-        {"_id": new_cred.inserted_id}
-    )
+    doc = to_document(cred)  # password, security answers and personal details are encrypted here
+    await check_references(request.app.database, doc)  # country, area and email must exist
+    await request.app.database["creds"].insert_one(doc)
+    credential_index.add(doc)
+    record_write(response, "creds", doc["_id"], doc)
+
+    # doc already holds everything that was written (including the generated "_id"), so no need to re-read it
+    return decrypt_fields(doc)
+
+
+@router.get("/", response_description="List all credentials", response_model=list[ExpandedCredential],
+            response_model_exclude_none=True)
+async def list_credentials(request: Request, response: Response,
+                           limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                           stream: bool = False, area: Optional[str] = None, country: Optional[str] = None,
+                           email: Optional[str] = None, username: Optional[str] = None,
+                           login_override: Optional[str] = None, fields: Optional[str] = None,
+                           sort: Optional[str] = None, expand: Optional[str] = None, reveal: bool = False):
+    """
+    List credentials. They can be filtered on area, country, email, username and login_override (end a value with
+    "*" for a prefix match), trimmed to a comma separated list of fields, and sorted (e.g. sort=-country,username).
+    Filters and sorts that no index can serve are refused rather than scanning the collection. expand=country,area,email
+    adds the documents those fields refer to under "expanded". Passwords, security answers and personal details stay
+    encrypted unless reveal=true
+    """
+    query = build_filter({"area": area, "country": country, "email": email, "username": username,
+                          "login_override": login_override})
+    sort_keys = build_sort(sort, CRED_FILTER_FIELDS)
+    projection = build_projection(fields, CRED_FIELDS)
+    check_indexed("creds", query, sort_keys, response)
+    expand_fields = parse_expand(expand)
+    if expand_fields and stream:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="expand cannot be used with stream")
+    # expanded documents come from other collections, so the ETag has to change when those do too
+    collections = ["creds", *(CREDENTIAL_REFERENCES[field] for field in expand_fields)]
+    if (unchanged := list_not_modified(request, response, *collections)) is not None:
+        return unchanged
+
+    creds = await list_documents(request.app.database["creds"], response, limit, cursor, stream, query, sort_keys,
+                                 projection)
+    if not stream:
+        creds = [credential_queue.overlay(cred, projection) for cred in creds]
+        await expand_references(request.app.database, creds, expand_fields)
+        if reveal:
+            creds = [decrypt_fields(cred) for cred in creds]
+    if projection is None or stream:
+        return serialize(creds, ExpandedCredential, response, exclude_none=True)
+    # trimmed documents would fail validation against Credential, so send them as they are. orjson, unlike
+    # JSONResponse, encodes the datetimes (e.g. modified_at) of expanded documents
+    return Response(orjson.dumps(creds), media_type="application/json", headers=passthrough_headers(response))
+
+
+@router.post("/bulk", response_description="Import many credentials at once")
+async def bulk_import_credentials(request: Request, batch_size: int = Query(BULK_BATCH_SIZE, ge=1, le=10000)):
+    """
+    Import credentials sent either as NDJSON (Content-Type: application/x-ndjson, one credential per line) or as a
+    JSON array. Valid credentials are written with unordered insert_many calls of batch_size documents; invalid ones
+    are skipped and reported by their position in the body
+    """
+    result = await bulk_insert(request, request.app.database["creds"], Credential, batch_size,
+                               check_batch=lambda batch: unknown_references(request.app.database, batch),
+                               on_insert=credential_index.add_all)
+    versions["creds"].invalidate()
+    return result
+
+
+@router.get("/search", response_description="Search credentials", response_model=list[Credential])
+async def search_credentials(request: Request, response: Response, q: str = Query(..., min_length=1),
+                             limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE)):
+    """
+    Search credentials by the words in their username, email, area, country, personal detail names and, for job
+    hunting credentials, post name, job description and medium. Misspelt words still match similar words. Results
+    come from the in-memory search index, best match first
+    """
+    if (unchanged := list_not_modified(request, response, "creds")) is not None:
+        return unchanged
+    ids = credential_index.search(q, limit)
+    creds = await request.app.database["creds"].find({"_id": {"$in": ids}}).to_list(None)
+    creds = [credential_queue.overlay(cred) for cred in creds]
+    rank = {doc_id: i for i, doc_id in enumerate(ids)}
+    creds.sort(key=lambda cred: rank[cred["_id"]])
+    return serialize(creds, Credential, response)
 
-    return created_cred
 
+@router.post("/search/rebuild", response_description="Rebuild the search index from the database")
+async def rebuild_search_index(request: Request):
+    await credential_index.rebuild(request.app.database["creds"])
+    return credential_index.stats()
 
-@router.get("/", response_description="List all credentials", response_model=list[Credential])
-def list_credentials(request: Request):
-    creds = list(request.app.database["creds"].find(limit=100))
-    return creds
 
+@router.get("/export", response_description="Export all credentials as NDJSON")
+async def export_credentials(request: Request):
+    return stream_ndjson(request.app.database["creds"])
 
-@router.get("/{id}", response_description="Get a single credential by id", response_model=Credential)
-def find_credential(id: str, request: Request):
-    if (cred := request.app.database["creds"].find_one({"_id": id})) is not None:
-        return cred
+
+@router.get("/batch", response_description="Get several credentials by ID at once",
+            response_model=Batch[ExpandedCredential], response_model_exclude_none=True)
+async def find_credentials(request: Request, response: Response, ids: str = Query(...), expand: Optional[str] = None,
+                           reveal: bool = False):
+    """
+    Get a comma separated list of credentials with a single query, in the order asked for. IDs that matched nothing
+    are listed under "missing". expand works as for a single credential. As in listings, secrets stay encrypted
+    unless reveal=true
+    """
+    expand_fields = parse_expand(expand)
+    collections = ["creds", *(CREDENTIAL_REFERENCES[field] for field in expand_fields)]
+    if (unchanged := list_not_modified(request, response, *collections)) is not None:
+        return unchanged
+    keys = parse_ids(ids)
+    creds = await request.app.database["creds"].find({"_id": {"$in": keys}}).to_list(None)
+    creds = [credential_queue.overlay(cred) for cred in creds]
+    if reveal:
+        creds = [decrypt_fields(cred) for cred in creds]
+    await expand_references(request.app.database, creds, expand_fields)
+    return batch_result(keys, {cred["_id"]: cred for cred in creds})
+
+
+@router.get("/{id}", response_description="Get a single credential by id", response_model=ExpandedCredential,
+            response_model_exclude_none=True)
+async def find_credential(id: str, request: Request, response: Response, expand: Optional[str] = None):
+    """
+    Get a credential. Unless expand is used, it comes with an ETag, and If-None-Match is answered with 304 (without a
+    query if this process already knows the credential's current version)
+    """
+    expand_fields = parse_expand(expand)
+    if not expand_fields and (unchanged := cached_not_modified(request, "creds", id)) is not None:
+        return unchanged
+    if (cred := await request.app.database["creds"].find_one({"_id": id})) is not None:
+        cred = decrypt_fields(credential_queue.overlay(cred))
+        # while an update is pending, the stored revision (and so the ETag) doesn't describe what we send
+        if not expand_fields and id not in credential_queue.pending:
+            return respond(request, response, "creds", cred, ExpandedCredential, exclude_none=True)
+        await expand_references(request.app.database, [cred], expand_fields)
+        return serialize(cred, ExpandedCredential, response, exclude_none=True)
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Credential with ID {id} not found")
 
 
+@router.get("/{id}/history", response_description="List the recorded changes of a credential")
+async def credential_history(id: str, request: Request, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    """
+    List the updates and deletes of a credential, newest first: the revision each one produced (for a delete, the
+    revision deleted), when, and which fields it changed. Any of these revisions, and the one before the oldest, can
+    be fetched from /cred/{id}/history/{revision}
+    """
+    return await list_revisions(request.app.database, id, limit)
+
+
+@router.get("/{id}/history/{revision}", response_description="Get a past revision of a credential",
+            response_model=Credential)
+async def find_credential_revision(id: str, revision: int, request: Request):
+    """
+    Get a credential as it was at the given revision, rebuilt from its current version (or, if it has been deleted,
+    its last version) and the recorded changes since. Send it back with PUT to roll back to it
+    """
+    if (cred := await rebuild_revision(request.app.database, id, revision)) is not None:
+        return decrypt_fields(cred)
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                        detail=f"Revision {revision} of credential with ID {id} not found")
+
+
 @router.put("/{id}", response_description="Update a credential", response_model=Credential)
-def update_credential(id: str, request: Request, cred: CredentialUpdate = Body(...)):
+async def update_credential(id: str, request: Request, response: Response, cred: CredentialUpdate = Body(...)):
+    """
+    Update the given fields of a credential. With If-Match, only if it is still at that revision (412 otherwise).
+    In write-behind mode, unconditional updates are queued and answered with 202
+    """
+    condition = match_condition(request)
     cred = {k: v for k, v in cred.dict().items() if v is not None}  # get the credential to be updated
-    if len(cred) >= 1:
-        update_result = request.app.database["creds"].update_one(
-            {"_id": id}, {"$set": cred}
-        )
-
-        if update_result.modified_count == 0:  # failed to update
+    await check_references(request.app.database, cred)
+    cred = encrypt_fields(id, cred)
+    if cred and credential_queue.running and not condition:
+        # write-behind mode: acknowledged once it is in the journal, written to MongoDB with the next batch.
+        # If-Match has to see the stored revision, so conditional updates take the normal path below.
+        # The search index holds the ID of every credential, so checking that it exists needs no round trip
+        if id not in credential_index:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Credential with ID {id} not found")
+        await credential_queue.update(id, cred)
+        versions["creds"].invalidate(id)
+        return JSONResponse({"_id": id, "queued": sorted(cred)}, status_code=status.HTTP_202_ACCEPTED)
+    if credential_queue.running:
+        await credential_queue.settle(id)  # an update queued earlier must not be written over this one
+    if len(cred) >= 1 and history_enabled():
+        # the update and its history entry are written in one transaction
+        existing_cred = await update_with_history(request.app.database, id, condition, cred)
+    elif len(cred) >= 1:
+        # apply the update and get the updated document back in the same round trip
+        existing_cred = await request.app.database["creds"].find_one_and_update(
+            {"_id": id, **condition}, versioned({"$set": cred}), return_document=ReturnDocument.AFTER
+        )
+    else:
+        existing_cred = await request.app.database["creds"].find_one({"_id": id, **condition})
 
-    if (
-        existing_cred := request.app.database["creds"].find_one({"_id": id})
-    ) is not None:
-        return existing_cred  # return the updated credential
+    if existing_cred is not None:
+        credential_index.add(existing_cred)
+        record_write(response, "creds", id, existing_cred)
+        return decrypt_fields(existing_cred)  # return the updated credential
 
+    await check_precondition(request.app.database["creds"], id, condition)
     # if no credential to be updated OR existing credential is not found, raise exception
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Credential with ID {id} not found")
 
 
 @router.delete("/{id}", response_description="Delete a credential")
-def delete_credential(id: str, request: Request, response: Response):
-    delete_result = request.app.database["creds"].delete_one({"_id": id})
-
-    if delete_result.deleted_count == 1:
+async def delete_credential(id: str, request: Request, response: Response):
+    condition = match_condition(request)  # If-Match
+    if history_enabled():
+        deleted = await delete_with_history(request.app.database, id, condition)  # keeps a copy in the history
+    else:
+        deleted = (await request.app.database["creds"].delete_one({"_id": id, **condition})).deleted_count == 1
+    record_write(response, "creds", id)
+
+    if deleted:
+        credential_index.remove(id)
+        credential_queue.discard(id)
         response.status_code = status.HTTP_204_NO_CONTENT
         return response
 
+    await check_precondition(request.app.database["creds"], id, condition)
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Credential with ID {id} not found")
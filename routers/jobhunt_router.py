@@ -0,0 +1,257 @@
+from datetime import date, timedelta
+from typing import Optional
+from fastapi import APIRouter, Body, Query, Request, Response, HTTPException, status
+from pymongo import ReturnDocument
+from attachments import REFERENCE_PREFIX, delete, delete_all, download, owned_by, reference, upload
+from encryption import decrypt_fields, encrypt_fields
+from models import JobHuntCredential, JobHuntCredentialUpdate, to_document, versioned
+from cache import result_caches, versions
+from conditional import (cached_not_modified, check_precondition, list_not_modified, match_condition, record_write,
+                         respond)
+from filters import build_filter, build_sort, check_indexed
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, list_documents
+from references import check_references
+from search import jobhunt_index
+from serialization import serialize
+
+# Job applications live in their own collection, "jobhunt". The statistics endpoints run aggregation pipelines on the
+# server and cache the results until the next write to the collection.
+router = APIRouter()
+stats_cache = result_caches["jobhunt"]
+
+JOBHUNT_SORT_FIELDS = {"status", "apply_date", "medium"}
+OPEN_STATUSES = ["PENDING"]  # applications still waiting on a decision
+# job_description stays inline rather than becoming an attachment, so its words stay searchable
+ATTACHMENT_FIELDS = "^(application_details|follow_up_files)$"
+
+
+@router.post("/", response_description="Create a new job application", status_code=status.HTTP_201_CREATED,
+             response_model=JobHuntCredential)
+async def create_application(request: Request, response: Response, cred: JobHuntCredential = Body(...)):
+    doc = to_document(cred)  # secrets are encrypted here
+    await check_references(request.app.database, doc)
+    await request.app.database["jobhunt"].insert_one(doc)
+    stats_cache.invalidate()
+    jobhunt_index.add(doc)
+    record_write(response, "jobhunt", doc["_id"], doc)
+    return decrypt_fields(doc)
+
+
+@router.get("/", response_description="List job applications", response_model=list[JobHuntCredential])
+async def list_applications(request: Request, response: Response,
+                            limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                            stream: bool = False, status_filter: Optional[str] = Query(None, alias="status"),
+                            medium: Optional[str] = None, sort: Optional[str] = None, reveal: bool = False):
+    """
+    List job applications, optionally filtered by status and/or medium and sorted, e.g. status=PENDING&sort=-apply_date.
+    Passwords and security answers stay encrypted unless reveal=true
+    """
+    query = build_filter({"status": status_filter, "medium": medium})
+    sort_keys = build_sort(sort, JOBHUNT_SORT_FIELDS)
+    check_indexed("jobhunt", query, sort_keys, response)
+    if (unchanged := list_not_modified(request, response, "jobhunt")) is not None:
+        return unchanged
+    creds = await list_documents(request.app.database["jobhunt"], response, limit, cursor, stream, query, sort_keys)
+    if reveal and not stream:
+        creds = [decrypt_fields(cred) for cred in creds]
+    return serialize(creds, JobHuntCredential, response)
+
+
+@router.get("/search", response_description="Search job applications", response_model=list[JobHuntCredential])
+async def search_applications(request: Request, response: Response, q: str = Query(..., min_length=1),
+                              limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE)):
+    if (unchanged := list_not_modified(request, response, "jobhunt")) is not None:
+        return unchanged
+    ids = jobhunt_index.search(q, limit)
+    creds = await request.app.database["jobhunt"].find({"_id": {"$in": ids}}).to_list(None)
+    rank = {doc_id: i for i, doc_id in enumerate(ids)}
+    creds.sort(key=lambda cred: rank[cred["_id"]])
+    return serialize(creds, JobHuntCredential, response)
+
+
+async def cached_aggregate(request: Request, key: tuple, pipeline: list[dict]) -> list[dict]:
+    if (result := stats_cache.get(key)) is not None:
+        return result
+    cursor = await request.app.database["jobhunt"].aggregate(pipeline)
+    result = await cursor.to_list(None)
+    stats_cache.put(key, result)
+    return result
+
+
+@router.get("/stats/counts", response_description="Number of applications by status and by medium")
+async def application_counts(request: Request, response: Response):
+    if (unchanged := list_not_modified(request, response, "jobhunt")) is not None:
+        return unchanged
+    pipeline = [{"$facet": {
+        "by_status": [{"$group": {"_id": "$status", "count": {"$sum": 1}}}, {"$sort": {"count": -1}}],
+        "by_medium": [{"$group": {"_id": "$medium", "count": {"$sum": 1}}}, {"$sort": {"count": -1}}],
+    }}]
+    (result,) = await cached_aggregate(request, ("counts",), pipeline)
+    return {facet: {row["_id"]: row["count"] for row in rows} for facet, rows in result.items()}
+
+
+@router.get("/stats/salaries", response_description="Histogram of expected salaries")
+async def salary_histogram(request: Request, response: Response, bucket_size: int = Query(10000, ge=1)):
+    """
+    Count applications by the midpoint of their expected salary range, in buckets of bucket_size
+    """
+    if (unchanged := list_not_modified(request, response, "jobhunt")) is not None:
+        return unchanged
+    pipeline = [
+        {"$match": {"expected_salary": {"$type": "array"}}},
+        {"$group": {
+            "_id": {"$multiply": [{"$floor": {"$divide": [{"$avg": "$expected_salary"}, bucket_size]}}, bucket_size]},
+            "count": {"$sum": 1},
+        }},
+        {"$sort": {"_id": 1}},
+    ]
+    rows = await cached_aggregate(request, ("salaries", bucket_size), pipeline)
+    return [{"from": row["_id"], "to": row["_id"] + bucket_size, "count": row["count"]} for row in rows]
+
+
+@router.get("/stats/weekly", response_description="Number of applications per week")
+async def applications_per_week(request: Request, response: Response):
+    if (unchanged := list_not_modified(request, response, "jobhunt")) is not None:
+        return unchanged
+    pipeline = [
+        {"$project": {"applied": {"$dateFromString": {"dateString": "$apply_date", "onError": None, "onNull": None}}}},
+        {"$match": {"applied": {"$ne": None}}},
+        {"$group": {"_id": {"$dateTrunc": {"date": "$applied", "unit": "week", "startOfWeek": "monday"}},
+                    "count": {"$sum": 1}}},
+        {"$sort": {"_id": 1}},
+    ]
+    rows = await cached_aggregate(request, ("weekly",), pipeline)
+    return [{"week_of": row["_id"].date().isoformat(), "count": row["count"]} for row in rows]
+
+
+@router.get("/stats/stale", response_description="Open applications with no follow-up in the last N days")
+async def stale_applications(request: Request, response: Response, days: int = Query(14, ge=0)):
+    """
+    Open applications whose latest activity (the apply date or the latest follow-up, whichever is later) is more than
+    days ago. Dates are compared as YYYY-MM-DD strings
+    """
+    if (unchanged := list_not_modified(request, response, "jobhunt")) is not None:
+        return unchanged
+    cutoff = (date.today() - timedelta(days=days)).isoformat()
+    pipeline = [
+        {"$match": {"status": {"$in": OPEN_STATUSES}}},  # served by the (status, apply_date) index
+        {"$addFields": {"last_activity": {"$max": [
+            "$apply_date",
+            {"$max": {"$map": {"input": {"$objectToArray": {"$ifNull": ["$follow_ups", {}]}}, "in": "$$this.k"}}},
+        ]}}},
+        {"$match": {"last_activity": {"$lt": cutoff}}},
+        {"$sort": {"last_activity": 1}},
+        {"$project": {"post_name": 1, "username": 1, "status": 1, "apply_date": 1, "last_activity": 1}},
+    ]
+    return await cached_aggregate(request, ("stale", cutoff), pipeline)
+
+
+@router.get("/{id}", response_description="Get a single job application by id", response_model=JobHuntCredential)
+async def find_application(id: str, request: Request, response: Response):
+    if (unchanged := cached_not_modified(request, "jobhunt", id)) is not None:
+        return unchanged
+    if (cred := await request.app.database["jobhunt"].find_one({"_id": id})) is not None:
+        return respond(request, response, "jobhunt", decrypt_fields(cred), JobHuntCredential)
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job application with ID {id} not found")
+
+
+@router.put("/{id}", response_description="Update a job application", response_model=JobHuntCredential)
+async def update_application(id: str, request: Request, response: Response, cred: JobHuntCredentialUpdate = Body(...)):
+    condition = match_condition(request)  # If-Match
+    cred = {k: v for k, v in cred.dict().items() if v is not None}
+    await check_references(request.app.database, cred)
+    cred = encrypt_fields(id, cred)
+    if len(cred) >= 1:
+        existing_cred = await request.app.database["jobhunt"].find_one_and_update(
+            {"_id": id, **condition}, versioned({"$set": cred}), return_document=ReturnDocument.AFTER
+        )
+        stats_cache.invalidate()
+    else:
+        existing_cred = await request.app.database["jobhunt"].find_one({"_id": id, **condition})
+
+    if existing_cred is not None:
+        jobhunt_index.add(existing_cred)
+        record_write(response, "jobhunt", id, existing_cred)
+        return decrypt_fields(existing_cred)
+
+    await check_precondition(request.app.database["jobhunt"], id, condition)
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job application with ID {id} not found")
+
+
+@router.delete("/{id}", response_description="Delete a job application")
+async def delete_application(id: str, request: Request, response: Response):
+    condition = match_condition(request)  # If-Match
+    delete_result = await request.app.database["jobhunt"].delete_one({"_id": id, **condition})
+    stats_cache.invalidate()
+    record_write(response, "jobhunt", id)
+
+    if delete_result.deleted_count == 1:
+        jobhunt_index.remove(id)
+        await delete_all(request.app.database, id)  # the application's attachments in GridFS
+        response.status_code = status.HTTP_204_NO_CONTENT
+        return response
+
+    await check_precondition(request.app.database["jobhunt"], id, condition)
+
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job application with ID {id} not found")
+
+
+@router.post("/{id}/attachments", response_description="Upload an attachment to a job application",
+             status_code=status.HTTP_201_CREATED)
+async def upload_attachment(id: str, request: Request, field: str = Query(..., regex=ATTACHMENT_FIELDS),
+                            filename: str = Query(...), key: Optional[str] = Query(None, regex=r"^[\w-]+$")):
+    """
+    Stream the request body into GridFS and store a reference to it on the application: appended to
+    application_details, or saved as follow_up_files[key] (key being the follow-up date). A file previously referenced
+    from the same follow_up_files key is deleted
+    """
+    if field == "follow_up_files" and key is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="key is required for follow_up_files")
+    # checked before the upload, so a missing application doesn't cost a whole upload (checked again below, in case
+    # it is deleted meanwhile)
+    if await request.app.database["jobhunt"].find_one({"_id": id}, {"_id": 1}) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job application with ID {id} not found")
+    file_id = await upload(request, id, filename)
+    ref = reference(file_id)
+    update = versioned({"$push": {field: ref}} if field == "application_details"
+                       else {"$set": {f"follow_up_files.{key}": ref}})
+
+    previous = await request.app.database["jobhunt"].find_one_and_update(
+        {"_id": id}, update, projection={"follow_up_files": 1}, return_document=ReturnDocument.BEFORE
+    )
+    if previous is None:
+        await delete(request.app.database, file_id)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job application with ID {id} not found")
+    versions["jobhunt"].invalidate(id)
+    replaced = (previous.get("follow_up_files") or {}).get(key) if field == "follow_up_files" else None
+    if isinstance(replaced, str) and replaced.startswith(REFERENCE_PREFIX):
+        await delete(request.app.database, replaced[len(REFERENCE_PREFIX):])
+    return {"_id": file_id, "reference": ref}
+
+
+@router.get("/{id}/attachments/{file_id}", response_description="Download an attachment (supports Range requests)")
+async def download_attachment(id: str, file_id: str, request: Request):
+    return await download(request, id, file_id)
+
+
+@router.delete("/{id}/attachments/{file_id}", response_description="Delete an attachment")
+async def delete_attachment(id: str, file_id: str, request: Request, response: Response):
+    ref = reference(file_id)
+    cred = await request.app.database["jobhunt"].find_one({"_id": id}, {"follow_up_files": 1, "job_description": 1})
+    if cred is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job application with ID {id} not found")
+    if not await owned_by(request.app.database, id, file_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Attachment with ID {file_id} not found")
+    # remove the reference wherever it is used
+    update = {"$pull": {"application_details": ref}}
+    if unset := {f"follow_up_files.{k}": "" for k, v in (cred.get("follow_up_files") or {}).items() if v == ref}:
+        update["$unset"] = unset
+    if cred.get("job_description") == ref:  # from before descriptions were kept inline
+        update["$set"] = {"job_description": ""}
+    await request.app.database["jobhunt"].update_one({"_id": id}, versioned(update))
+    versions["jobhunt"].invalidate(id)
+    if "$set" in update:
+        await jobhunt_index.refresh(request.app.database["jobhunt"], [id])
+    await delete(request.app.database, file_id)
+    response.status_code = status.HTTP_204_NO_CONTENT
+    return response
@@ -1,62 +1,104 @@
-from fastapi import APIRouter, Body, Request, Response, HTTPException, status
-from fastapi.encoders import jsonable_encoder
-from models import Mailbox, MailboxUpdate
+from typing import Optional
+from fastapi import APIRouter, Body, Query, Request, Response, HTTPException, status
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from models import Batch, Mailbox, MailboxUpdate, to_document, versioned
+from cache import caches
+from conditional import check_precondition, list_not_modified, match_condition, record_write, respond
+from database import find_by_id_or_name
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, list_documents
+from references import batch_result, parse_ids, resolve
+from serialization import serialize
 
 router = APIRouter()
+cache = caches["mailboxes"]
 
 
 @router.post("/", response_description="Create a new mailbox", status_code=status.HTTP_201_CREATED,
              response_model=Mailbox)
-def create_mailbox(request: Request, cred: Mailbox = Body(...)):
-    cred = jsonable_encoder(cred)
-    new_cred = request.app.database["mailboxes"].insert_one(cred)
-    created_cred = request.app.database["mailboxes"].find_one(
-        {"_id": new_cred.inserted_id}
-    )
-    return created_cred
+async def create_mailbox(request: Request, response: Response, cred: Mailbox = Body(...)):
+    cred = to_document(cred)
+    try:
+        await request.app.database["mailboxes"].insert_one(cred)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="Mailbox with this ID or address already exists")
+    # cred already holds everything that was written (including the generated "_id"), so no need to re-read it
+    cache.put(cred)
+    record_write(response, "mailboxes", cred["_id"], cred)
+    return cred
 
 
 @router.get("/", response_description="List all mailboxes", response_model=list[Mailbox])
-def list_mailboxes(request: Request):
-    creds = list(request.app.database["mailboxes"].find(limit=100))
-    return creds
-
-
-@router.get("/{id/address}", response_description="Get a single mailbox by ID or that mailbox's address",
+async def list_mailboxes(request: Request, response: Response,
+                         limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                         stream: bool = False):
+    if (unchanged := list_not_modified(request, response, "mailboxes")) is not None:
+        return unchanged
+    creds = await list_documents(request.app.database["mailboxes"], response, limit, cursor, stream)
+    return serialize(creds, Mailbox, response)
+
+
+@router.get("/batch", response_description="Get several mailboxes by ID/address at once",
+            response_model=Batch[Mailbox])
+async def find_mailboxes(request: Request, response: Response, ids: str = Query(...)):
+    """
+    Look up a comma separated list of IDs/addresses with at most one query (none if they are all cached). Results come
+    back in the order asked for, and the IDs/addresses that matched nothing are listed under "missing"
+    """
+    if (unchanged := list_not_modified(request, response, "mailboxes")) is not None:
+        return unchanged
+    keys = parse_ids(ids)
+    return batch_result(keys, await resolve(request.app.database, "mailboxes", set(keys)))
+
+
+@router.get("/{mailbox}", response_description="Get a single mailbox by ID or that mailbox's address",
             response_model=Mailbox)
-def find_mailbox(mailbox: str, request: Request):
-    if (cred := request.app.database["mailboxes"].find_one({"_id": mailbox})) is not None:
-        return cred
-    if (cred := request.app.database["mailboxes"].find_one({"address": mailbox})) is not None:
-        return cred
+async def find_mailbox(mailbox: str, request: Request, response: Response):
+    if (cred := cache.get(mailbox)) is not None:
+        return respond(request, response, "mailboxes", cred, Mailbox)
+    # match on "_id" or address with one indexed query
+    if (cred := await find_by_id_or_name(request.app.database["mailboxes"], mailbox, "address")) is not None:
+        cache.put(cred)
+        return respond(request, response, "mailboxes", cred, Mailbox)
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Mailbox with ID/name {mailbox} not found")
 
 
 @router.put("/{id}", response_description="Update a mailbox", response_model=Mailbox)
-def update_mailbox(id: str, request: Request, cred: MailboxUpdate = Body(...)):
+async def update_mailbox(id: str, request: Request, response: Response, cred: MailboxUpdate = Body(...)):
+    condition = match_condition(request)  # If-Match
     cred = {k: v for k, v in cred.dict().items() if v is not None}
     if len(cred) >= 1:
-        update_result = request.app.database["mailboxes"].update_one(
-            {"_id": id}, {"$set": cred}
-        )
-
-        if update_result.modified_count == 0:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Mailbox with ID {id} not found")
-
-    if (
-        existing_cred := request.app.database["mailboxes"].find_one({"_id": id})
-    ) is not None:
+        # apply the update and get the updated document back in the same round trip
+        try:
+            existing_cred = await request.app.database["mailboxes"].find_one_and_update(
+                {"_id": id, **condition}, versioned({"$set": cred}), return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail="Mailbox with this address already exists")
+    else:
+        existing_cred = await request.app.database["mailboxes"].find_one({"_id": id, **condition})
+
+    if existing_cred is not None:
+        cache.put(existing_cred)
+        record_write(response, "mailboxes", id, existing_cred)
         return existing_cred
 
+    await check_precondition(request.app.database["mailboxes"], id, condition)
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Mailbox with ID {id} not found")
 
 
 @router.delete("/{id}", response_description="Delete a mailbox")
-def delete_mailbox(id: str, request: Request, response: Response):
-    delete_result = request.app.database["mailboxes"].delete_one({"_id": id})
+async def delete_mailbox(id: str, request: Request, response: Response):
+    condition = match_condition(request)  # If-Match
+    delete_result = await request.app.database["mailboxes"].delete_one({"_id": id, **condition})
 
+    cache.invalidate(id)
+    record_write(response, "mailboxes", id)
     if delete_result.deleted_count == 1:
         response.status_code = status.HTTP_204_NO_CONTENT
         return response
 
+    await check_precondition(request.app.database["mailboxes"], id, condition)
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Mailbox with ID {id} not found")
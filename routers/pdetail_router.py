@@ -1,64 +1,107 @@
-from fastapi import APIRouter, Body, Request, Response, HTTPException, status
-from fastapi.encoders import jsonable_encoder
-from models import PersonalDetails, PersonalDetailsUpdate
+from typing import Optional
+from fastapi import APIRouter, Body, Query, Request, Response, HTTPException, status
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from models import Batch, PersonalDetails, PersonalDetailsUpdate, to_document, versioned
+from cache import caches
+from conditional import check_precondition, list_not_modified, match_condition, record_write, respond
+from database import find_by_id_or_name
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, list_documents
+from references import batch_result, parse_ids, resolve
+from serialization import serialize
 
 router = APIRouter()
+cache = caches["personal_detail_type"]
 
 
 @router.post("/", response_description="Create a new personal detail types", status_code=status.HTTP_201_CREATED,
              response_model=PersonalDetails)
-def create_pdetail(request: Request, cred: PersonalDetails = Body(...)):
-    cred = jsonable_encoder(cred)
-    new_cred = request.app.database["personal_detail_type"].insert_one(cred)
-    created_cred = request.app.database["personal_detail_type"].find_one(
-        {"_id": new_cred.inserted_id}
-    )
-    return created_cred
+async def create_pdetail(request: Request, response: Response, cred: PersonalDetails = Body(...)):
+    cred = to_document(cred)
+    try:
+        await request.app.database["personal_detail_type"].insert_one(cred)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="Personal detail type with this ID or detail already exists")
+    # cred already holds everything that was written (including the generated "_id"), so no need to re-read it
+    cache.put(cred)
+    record_write(response, "personal_detail_type", cred["_id"], cred)
+    return cred
 
 
 @router.get("/", response_description="List all personal detail types", response_model=list[PersonalDetails])
-def list_pdetails(request: Request):
-    creds = list(request.app.database["personal_detail_type"].find(limit=100))
-    return creds
-
-
-@router.get("/{id/name}", response_description="Get a single personal detail type by id",
+async def list_pdetails(request: Request, response: Response,
+                        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: Optional[str] = None,
+                        stream: bool = False):
+    if (unchanged := list_not_modified(request, response, "personal_detail_type")) is not None:
+        return unchanged
+    creds = await list_documents(request.app.database["personal_detail_type"], response, limit, cursor, stream)
+    return serialize(creds, PersonalDetails, response)
+
+
+@router.get("/batch", response_description="Get several personal detail types by ID/detail at once",
+            response_model=Batch[PersonalDetails])
+async def find_pdetails(request: Request, response: Response, ids: str = Query(...)):
+    """
+    Look up a comma separated list of IDs/details with at most one query (none if they are all cached). Results come
+    back in the order asked for, and the IDs/details that matched nothing are listed under "missing"
+    """
+    if (unchanged := list_not_modified(request, response, "personal_detail_type")) is not None:
+        return unchanged
+    keys = parse_ids(ids)
+    return batch_result(keys, await resolve(request.app.database, "personal_detail_type", set(keys)))
+
+
+@router.get("/{pdetail_type_name}", response_description="Get a single personal detail type by id",
             response_model=PersonalDetails)
-def find_pdetail(pdetail_type_name: str, request: Request):
-    if (cred := request.app.database["personal_detail_type"].find_one({"_id": pdetail_type_name})) is not None:
-        return cred
-    if (cred := request.app.database["personal_detail_type"].find_one({"detail": pdetail_type_name})) is not None:
-        return cred
+async def find_pdetail(pdetail_type_name: str, request: Request, response: Response):
+    if (cred := cache.get(pdetail_type_name)) is not None:
+        return respond(request, response, "personal_detail_type", cred, PersonalDetails)
+    # match on "_id" or detail with one indexed query
+    if (
+        cred := await find_by_id_or_name(request.app.database["personal_detail_type"], pdetail_type_name, "detail")
+    ) is not None:
+        cache.put(cred)
+        return respond(request, response, "personal_detail_type", cred, PersonalDetails)
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                         detail=f"Personal detail type with ID/name {pdetail_type_name} not found")
 
 
 @router.put("/{id}", response_description="Update a personal detail type", response_model=PersonalDetails)
-def update_pdetail(id: str, request: Request, cred: PersonalDetailsUpdate = Body(...)):
+async def update_pdetail(id: str, request: Request, response: Response, cred: PersonalDetailsUpdate = Body(...)):
+    condition = match_condition(request)  # If-Match
     cred = {k: v for k, v in cred.dict().items() if v is not None}
     if len(cred) >= 1:
-        update_result = request.app.database["personal_detail_type"].update_one(
-            {"_id": id}, {"$set": cred}
-        )
-
-        if update_result.modified_count == 0:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                detail=f"Personal detail type with ID {id} not found")
-
-    if (
-        existing_cred := request.app.database["personal_detail_type"].find_one({"_id": id})
-    ) is not None:
+        # apply the update and get the updated document back in the same round trip
+        try:
+            existing_cred = await request.app.database["personal_detail_type"].find_one_and_update(
+                {"_id": id, **condition}, versioned({"$set": cred}), return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail="Personal detail type with this detail already exists")
+    else:
+        existing_cred = await request.app.database["personal_detail_type"].find_one({"_id": id, **condition})
+
+    if existing_cred is not None:
+        cache.put(existing_cred)
+        record_write(response, "personal_detail_type", id, existing_cred)
         return existing_cred
 
+    await check_precondition(request.app.database["personal_detail_type"], id, condition)
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Personal detail type with ID {id} not found")
 
 
 @router.delete("/{id}", response_description="Delete a personal detail type")
-def delete_pdetail(id: str, request: Request, response: Response):
-    delete_result = request.app.database["personal_detail_type"].delete_one({"_id": id})
+async def delete_pdetail(id: str, request: Request, response: Response):
+    condition = match_condition(request)  # If-Match
+    delete_result = await request.app.database["personal_detail_type"].delete_one({"_id": id, **condition})
 
+    cache.invalidate(id)
+    record_write(response, "personal_detail_type", id)
     if delete_result.deleted_count == 1:
         response.status_code = status.HTTP_204_NO_CONTENT
         return response
 
+    await check_precondition(request.app.database["personal_detail_type"], id, condition)
     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Personal detail type with ID {id} not found")
@@ -0,0 +1,146 @@
+import re
+from collections import defaultdict
+
+# Fields of a credential that are searchable. Only the keys of personal_details are indexed, never the values, and
+# the password and security answers are left out entirely. The last three only exist on job hunting credentials.
+SEARCH_FIELDS = ("username", "email", "area", "country", "personal_details", "post_name", "job_description", "medium")
+MIN_SIMILARITY = 0.3  # trigram similarity a word needs to count as a (misspelt) match for a query word
+MAX_FUZZY_MATCHES = 20  # at most this many similar words are tried for each misspelt query word
+
+
+def words(text: str) -> set[str]:
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def trigrams(word: str) -> set[str]:
+    padded = f"  {word} "  # padding so short words and word starts still produce trigrams
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    """
+    In-memory inverted index from words to document IDs. Query words that aren't in the index at all are matched to
+    similar indexed words through a second index from trigrams to words, so small typos still find results.
+    """
+    def __init__(self, fields: tuple[str, ...]):
+        self.fields = fields
+        self.postings: dict[str, set[str]] = defaultdict(set)  # word -> IDs of documents containing it
+        self.word_trigrams: dict[str, set[str]] = defaultdict(set)  # trigram -> words containing it
+        self.doc_words: dict[str, set[str]] = {}  # document ID -> its words, so it can be removed again
+        self.changes: list[list] = []  # one per rebuild running: the adds and removes made while it reads
+
+    def words_of(self, doc: dict) -> set[str]:
+        found = set()
+        for field in self.fields:
+            value = doc.get(field)
+            if isinstance(value, dict):
+                value = " ".join(value)  # keys only
+            if isinstance(value, str):
+                found |= words(value)
+        return found
+
+    def add(self, doc: dict):
+        """
+        Index a new document, or re-index one that changed
+        """
+        for changes in self.changes:
+            changes.append(doc)
+        self.unindex(doc["_id"])
+        doc_words = self.words_of(doc)
+        self.doc_words[doc["_id"]] = doc_words
+        for word in doc_words:
+            if word not in self.postings:
+                for trigram in trigrams(word):
+                    self.word_trigrams[trigram].add(word)
+            self.postings[word].add(doc["_id"])
+
+    def add_all(self, docs: list[dict]):
+        for doc in docs:
+            self.add(doc)
+
+    def remove(self, doc_id: str):
+        for changes in self.changes:
+            changes.append(doc_id)
+        self.unindex(doc_id)
+
+    def unindex(self, doc_id: str):
+        for word in self.doc_words.pop(doc_id, ()):
+            self.postings[word].discard(doc_id)
+            if not self.postings[word]:  # last document with this word, so forget the word too
+                del self.postings[word]
+                for trigram in trigrams(word):
+                    self.word_trigrams[trigram].discard(word)
+                    if not self.word_trigrams[trigram]:
+                        del self.word_trigrams[trigram]
+
+    def similar_words(self, word: str) -> list[tuple[str, float]]:
+        query_trigrams = trigrams(word)
+        shared = defaultdict(int)
+        for trigram in query_trigrams:
+            for candidate in self.word_trigrams.get(trigram, ()):
+                shared[candidate] += 1
+        scored = []
+        for candidate, count in shared.items():
+            similarity = count / (len(query_trigrams) + len(trigrams(candidate)) - count)  # Jaccard similarity
+            if similarity >= MIN_SIMILARITY:
+                scored.append((candidate, similarity))
+        scored.sort(key=lambda match: match[1], reverse=True)
+        return scored[:MAX_FUZZY_MATCHES]
+
+    def search(self, query: str, limit: int) -> list[str]:
+        """
+        Return up to limit document IDs, best first. Each query word adds 1 to the score of the documents containing
+        it, or its similarity to the closest misspelling a document contains
+        """
+        scores = defaultdict(float)
+        for word in words(query):
+            matches = [(word, 1.0)] if word in self.postings else self.similar_words(word)
+            best = {}
+            for match, similarity in matches:
+                for doc_id in self.postings[match]:
+                    best[doc_id] = max(best.get(doc_id, 0.0), similarity)
+            for doc_id, similarity in best.items():
+                scores[doc_id] += similarity
+        return sorted(scores, key=scores.get, reverse=True)[:limit]
+
+    async def rebuild(self, collection):
+        """
+        Index the whole collection again. The new index is built on the side and swapped in once the scan is done, so
+        searches keep using the old one meanwhile. Documents added or removed during the scan may have been read
+        before the change, so those changes are applied to the new index again before the swap
+        """
+        fresh = SearchIndex(self.fields)
+        changes = []
+        self.changes.append(changes)
+        try:
+            projection = {field: 1 for field in self.fields}
+            async for doc in collection.find({}, projection, batch_size=1000):
+                fresh.add(doc)
+        finally:
+            self.changes = [other for other in self.changes if other is not changes]
+        for change in changes:
+            if isinstance(change, dict):
+                fresh.add(change)
+            else:
+                fresh.remove(change)
+        self.postings, self.word_trigrams, self.doc_words = fresh.postings, fresh.word_trigrams, fresh.doc_words
+
+    async def refresh(self, collection, ids: list[str]):
+        """
+        Re-index the given documents from the database, e.g. after they were updated in bulk
+        """
+        projection = {field: 1 for field in self.fields}
+        async for doc in collection.find({"_id": {"$in": ids}}, projection):
+            self.add(doc)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.doc_words
+
+    def stats(self) -> dict:
+        return {"documents": len(self.doc_words), "words": len(self.postings)}
+
+
+credential_index = SearchIndex(SEARCH_FIELDS)
+jobhunt_index = SearchIndex(SEARCH_FIELDS)
+# search index of each collection, keyed by collection name
+SEARCH_INDEXES = {"creds": credential_index, "jobhunt": jobhunt_index}
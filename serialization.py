@@ -0,0 +1,59 @@
+from typing import Union
+import orjson
+from fastapi import Response
+from pydantic import BaseModel
+
+from database import config_bool
+from models import SCHEMA_VERSION
+
+# Opt-in fast path for read endpoints. Normally FastAPI validates every document we return against the route's
+# response_model and re-encodes it with jsonable_encoder, which is where most of the CPU time of a list endpoint goes.
+# Documents stamped with the current SCHEMA_VERSION were validated when they were written, so with this enabled they
+# are only trimmed to the model's fields and encoded straight to JSON bytes with orjson instead, giving the same body.
+# Older, unstamped documents still go through the model.
+FAST_SERIALIZATION = config_bool("FAST_SERIALIZATION")
+
+
+def passthrough_headers(response: Response) -> dict:
+    # our own headers (X-Next-Cursor, ETag etc.) set on the injected response, to copy onto a response we build
+    return {k: v for k, v in response.headers.items() if k.startswith("x-") or k in ("etag", "last-modified")}
+
+
+def shaped(doc: dict, model: type[BaseModel], exclude_none: bool) -> dict:
+    """
+    A valid document as the normal path would send it: only the model's fields (by alias), in the model's order, with
+    defaults for missing ones, and nested models shaped the same way. Stored fields the models don't declare
+    (schema_version, revision, modified_at) are left out
+    """
+    result = {}
+    for field in model.__fields__.values():
+        value = doc[field.alias] if field.alias in doc else field.get_default()
+        if isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+            if isinstance(value, dict):
+                value = shaped(value, field.type_, exclude_none)
+            elif isinstance(value, list):
+                value = [shaped(item, field.type_, exclude_none) if isinstance(item, dict) else item for item in value]
+        if value is not None or not exclude_none:
+            result[field.alias] = value
+    return result
+
+
+def trusted(doc: dict, model: type[BaseModel], exclude_none: bool = False) -> dict:
+    if doc.get("schema_version") == SCHEMA_VERSION:
+        return shaped(doc, model, exclude_none)
+    return model.validate(doc).dict(by_alias=True, exclude_none=exclude_none)
+
+
+def serialize(content: Union[dict, list[dict]], model: type[BaseModel], response: Response,
+              exclude_none: bool = False):
+    """
+    Return content unchanged for FastAPI to validate and encode as usual, or, in fast mode, an already-encoded response
+    with the same body. Pass the route's response_model_exclude_none as exclude_none
+    """
+    if not FAST_SERIALIZATION or isinstance(content, Response):  # e.g. a StreamingResponse
+        return content
+    if isinstance(content, list):
+        content = [trusted(doc, model, exclude_none) for doc in content]
+    else:
+        content = trusted(content, model, exclude_none)
+    return Response(orjson.dumps(content), media_type="application/json", headers=passthrough_headers(response))
@@ -0,0 +1,21 @@
+"""
+Production entry point: runs the app in WORKERS processes (default: one per CPU core) behind one port.
+
+    python serve.py
+
+Each worker is a separate process with its own MongoDB client, connection pool, caches and search indexes, all set up
+by the lifespan handler in main.py once the worker has started. The same app can be run under gunicorn instead,
+which also takes the number of workers from WEB_CONCURRENCY:
+
+    WEB_CONCURRENCY=4 gunicorn main:app --worker-class uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000
+"""
+import os
+import uvicorn
+
+from database import config, config_int
+
+if __name__ == "__main__":
+    workers = config_int("WORKERS", os.cpu_count() or 1)
+    os.environ["WEB_CONCURRENCY"] = str(workers)  # inherited by the workers, see cache.change_stream_enabled
+    uvicorn.run("main:app", host=config.get("HOST") or "127.0.0.1", port=config_int("PORT", 8000), workers=workers,
+                proxy_headers=True, log_level="info")
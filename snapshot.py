@@ -0,0 +1,555 @@
+import asyncio
+import bisect
+import fcntl
+import mmap
+import os
+import re
+import time
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Iterator, Optional
+import bson
+import orjson
+from bson import json_util
+from fastapi import Request, status
+from fastapi.responses import JSONResponse
+from starlette.datastructures import MutableHeaders
+from pymongo.errors import ConnectionFailure, OperationFailure
+
+from database import config, config_bool, config_int
+
+# Offline mode. With SNAPSHOT=true, one worker at a time keeps a copy of every collection the routers serve in
+# SNAPSHOT_DIR, and when Atlas can't be reached, GET requests are answered from that copy instead of failing:
+#
+# - Each collection is one file of BSON documents back to back ("<collection>-<generation>.bson"). manifest.json holds,
+#   per collection, the file name, how much of it is valid and an index from "_id" to (offset, length), plus the
+#   change stream resume token the snapshot is up to date with. The manifest is replaced atomically, so readers
+#   always see a consistent snapshot.
+# - The first snapshot is a full dump. After that, every SNAPSHOT_INTERVAL_SECONDS, changes are read from the change
+#   stream from the resume token on and appended to the files; the index then points at the new copy. Files are
+#   rewritten once more than half of them is dead copies.
+# - Offline, the routers run unchanged, with request.app.database swapped for a read-only view of the memory-mapped
+#   files. Lookups by "_id" go through the index, and pages sorted on "_id" read only as far as they need to; other
+#   sorts scan the collection. Anything the view can't do (aggregations, writes, attachments) is answered with 503.
+#
+# A request that fails because Atlas is unreachable switches the worker to offline mode for OFFLINE_RETRY_SECONDS,
+# after which Atlas is tried again.
+SNAPSHOT = config_bool("SNAPSHOT")
+SNAPSHOT_DIR = config.get("SNAPSHOT_DIR") or "snapshot"
+SNAPSHOT_INTERVAL = config_int("SNAPSHOT_INTERVAL_SECONDS", 60)
+OFFLINE_RETRY = config_int("OFFLINE_RETRY_SECONDS", 30)
+SNAPSHOT_COLLECTIONS = ("creds", "countries", "areas", "mailboxes", "personal_detail_type", "jobhunt")
+MAX_CHANGES = 100000  # changes applied per refresh, so a busy stream can't hold off the manifest being written
+MANIFEST = "manifest.json"
+UNREACHABLE_HEADER = "X-MongoDB-Unreachable"
+
+
+def snapshot_enabled() -> bool:
+    return SNAPSHOT
+
+
+class OfflineUnsupported(Exception):
+    pass
+
+
+# writing
+
+def read_manifest(directory: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(directory, MANIFEST), "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(directory: str, manifest: dict):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".tmp", "wb") as f:
+        f.write(orjson.dumps(manifest))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def remove_unused_files(directory: str, manifest: dict):
+    # readers that still have an old file mapped keep it readable until they let go of it
+    in_use = {entry["file"] for entry in manifest["collections"].values()}
+    for name in os.listdir(directory):
+        if name.endswith(".bson") and name not in in_use:
+            os.remove(os.path.join(directory, name))
+
+
+class SnapshotFile:
+    """
+    Appends documents to one collection's data file, keeping its entry in the manifest up to date
+    """
+    def __init__(self, directory: str, entry: dict):
+        self.entry = entry
+        self.file = open(os.path.join(directory, entry["file"]), "ab", opener=private)
+        self.file.truncate(entry["size"])  # drop anything a crashed refresh appended but never put in the manifest
+        self.file.seek(entry["size"])
+
+    def put(self, doc: dict):
+        data = bson.encode(doc)
+        if (old := self.entry["index"].get(str(doc["_id"]))) is not None:
+            self.entry["dead"] += old[1]
+        self.entry["index"][str(doc["_id"])] = [self.file.tell(), len(data)]
+        self.file.write(data)
+
+    def delete(self, doc_id):
+        if (old := self.entry["index"].pop(str(doc_id), None)) is not None:
+            self.entry["dead"] += old[1]
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.entry["size"] = self.file.tell()
+        self.file.close()
+
+
+def private(path: str, flags: int) -> int:
+    return os.open(path, flags, 0o600)  # the snapshot holds (encrypted) credentials
+
+
+def new_entry(collection: str, generation: int) -> dict:
+    return {"file": f"{collection}-{generation}.bson", "size": 0, "dead": 0, "index": {}}
+
+
+async def full_dump(database, directory: str, generation: int) -> dict:
+    # open the change stream first, so whatever is written while we dump is picked up by the next refresh
+    async with await database.watch(watch_pipeline()) as stream:
+        resume_token = stream.resume_token
+    manifest = {"generation": generation, "resume_token": json_util.dumps(resume_token), "collections": {}}
+    for collection in SNAPSHOT_COLLECTIONS:
+        entry = manifest["collections"][collection] = new_entry(collection, generation)
+        snapshot_file = SnapshotFile(directory, entry)
+        async for doc in database[collection].find({}, batch_size=1000):
+            snapshot_file.put(doc)
+        await asyncio.to_thread(snapshot_file.close)
+    return manifest
+
+
+async def apply_changes(database, directory: str, manifest: dict) -> bool:
+    """
+    Append the changes since the manifest's resume token. Returns False if they can't be applied (e.g. a collection
+    was dropped) and a full dump is needed instead
+    """
+    files = {collection: SnapshotFile(directory, entry) for collection, entry in manifest["collections"].items()}
+    try:
+        async with await database.watch(watch_pipeline(), full_document="updateLookup",
+                                        resume_after=json_util.loads(manifest["resume_token"])) as stream:
+            for _ in range(MAX_CHANGES):
+                if (change := await stream.try_next()) is None:
+                    break
+                collection = change.get("ns", {}).get("coll")
+                if (doc_id := change.get("documentKey", {}).get("_id")) is None or collection not in files:
+                    return False  # drop/rename/invalidate
+                if change.get("fullDocument") is not None:
+                    files[collection].put(change["fullDocument"])
+                else:  # deleted (or deleted again before the update could be looked up)
+                    files[collection].delete(doc_id)
+            manifest["resume_token"] = json_util.dumps(stream.resume_token)
+    finally:
+        for snapshot_file in files.values():
+            await asyncio.to_thread(snapshot_file.close)
+    return True
+
+
+def compact(directory: str, manifest: dict):
+    """
+    Rewrite the files that are mostly dead copies into new files holding only the current documents
+    """
+    if not (wasteful := [collection for collection, entry in manifest["collections"].items()
+                         if entry["dead"] > entry["size"] // 2]):
+        return
+    manifest["generation"] += 1
+    for collection in wasteful:
+        entry = manifest["collections"][collection]
+        new = new_entry(collection, manifest["generation"])
+        with open(os.path.join(directory, entry["file"]), "rb") as old, \
+                open(os.path.join(directory, new["file"]), "wb", opener=private) as f:
+            for doc_id, (offset, length) in entry["index"].items():
+                old.seek(offset)
+                new["index"][doc_id] = [f.tell(), length]
+                f.write(old.read(length))
+            f.flush()
+            os.fsync(f.fileno())
+            new["size"] = f.tell()
+        manifest["collections"][collection] = new
+
+
+def watch_pipeline() -> list[dict]:
+    return [{"$match": {"ns.coll": {"$in": list(SNAPSHOT_COLLECTIONS)}}}]
+
+
+async def refresh(database, directory: str = SNAPSHOT_DIR):
+    """
+    Bring the snapshot up to date: incrementally if there is one, otherwise (or if that fails) with a full dump. Only
+    one worker refreshes at a time; the others skip their turn
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, ".lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        manifest = read_manifest(directory)
+        if manifest is not None:
+            try:
+                applied = await apply_changes(database, directory, manifest)
+            except OperationFailure as e:  # e.g. the resume token is older than the oplog
+                print(f"Snapshot can't be refreshed from the change stream ({e}), taking a new one")
+                applied = False
+            if applied:
+                await asyncio.to_thread(compact, directory, manifest)
+        if manifest is None or not applied:
+            manifest = await full_dump(database, directory, (manifest or {}).get("generation", 0) + 1)
+        manifest["updated_at"] = datetime.now(timezone.utc).isoformat()
+        await asyncio.to_thread(write_manifest, directory, manifest)
+        remove_unused_files(directory, manifest)
+
+
+async def refresh_loop(database):
+    # the manifest is parsed here, off the request path: first whatever snapshot is on disk already, then each new one
+    # (whether this worker or another one wrote it)
+    await asyncio.to_thread(snapshot.load)
+    while True:
+        try:
+            await refresh(database)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Snapshot refresh failed ({e})")
+        await asyncio.to_thread(snapshot.load)
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+
+
+# reading
+
+class SnapshotView:
+    """
+    One loaded snapshot: its manifest, the memory-mapped files and, per collection, the "_id"s in order
+    """
+    def __init__(self, directory: str, manifest: dict, mtime: int):
+        self.manifest = manifest
+        self.mtime = mtime
+        self.maps: dict[str, mmap.mmap] = {}
+        for collection, entry in manifest["collections"].items():
+            if entry["size"]:
+                with open(os.path.join(directory, entry["file"]), "rb") as f:
+                    self.maps[collection] = mmap.mmap(f.fileno(), entry["size"], access=mmap.ACCESS_READ)
+        self.ids = {collection: sorted(entry["index"]) for collection, entry in manifest["collections"].items()}
+
+
+class Snapshot:
+    """
+    Read-only, memory-mapped view of the latest snapshot. load() picks up a new manifest; it is called from
+    refresh_loop, in a thread, so requests never wait for the manifest to be parsed. A new view replaces the old one
+    in a single assignment, so a reader never mixes the manifest of one snapshot with the files of another
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.view: Optional[SnapshotView] = None
+        self.offline_until = 0.0  # while in the future, GETs are served from here without trying Atlas
+
+    def load(self):
+        try:
+            mtime = os.stat(os.path.join(self.directory, MANIFEST)).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if self.view is not None and mtime == self.view.mtime:
+            return
+        if (manifest := read_manifest(self.directory)) is not None:
+            self.view = SnapshotView(self.directory, manifest, mtime)
+
+    @property
+    def manifest(self) -> Optional[dict]:
+        return self.view.manifest if self.view is not None else None
+
+    def available(self) -> bool:
+        return self.view is not None
+
+    def current(self, collection: str) -> SnapshotView:
+        if (view := self.view) is None:
+            raise OfflineUnsupported("No snapshot has been taken yet")
+        if collection not in view.manifest["collections"]:
+            raise OfflineUnsupported(f"{collection} is not in the snapshot")
+        return view
+
+    @staticmethod
+    def read(view: SnapshotView, collection: str, doc_id) -> Optional[dict]:
+        if (location := view.manifest["collections"][collection]["index"].get(str(doc_id))) is None:
+            return None
+        offset, length = location
+        return bson.decode(view.maps[collection][offset:offset + length])
+
+    def get(self, collection: str, doc_id) -> Optional[dict]:
+        return self.read(self.current(collection), collection, doc_id)
+
+    def scan(self, collection: str, after: Optional[str] = None, descending: bool = False) -> Iterator[dict]:
+        """
+        The documents of a collection in "_id" order, decoded one at a time as they are iterated. With after, starts
+        past that "_id"
+        """
+        view = self.current(collection)
+        ids = view.ids[collection]
+        if descending:
+            end = len(ids) if after is None else bisect.bisect_left(ids, after)
+            keys = (ids[i] for i in range(end - 1, -1, -1))
+        else:
+            start = 0 if after is None else bisect.bisect_right(ids, after)
+            keys = (ids[i] for i in range(start, len(ids)))
+        for key in keys:
+            yield self.read(view, collection, key)
+
+    @property
+    def offline(self) -> bool:
+        return time.monotonic() < self.offline_until
+
+
+snapshot = Snapshot(SNAPSHOT_DIR)
+
+
+def compare(value, operator: str, argument) -> bool:
+    try:
+        if operator == "$in":
+            return value in argument
+        if operator == "$nin":
+            return value not in argument
+        if operator == "$ne":
+            return value != argument
+        if operator == "$exists":
+            return (value is not None) == bool(argument)
+        if operator == "$regex":
+            return isinstance(value, str) and re.search(argument, value) is not None
+        if value is None:
+            return False
+        if operator == "$gt":
+            return value > argument
+        if operator == "$gte":
+            return value >= argument
+        if operator == "$lt":
+            return value < argument
+        if operator == "$lte":
+            return value <= argument
+    except TypeError:  # e.g. comparing a string to a date; MongoDB doesn't match those either
+        return False
+    raise OfflineUnsupported(f"{operator} is not available offline")
+
+
+def matches(doc: dict, query: dict) -> bool:
+    """
+    The subset of MongoDB query semantics our routers use: equality, comparisons, $in/$nin, $regex, $and and $or
+    """
+    for field, condition in query.items():
+        if field == "$and":
+            if not all(matches(doc, part) for part in condition):
+                return False
+        elif field == "$or":
+            if not any(matches(doc, part) for part in condition):
+                return False
+        elif field.startswith("$"):
+            raise OfflineUnsupported(f"{field} is not available offline")
+        elif isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+            if not all(compare(doc.get(field), operator, argument) for operator, argument in condition.items()):
+                return False
+        elif doc.get(field) != condition:
+            return False
+    return True
+
+
+def project(doc: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return doc
+    return {k: v for k, v in doc.items() if k == "_id" or projection.get(k)}
+
+
+def sort_key(value):
+    return (0, "") if value is None else (1, value)
+
+
+def id_lookup(query: dict) -> Optional[list]:
+    # the "_id"s a query is limited to, if it looks documents up by "_id" (equality or $in)
+    doc_id = query.get("_id")
+    if isinstance(doc_id, dict):
+        return list(doc_id["$in"]) if set(doc_id) == {"$in"} else None
+    return None if doc_id is None else [doc_id]
+
+
+def start_after(query: dict, descending: bool) -> Optional[str]:
+    """
+    The "_id" a query only matches documents past (in the given direction), if it says so in a way that is easy to
+    spot: {"_id": {"$gt": ...}}, at the top level or in an $and, or as the only branch of an $or. That is the shape
+    of the keyset pagination cursor (see pagination.py) when sorting on "_id" alone
+    """
+    for clause in [query, *query.get("$and", [])]:
+        if len(branches := clause.get("$or", [])) == 1:
+            clause = branches[0]
+        if isinstance(condition := clause.get("_id"), dict):
+            bound = condition.get("$lt" if descending else "$gt")
+            if isinstance(bound, str):
+                return bound
+    return None
+
+
+class SnapshotCursor:
+    """
+    A find() on the snapshot. As with a MongoDB cursor, nothing is read until the results are: sorted on "_id" (or
+    not sorted), documents are decoded in "_id" order, starting at the page cursor, only until limit of them have
+    matched. Sorting on other fields has no index to use, so it reads every document that matches
+    """
+    def __init__(self, collection: str, query: dict, projection: Optional[dict]):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.keys: list[tuple[str, int]] = []
+        self.count = 0
+
+    def sort(self, keys, direction=None):
+        self.keys = [(keys, direction or 1)] if isinstance(keys, str) else list(keys)
+        return self
+
+    def limit(self, limit: int):
+        self.count = limit
+        return self
+
+    def documents(self) -> Iterator[dict]:
+        descending = bool(self.keys) and self.keys[0][1] < 0
+        if (doc_ids := id_lookup(self.query)) is not None:
+            docs = [doc for doc in (snapshot.get(self.collection, key) for key in doc_ids)
+                    if doc is not None and matches(doc, self.query)]
+        elif all(field == "_id" for field, _ in self.keys):
+            docs = snapshot.scan(self.collection, start_after(self.query, descending), descending)
+            return islice((doc for doc in docs if matches(doc, self.query)), self.count or None)
+        else:
+            docs = [doc for doc in snapshot.scan(self.collection) if matches(doc, self.query)]
+        for field, order in reversed(self.keys):  # stable sorts, least significant key first
+            docs.sort(key=lambda doc: sort_key(doc.get(field)), reverse=order < 0)
+        return iter(docs[:self.count or None])
+
+    async def to_list(self, length=None):
+        return [project(doc, self.projection) for doc in islice(self.documents(), length)]
+
+    async def _iterate(self):
+        for doc in self.documents():
+            yield project(doc, self.projection)
+
+    def __aiter__(self):
+        return self._iterate()
+
+
+class SnapshotCollection:
+    """
+    The read methods of a collection, answered from the snapshot. Anything else raises OfflineUnsupported
+    """
+    def __init__(self, collection: str):
+        self.collection = collection
+
+    def find(self, filter: Optional[dict] = None, projection: Optional[dict] = None, **kwargs) -> SnapshotCursor:
+        return SnapshotCursor(self.collection, filter or {}, projection)
+
+    async def find_one(self, filter: Optional[dict] = None, projection: Optional[dict] = None, **kwargs):
+        docs = await self.find(filter, projection).limit(1).to_list(None)
+        return docs[0] if docs else None
+
+    def __getattr__(self, name):
+        raise OfflineUnsupported(f"{name} is not available offline")
+
+
+class SnapshotDatabase:
+    def __getitem__(self, collection: str) -> SnapshotCollection:
+        if collection not in SNAPSHOT_COLLECTIONS:
+            raise OfflineUnsupported(f"{collection} is not available offline")
+        return SnapshotCollection(collection)
+
+    def __getattr__(self, name):
+        raise OfflineUnsupported(f"{name} is not available offline")
+
+
+class OfflineApp:
+    """
+    Stands in for the app in request.scope, so the routers' request.app.database is the snapshot
+    """
+    def __init__(self, app):
+        self._app = app
+        self.database = SnapshotDatabase()
+        self.ready = asyncio.Event()
+        self.ready.set()  # nothing to wait for, see startup.wait_until_ready
+
+    def __getattr__(self, name):
+        return getattr(self._app, name)
+
+
+def unavailable(detail: str) -> JSONResponse:
+    return JSONResponse({"detail": detail}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        headers={"Retry-After": str(OFFLINE_RETRY)})
+
+
+async def mongodb_unreachable(request: Request, exc: ConnectionFailure) -> JSONResponse:
+    """
+    Exception handler for requests that failed because MongoDB couldn't be reached. Answered with 503 rather than
+    500; GETs are then retried against the snapshot by ServeOffline
+    """
+    if SNAPSHOT and not snapshot.offline:
+        print(f"MongoDB unreachable ({exc}), serving reads from the snapshot for {OFFLINE_RETRY}s")
+        snapshot.offline_until = time.monotonic() + OFFLINE_RETRY
+    response = unavailable(f"MongoDB is unreachable: {exc}")
+    response.headers[UNREACHABLE_HEADER] = "1"
+    return response
+
+
+async def offline_unsupported(request: Request, exc: OfflineUnsupported) -> JSONResponse:
+    return unavailable(f"MongoDB is unreachable and this request can't be answered offline: {exc}")
+
+
+def startup_failed(app) -> bool:
+    return not app.ready.is_set() and app.startup_error is not None
+
+
+class ServeOffline:
+    """
+    Middleware switching to the snapshot while MongoDB is unreachable (see above). A GET that fails against Atlas is
+    answered by running the request again, with the snapshot as its database; the failed response is held back, never
+    sent. Plain ASGI, so the request can be dispatched twice. When MongoDB is reachable, this costs one time comparison
+    per request
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not SNAPSHOT:
+            return await self.app(scope, receive, send)
+        reading = scope["method"] in ("GET", "HEAD")
+        if not snapshot.offline and not startup_failed(scope["app"]):
+            unreachable = False
+
+            async def send_online(message):
+                nonlocal unreachable
+                if message["type"] == "http.response.start":
+                    unreachable = reading and UNREACHABLE_HEADER in MutableHeaders(scope=message)
+                if not unreachable:
+                    await send(message)
+
+            await self.app(scope, receive, send_online)
+            if not unreachable:
+                return
+        elif not reading:
+            response = unavailable("MongoDB is unreachable; only reads are served, from the local snapshot")
+            return await response(scope, receive, send)
+
+        replayed = False
+
+        async def receive_again():
+            # a GET has no body, but the first attempt may already have received its (empty) request message
+            nonlocal replayed
+            if replayed:
+                return await receive()
+            replayed = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send_offline(message):
+            if message["type"] == "http.response.start" and snapshot.manifest is not None:
+                MutableHeaders(scope=message)["X-Served-From"] = f"snapshot {snapshot.manifest['updated_at']}"
+            await send(message)
+
+        await self.app({**scope, "app": OfflineApp(scope["app"])}, receive_again, send_offline)
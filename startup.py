@@ -0,0 +1,110 @@
+import asyncio
+import time
+from fastapi import HTTPException, Request, status
+from fastapi.responses import JSONResponse
+from pymongo.errors import ConnectionFailure
+
+from cache import change_stream_enabled, load_caches, watch_caches
+from database import config_int
+from indexes import ensure_indexes
+from search import SEARCH_INDEXES, credential_index, jobhunt_index
+from snapshot import snapshot, snapshot_enabled
+from write_behind import credential_queue, write_behind_enabled
+
+# Startup doesn't wait for MongoDB. The client connects on its first operation, and everything that needs the database
+# (indexes, journal replay, caches, search indexes) runs in a background task after the worker is already serving, so
+# a slow Atlas handshake delays readiness but never makes startup itself fail or time out. Only failures to reach
+# MongoDB are retried; any other error (bad credentials, an index that can't be built, an unwritable journal directory)
+# won't go away by retrying, so warm-up gives up on it:
+#
+# - GET /health/live answers as soon as the worker is up, and 503 once warm-up has given up, so the worker is restarted
+# - GET /health/ready answers 503 until warm-up has finished and MongoDB answers a ping (or, with SNAPSHOT, while
+#   reads can be served from the offline snapshot instead, see snapshot.py)
+#
+# Requests arriving before warm-up has finished wait for it, up to READY_WAIT_MS, and are then refused with 503. If
+# warm-up gives up, they are refused straight away.
+READY_WAIT_MS = config_int("STARTUP_READY_WAIT_MS", 30000)
+PING_TIMEOUT_MS = config_int("STARTUP_PING_TIMEOUT_MS", 2000)
+MAX_RETRY_SECONDS = 30
+PROBE_PATHS = ("/health/", "/metrics", "/cache/stats", "/docs", "/redoc", "/openapi.json")  # never wait for warm-up
+
+
+async def prepare(app):
+    if write_behind_enabled() and not credential_queue.running:
+        await credential_queue.start(app.database)  # replays updates journalled before a crash, before any new ones
+    await asyncio.gather(
+        ensure_indexes(app.database),  # create any indexes from indexes.INDEXES that are missing
+        load_caches(app.database),  # warm the reference collection caches
+        credential_index.rebuild(app.database["creds"]),
+        jobhunt_index.rebuild(app.database["jobhunt"]),
+    )
+    # follow writes made by the other workers, so caches and search indexes stay in step with theirs
+    if change_stream_enabled() and app.cache_watcher is None:
+        app.cache_watcher = asyncio.create_task(watch_caches(app.database, SEARCH_INDEXES))
+
+
+async def warm_up(app):
+    """
+    Run prepare() until it succeeds, backing off between attempts, then mark the app ready. Gives up on errors other
+    than ConnectionFailure (which includes ServerSelectionTimeoutError)
+    """
+    started = time.perf_counter()
+    delay = 1
+    while True:
+        try:
+            await prepare(app)
+            break
+        except ConnectionFailure as e:
+            app.startup_error = str(e)
+            print(f"Startup against MongoDB failed ({e}), retrying in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_SECONDS)
+        except Exception as e:
+            app.startup_error = f"{type(e).__name__}: {e}"
+            print(f"Startup failed ({app.startup_error}), not retrying")
+            return
+    app.startup_error = None
+    app.ready.set()
+    print(f"Connected to the MongoDB database! Ready after {time.perf_counter() - started:.2f}s")
+
+
+def gave_up(app) -> bool:
+    """
+    True once warm-up has finished without making the app ready
+    """
+    return app.warm_up.done() and not app.ready.is_set()
+
+
+async def check_ready(app) -> dict:
+    """
+    Body of the readiness probe. Raises 503 while warm-up is running or if MongoDB doesn't answer a ping, unless reads
+    can be served from the offline snapshot (see snapshot.py)
+    """
+    if not app.ready.is_set() and app.startup_error is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Starting")
+    if not app.ready.is_set():
+        problem = f"{'Startup failed' if gave_up(app) else 'Starting'}: {app.startup_error}"
+    else:
+        try:
+            await asyncio.wait_for(app.database.command("ping"), PING_TIMEOUT_MS / 1000)
+            return {"status": "ready"}
+        except Exception as e:
+            problem = f"MongoDB unavailable: {e!r}"
+    if snapshot_enabled() and snapshot.available():
+        return {"status": "offline", "detail": problem}
+    raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=problem)
+
+
+async def wait_until_ready(request: Request, call_next):
+    """
+    Middleware holding requests back until warm-up has finished. Once it has, this is a single flag check
+    """
+    if request.app.ready.is_set() or request.url.path.startswith(PROBE_PATHS):
+        return await call_next(request)
+    await asyncio.wait([request.app.warm_up], timeout=READY_WAIT_MS / 1000)  # over early if warm-up gives up
+    if gave_up(request.app):
+        return JSONResponse({"detail": "Startup failed"}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    if not request.app.ready.is_set():
+        return JSONResponse({"detail": "Still starting, try again later"},
+                            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": "5"})
+    return await call_next(request)
@@ -0,0 +1,18 @@
+import pytest
+
+from benchmarks.fake_mongo import FakeClient
+from database import config
+
+# The tests run against the in-process fake MongoDB from the benchmarks, so no Atlas cluster is needed. Run them from
+# the repository root with `python -m pytest`.
+config.setdefault("DB_NAME", "test")
+
+
+@pytest.fixture
+def client() -> FakeClient:
+    return FakeClient()
+
+
+@pytest.fixture
+def database(client):
+    return client[config["DB_NAME"]]
@@ -0,0 +1,153 @@
+import asyncio
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+import httpx
+import pytest
+from fastapi import HTTPException
+from gridfs.errors import NoFile
+
+import attachments
+import main
+from attachments import parse_range
+
+
+class FakeUpload:
+    def __init__(self, bucket, file_id: str, filename: str, metadata: dict):
+        self.bucket, self.file_id, self.filename, self.metadata = bucket, file_id, filename, metadata
+        self.data = b""
+
+    async def write(self, chunk: bytes):
+        self.data += chunk
+
+    async def abort(self):
+        pass
+
+    async def close(self):
+        self.bucket.contents[self.file_id] = self.data
+        await self.bucket.files.insert_one({"_id": self.file_id, "filename": self.filename, "length": len(self.data),
+                                            "metadata": self.metadata, "uploadDate": datetime.now(timezone.utc)})
+
+
+class FakeDownload:
+    def __init__(self, doc: dict, data: bytes):
+        self._id, self.filename, self.metadata = doc["_id"], doc["filename"], doc["metadata"]
+        self.length, self.upload_date = doc["length"], doc["uploadDate"]
+        self.data, self.position = data, 0
+
+    async def seek(self, position: int):
+        self.position = position
+
+    async def read(self, size: int) -> bytes:
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+
+class FakeBucket:
+    """
+    The parts of AsyncGridFSBucket that attachments.py uses, keeping file documents where GridFS would, in
+    attachments.files
+    """
+    def __init__(self, database):
+        self.files = database["attachments.files"]
+        self.contents: dict[str, bytes] = {}
+
+    def open_upload_stream_with_id(self, file_id: str, filename: str, metadata: dict) -> FakeUpload:
+        return FakeUpload(self, file_id, filename, metadata)
+
+    async def open_download_stream(self, file_id: str) -> FakeDownload:
+        if (doc := await self.files.find_one({"_id": file_id})) is None:
+            raise NoFile(file_id)
+        return FakeDownload(doc, self.contents[file_id])
+
+    async def delete(self, file_id: str):
+        if (await self.files.delete_one({"_id": file_id})).deleted_count == 0:
+            raise NoFile(file_id)
+        del self.contents[file_id]
+
+    def find(self, query: dict):
+        return self.files.find(query)
+
+
+@pytest.fixture
+def app(database, monkeypatch):
+    bucket = FakeBucket(database)
+    monkeypatch.setattr(attachments, "attachment_bucket", lambda database: bucket)
+    monkeypatch.setattr(main.app, "database", database, raising=False)
+    ready = asyncio.Event()
+    ready.set()
+    monkeypatch.setattr(main.app, "ready", ready, raising=False)
+    asyncio.run(database["jobhunt"].insert_many([{"_id": "j1", "application_details": []}, {"_id": "j2"}]))
+    return main.app
+
+
+def call(app, *requests: tuple) -> list[httpx.Response]:
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return [await client.request(method, url, **kwargs) for method, url, kwargs in requests]
+
+    return asyncio.run(run())
+
+
+def test_upload_and_download(app, database):
+    name = 'résumé "final"\r\n.txt'
+    uploaded, = call(app, ("POST", "/jobhunt/j1/attachments",
+                           {"params": {"field": "application_details", "filename": name}, "content": b"0123456789"}))
+    assert uploaded.status_code == 201
+    file_id = uploaded.json()["_id"]
+    whole, part, other = call(app, ("GET", f"/jobhunt/j1/attachments/{file_id}", {}),
+                              ("GET", f"/jobhunt/j1/attachments/{file_id}", {"headers": {"Range": "bytes=2-4"}}),
+                              ("GET", f"/jobhunt/j2/attachments/{file_id}", {}))
+    assert whole.status_code == 200 and whole.content == b"0123456789"
+    assert whole.headers["Content-Disposition"] == (
+        f"attachment; filename=\"r_sum_ _final___.txt\"; filename*=UTF-8''{quote(name, safe='')}")
+    assert part.status_code == 206 and part.content == b"234"
+    assert part.headers["Content-Range"] == "bytes 2-4/10"
+    assert other.status_code == 404  # belongs to another application
+    stored = asyncio.run(database["jobhunt"].find_one({"_id": "j1"}))
+    assert stored["application_details"] == [f"gridfs:{file_id}"]
+
+
+def test_upload_to_missing_application_stores_nothing(app, database):
+    response, = call(app, ("POST", "/jobhunt/nope/attachments",
+                           {"params": {"field": "application_details", "filename": "cv.pdf"}, "content": b"cv"}))
+    assert response.status_code == 404
+    assert asyncio.run(database["attachments.files"].count_documents({})) == 0
+
+
+def test_delete_checks_the_owner(app, database):
+    uploaded, = call(app, ("POST", "/jobhunt/j1/attachments",
+                           {"params": {"field": "application_details", "filename": "cv.pdf"}, "content": b"cv"}))
+    file_id = uploaded.json()["_id"]
+    wrong, right, gone = call(app, ("DELETE", f"/jobhunt/j2/attachments/{file_id}", {}),
+                              ("DELETE", f"/jobhunt/j1/attachments/{file_id}", {}),
+                              ("GET", f"/jobhunt/j1/attachments/{file_id}", {}))
+    assert (wrong.status_code, right.status_code, gone.status_code) == (404, 204, 404)
+    assert asyncio.run(database["jobhunt"].find_one({"_id": "j1"}))["application_details"] == []
+
+
+@pytest.mark.parametrize("header,expected", [
+    (None, None),
+    ("", None),
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),  # more than the whole file
+    ("bytes=900-5000", (900, 999)),  # end past the end of the file
+    (" bytes=0-0 ", (0, 0)),
+    ("bytes=0-1,5-6", None),  # multiple ranges: answered with the whole file
+    ("bytes=-", None),
+    ("items=0-1", None),
+    ("bytes=a-b", None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=500-100", "bytes=2000-3000"])
+def test_unsatisfiable_range(header):
+    with pytest.raises(HTTPException) as raised:
+        parse_range(header, 1000)
+    assert raised.value.status_code == 416
+    assert raised.value.headers["Content-Range"] == "bytes */1000"
@@ -0,0 +1,118 @@
+import asyncio
+import os
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import encryption
+import main
+from encryption import PREFIX, decrypt_fields, decrypt_value, encrypt_fields
+
+CRED = {"_id": "c1", "username": "alice", "email": "alice@example.com", "password": "hunter2", "country": "UK",
+        "area": "personal", "login_override": "", "personal_details": {"DOB": "1996/12/31"},
+        "security_questions": {"First pet?": "Rex"}}
+
+
+@pytest.fixture
+def master_key(monkeypatch):
+    monkeypatch.setattr(encryption, "MASTER_KEY", os.urandom(32))
+
+
+def test_round_trip(master_key):
+    stored = encrypt_fields("c1", CRED)
+    assert stored["password"].startswith(PREFIX) and stored["password"] != CRED["password"]
+    assert stored["personal_details"]["DOB"].startswith(PREFIX)
+    assert stored["username"] == "alice"  # only the secrets are encrypted
+    assert decrypt_fields(stored) == CRED
+
+
+def test_values_are_bound_to_their_credential(master_key):
+    stored = encrypt_fields("c1", CRED)
+    with pytest.raises(HTTPException) as raised:
+        decrypt_value("c2:password", stored["password"])
+    assert raised.value.status_code == 500
+
+
+def test_tampered_value(master_key):
+    value = encrypt_fields("c1", CRED)["password"]
+    tampered = value[:-4] + ("AAAA" if not value.endswith("AAAA") else "BBBB")
+    with pytest.raises(HTTPException) as raised:
+        decrypt_value("c1:password", tampered)
+    assert raised.value.status_code == 500
+
+
+@pytest.mark.parametrize("value", [f"{PREFIX}x", f"{PREFIX}not base64:!!", f"{PREFIX}{'A' * 8}:{'A' * 8}"])
+def test_malformed_value(master_key, value):
+    with pytest.raises(HTTPException) as raised:
+        decrypt_value("c1:password", value)
+    assert raised.value.status_code == 422
+
+
+def test_plaintext_fallback(master_key):
+    assert decrypt_value("c1:password", "stored before encryption") == "stored before encryption"
+
+
+def test_plaintext_without_master_key():
+    assert encrypt_fields("c1", CRED) == CRED
+    with pytest.raises(HTTPException) as raised:
+        encrypt_fields("c1", {"password": f"{PREFIX}x"})
+    assert raised.value.status_code == 422
+
+
+def test_client_values_are_always_encrypted(master_key):
+    copied = encrypt_fields("other", CRED)["password"]  # ciphertext of another credential
+    for value in (f"{PREFIX}x", copied):
+        stored = encrypt_fields("c1", {"password": value})
+        assert stored["password"] != value
+        assert decrypt_value("c1:password", stored["password"]) == value
+
+
+def test_imports_keep_only_their_own_ciphertext(master_key):
+    exported = encrypt_fields("c1", CRED)
+    assert encrypt_fields("c1", exported, imported=True) == exported
+    with pytest.raises(HTTPException):
+        encrypt_fields("c2", exported, imported=True)  # copied onto another credential
+
+
+@pytest.fixture
+def app(database, monkeypatch):
+    monkeypatch.setattr(main.app, "database", database, raising=False)
+    ready = asyncio.Event()
+    ready.set()
+    monkeypatch.setattr(main.app, "ready", ready, raising=False)
+
+    async def references():
+        await database["countries"].insert_one({"_id": "uk", "name": "UK"})
+        await database["areas"].insert_one({"_id": "personal", "name": "personal"})
+        await database["mailboxes"].insert_one({"_id": "m1", "address": "alice@example.com"})
+
+    asyncio.run(references())
+    return main.app
+
+
+def test_post_with_encrypted_looking_password(master_key, app):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            created = await client.post("/cred/", json={**CRED, "password": f"{PREFIX}x"})
+            return created, await client.get("/cred/c1")
+
+    created, found = asyncio.run(run())
+    assert created.status_code == 201
+    assert found.status_code == 200
+    assert found.json()["password"] == f"{PREFIX}x"
+
+
+def test_bulk_import_of_exported_credentials(master_key, app):
+    exported = encrypt_fields("c1", CRED)
+    copied = {**exported, "_id": "c2"}  # ciphertext that belongs to c1
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            imported = await client.post("/cred/bulk", json=[exported, copied])
+            return imported, await client.get("/cred/c1")
+
+    imported, found = asyncio.run(run())
+    assert imported.json()["inserted"] == 1
+    assert [error["index"] for error in imported.json()["errors"]] == [1]
+    assert found.json()["password"] == "hunter2"
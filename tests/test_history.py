@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from history import (HISTORY_COLLECTION, delete_with_history, list_revisions, rebuild_revision,
+                     update_many_with_history, update_with_history)
+
+
+@pytest.fixture
+def history(database):
+    """
+    A credential created at revision 0, then changed three times: revisions 1 and 2 through single updates, 3
+    through the batched update the write-behind queue uses
+    """
+    async def build():
+        await database["creds"].insert_one({"_id": "c1", "username": "alice", "password": "one", "revision": 0})
+        await update_with_history(database, "c1", {}, {"password": "two"})
+        await update_with_history(database, "c1", {}, {"password": "three", "login_override": "a@example.com"})
+        await update_many_with_history(database, {"c1": {"username": "alicia"}})
+
+    asyncio.run(build())
+    return database
+
+
+def rebuild(database, revision: int):
+    return asyncio.run(rebuild_revision(database, "c1", revision))
+
+
+def fields(doc: dict) -> dict:
+    return {k: v for k, v in doc.items() if k != "modified_at"}
+
+
+def test_rebuilds_every_revision(history):
+    assert fields(rebuild(history, 3)) == {"_id": "c1", "username": "alicia", "password": "three",
+                                           "login_override": "a@example.com", "revision": 3}
+    assert fields(rebuild(history, 2)) == {"_id": "c1", "username": "alice", "password": "three",
+                                           "login_override": "a@example.com", "revision": 2}
+    assert fields(rebuild(history, 1)) == {"_id": "c1", "username": "alice", "password": "two", "revision": 1}
+    assert rebuild(history, 0) == {"_id": "c1", "username": "alice", "password": "one", "revision": 0}
+    assert rebuild(history, 4) is None
+
+
+def test_update_with_history_returns_the_new_version(database):
+    async def run():
+        await database["creds"].insert_one({"_id": "c1", "username": "alice", "revision": 4})
+        return await update_with_history(database, "c1", {"revision": 4}, {"username": "bob"})
+
+    updated = asyncio.run(run())
+    assert updated["username"] == "bob" and updated["revision"] == 5
+    stored = asyncio.run(database["creds"].find_one({"_id": "c1"}))
+    assert stored["modified_at"] == updated["modified_at"].replace(tzinfo=None)  # the fake returns naive datetimes
+
+
+def test_condition_mismatch_records_nothing(history):
+    assert asyncio.run(update_with_history(history, "c1", {"revision": 1}, {"password": "x"})) is None
+    assert asyncio.run(history[HISTORY_COLLECTION].count_documents({})) == 3
+
+
+def test_expired_entries_leave_a_gap(history):
+    asyncio.run(history[HISTORY_COLLECTION].delete_one({"cred_id": "c1", "revision": 2}))  # as the TTL index would
+    assert rebuild(history, 2) is not None  # only needs the entry for revision 3
+    assert rebuild(history, 1) is None
+    assert rebuild(history, 0) is None
+
+
+def test_rebuilds_deleted_credential(history):
+    assert asyncio.run(delete_with_history(history, "c1", {}))
+    assert asyncio.run(history["creds"].find_one({"_id": "c1"})) is None
+    assert rebuild(history, 3)["username"] == "alicia"
+    assert rebuild(history, 0)["password"] == "one"
+
+
+def test_recreated_credential_hides_the_deleted_one(history):
+    asyncio.run(delete_with_history(history, "c1", {}))
+    asyncio.run(history["creds"].insert_one({"_id": "c1", "username": "new", "password": "new"}))
+    assert rebuild(history, 0)["username"] == "new"  # the new credential's own revision 0
+    assert rebuild(history, 3) is None  # from before the delete, not reachable through it
+
+
+def test_list_revisions(history):
+    asyncio.run(delete_with_history(history, "c1", {}))
+    listed = asyncio.run(list_revisions(history, "c1", 10))
+    assert [(entry["revision"], entry["op"], entry["changed"]) for entry in listed] == [
+        (3, "delete", []),
+        (3, "update", ["username"]),
+        (2, "update", ["login_override", "password"]),
+        (1, "update", ["password"]),
+    ]
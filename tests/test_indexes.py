@@ -0,0 +1,49 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+from pymongo import AsyncMongoClient
+
+from indexes import ensure_indexes
+
+# These run against a real MongoDB, since only the server can say which plan it picks. Point MONGO_TEST_URI at a
+# test deployment (e.g. mongodb://localhost:27017); each run uses a new database and drops it afterwards.
+MONGO_TEST_URI = os.environ.get("MONGO_TEST_URI")
+pytestmark = pytest.mark.skipif(not MONGO_TEST_URI, reason="MONGO_TEST_URI is not set")
+
+LOOKUPS = [
+    ("countries", {"$or": [{"_id": "UK"}, {"name": "UK"}]}),  # find_by_id_or_name
+    ("areas", {"$or": [{"_id": "banking"}, {"name": "banking"}]}),
+    ("mailboxes", {"$or": [{"_id": "a@example.com"}, {"address": "a@example.com"}]}),
+    ("personal_detail_type", {"$or": [{"_id": "DOB"}, {"detail": "DOB"}]}),
+    ("creds", {"area": "banking"}),
+    ("creds", {"country": "UK"}),
+    ("creds", {"email": "a@example.com"}),
+    ("creds", {"username": "alice"}),
+]
+
+
+def stages(plan: dict) -> set[str]:
+    found = {plan["stage"]} if "stage" in plan else set()
+    for value in plan.values():
+        for child in value if isinstance(value, list) else [value]:
+            if isinstance(child, dict):
+                found |= stages(child)
+    return found
+
+
+@pytest.mark.parametrize("collection,query", LOOKUPS)
+def test_lookups_use_indexes(collection, query):
+    async def explain():
+        client = AsyncMongoClient(MONGO_TEST_URI)
+        database = client[f"test_{uuid.uuid4().hex}"]
+        try:
+            await ensure_indexes(database)
+            return await database[collection].find(query).explain()
+        finally:
+            await client.drop_database(database.name)
+            await client.close()
+
+    plan = asyncio.run(explain())["queryPlanner"]["winningPlan"]
+    assert "COLLSCAN" not in stages(plan)
@@ -0,0 +1,56 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+import ratelimit
+from ratelimit import LimitRequests, RateLimiter, client_key, parse_limits
+
+
+@pytest.fixture
+def limited_app(monkeypatch):
+    monkeypatch.setattr(ratelimit, "rate_limiter", RateLimiter(parse_limits("/=100,100,1"), 10))
+    app = FastAPI()
+    app.add_middleware(LimitRequests)
+    release = asyncio.Event()
+
+    @app.get("/export")
+    async def export():
+        async def body():
+            yield b"first"
+            await release.wait()
+            yield b"last"
+        return StreamingResponse(body())
+
+    @app.get("/item")
+    async def item():
+        return {}
+
+    app.state.release = release
+    return app
+
+
+def test_streamed_response_holds_its_slot_until_sent(limited_app):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=limited_app), base_url="http://test") as client:
+            export = asyncio.create_task(client.get("/export"))
+            while not ratelimit.rate_limiter.buckets or not list(ratelimit.rate_limiter.buckets.values())[0][2]:
+                await asyncio.sleep(0)
+            blocked = await client.get("/item")
+            limited_app.state.release.set()
+            await export
+            return blocked, await client.get("/item")
+
+    blocked, allowed = asyncio.run(run())
+    assert blocked.status_code == 429
+    assert allowed.status_code == 200
+
+
+def test_unknown_api_keys_are_ignored(monkeypatch):
+    monkeypatch.setattr(ratelimit, "API_KEYS", {"issued"})
+    scope = {"type": "http", "client": ("10.0.0.1", 1234), "headers": [(b"x-api-key", b"made-up")]}
+    assert client_key(scope) == "ip:10.0.0.1"
+    scope["headers"] = [(b"x-api-key", b"issued")]
+    assert client_key(scope) == "key:issued"
@@ -0,0 +1,37 @@
+import asyncio
+
+from search import SearchIndex
+
+
+class SlowCollection:
+    """
+    A collection whose find() yields to the event loop after every document, as a real cursor's fetches would
+    """
+    def __init__(self, docs: list[dict]):
+        self.docs = docs
+
+    def find(self, *args, **kwargs):
+        async def iterate():
+            for doc in list(self.docs):
+                await asyncio.sleep(0)
+                yield doc
+        return iterate()
+
+
+def test_rebuild_keeps_serving_and_keeps_concurrent_changes():
+    index = SearchIndex(("username",))
+    docs = [{"_id": f"c{i}", "username": f"user{i}"} for i in range(10)]
+    index.add_all(docs)
+
+    async def run():
+        rebuild = asyncio.create_task(index.rebuild(SlowCollection(docs)))
+        await asyncio.sleep(0)
+        assert index.search("user3", 1) == ["c3"]  # the old index still answers during the rebuild
+        index.add({"_id": "new", "username": "newcomer"})  # written after the scan started
+        index.remove("c9")  # deleted before the scan reaches it
+        await rebuild
+
+    asyncio.run(run())
+    assert index.search("newcomer", 1) == ["new"]
+    assert "c9" not in index
+    assert index.stats()["documents"] == 10
@@ -0,0 +1,48 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from cache import invalidate_all
+import serialization
+from models import SCHEMA_VERSION
+
+# Stored as the API writes them: stamped, with bookkeeping fields the models don't declare
+STORED = {"schema_version": SCHEMA_VERSION, "revision": 3, "modified_at": 1700000000.0}
+CRED = {"_id": "c1", "username": "alice", "email": "alice@example.com", "password": "hunter2", "country": "UK",
+        "area": "personal", "login_override": "", "personal_details": {"DOB": "1996/12/31"},
+        "security_questions": {"First pet?": "Rex"}, **STORED}
+
+
+@pytest.fixture
+def app(database, monkeypatch):
+    monkeypatch.setattr(main.app, "database", database, raising=False)
+    ready = asyncio.Event()
+    ready.set()
+    monkeypatch.setattr(main.app, "ready", ready, raising=False)
+    invalidate_all()  # the reference caches outlive each test's database
+
+    async def seed():
+        await database["creds"].insert_one(dict(CRED))
+        await database["creds"].insert_one({**CRED, "_id": "c2", "country": "nowhere"})
+        await database["countries"].insert_one({"_id": "uk", "name": "UK", **STORED})
+        await database["countries"].insert_one({"_id": "hk", "name": "Hong Kong"})  # written before stamping
+        await database["areas"].insert_one({"_id": "personal", "name": "personal", "description": "Mine", **STORED})
+
+    asyncio.run(seed())
+    return main.app
+
+
+@pytest.mark.parametrize("path", ["/cred/", "/cred/?expand=country,area", "/cred/c1", "/cred/c2?expand=country",
+                                  "/cred/search?q=alice", "/country/", "/country/uk"])
+def test_fast_path_sends_the_same_body(app, monkeypatch, path):
+    async def get(fast):
+        monkeypatch.setattr(serialization, "FAST_SERIALIZATION", fast)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.get(path)
+
+    normal, fast = asyncio.run(get(False)), asyncio.run(get(True))
+    assert normal.status_code == fast.status_code == 200
+    assert fast.content == normal.content
+    assert "schema_version" not in fast.text and "revision" not in fast.text
@@ -0,0 +1,152 @@
+import asyncio
+from datetime import datetime, timezone
+
+import httpx
+import pytest
+from pymongo.errors import ConnectionFailure
+
+import main
+import snapshot
+from snapshot import (SNAPSHOT_COLLECTIONS, Snapshot, SnapshotCollection, SnapshotFile, matches, new_entry,
+                      write_manifest)
+
+CRED = {"_id": "c1", "username": "alice", "email": "alice@example.com", "password": "hunter2", "country": "UK",
+        "area": "personal", "login_override": "", "personal_details": {}, "security_questions": {}}
+
+
+def write_snapshot(directory: str, docs: dict[str, list[dict]]):
+    manifest = {"generation": 1, "resume_token": "null", "updated_at": datetime.now(timezone.utc).isoformat(),
+                "collections": {}}
+    for collection in SNAPSHOT_COLLECTIONS:
+        entry = manifest["collections"][collection] = new_entry(collection, 1)
+        snapshot_file = SnapshotFile(directory, entry)
+        for doc in docs.get(collection, []):
+            snapshot_file.put(doc)
+        snapshot_file.close()
+    write_manifest(directory, manifest)
+
+
+class Unreachable:
+    """
+    A database every operation of which fails as if Atlas couldn't be reached
+    """
+    def __getitem__(self, name: str):
+        return self
+
+    def __getattr__(self, name):
+        raise ConnectionFailure("Atlas is unreachable")
+
+
+@pytest.fixture
+def offline_app(tmp_path, monkeypatch):
+    write_snapshot(str(tmp_path), {"creds": [CRED]})
+    monkeypatch.setattr(snapshot, "SNAPSHOT", True)
+    loaded = Snapshot(str(tmp_path))
+    loaded.load()
+    monkeypatch.setattr(snapshot, "snapshot", loaded)
+    monkeypatch.setattr(main.app, "database", Unreachable(), raising=False)
+    monkeypatch.setattr(main.app, "startup_error", None, raising=False)
+    ready = asyncio.Event()
+    ready.set()
+    monkeypatch.setattr(main.app, "ready", ready, raising=False)
+    return main.app
+
+
+async def request(app, method: str, url: str, **kwargs) -> httpx.Response:
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        return await client.request(method, url, **kwargs)
+
+
+def test_get_falls_back_to_snapshot(offline_app):
+    response = asyncio.run(request(offline_app, "GET", "/cred/c1"))
+    assert response.status_code == 200
+    assert response.json()["username"] == "alice"
+    assert response.headers["X-Served-From"].startswith("snapshot ")
+    assert snapshot.snapshot.offline  # the next reads go straight to the snapshot
+
+
+def test_write_refused_while_offline(offline_app):
+    asyncio.run(request(offline_app, "GET", "/cred/c1"))
+    response = asyncio.run(request(offline_app, "PUT", "/cred/c1", json={"username": "bob"}))
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+
+
+def test_failed_write_is_not_retried(offline_app):
+    response = asyncio.run(request(offline_app, "DELETE", "/cred/c1"))
+    assert response.status_code == 503
+    assert "X-Served-From" not in response.headers
+
+
+@pytest.mark.parametrize("query,expected", [
+    ({"area": "banking"}, True),
+    ({"area": "personal"}, False),
+    ({"area": {"$in": ["banking", "personal"]}}, True),
+    ({"area": {"$nin": ["banking"]}}, False),
+    ({"username": {"$regex": "^ali"}}, True),
+    ({"revision": {"$gt": 2, "$lte": 3}}, True),
+    ({"revision": {"$lt": 3}}, False),
+    ({"revision": {"$gt": "3"}}, False),  # different types never compare, as in MongoDB
+    ({"missing": {"$exists": False}}, True),
+    ({"missing": {"$gt": 1}}, False),
+    ({"$or": [{"area": "personal"}, {"username": "alice"}]}, True),
+    ({"$and": [{"area": "banking"}, {"username": "bob"}]}, False),
+])
+def test_matches(query, expected):
+    assert matches({"_id": "c1", "username": "alice", "area": "banking", "revision": 3}, query) is expected
+
+
+def test_unsupported_operator_is_refused():
+    with pytest.raises(snapshot.OfflineUnsupported):
+        matches({"tags": ["a"]}, {"tags": {"$all": ["a"]}})
+
+
+@pytest.fixture
+def creds(tmp_path, monkeypatch):
+    docs = [{"_id": f"c{i:02}", "username": f"user{i % 3}", "area": "banking" if i % 2 else "personal"}
+            for i in range(20)]
+    write_snapshot(str(tmp_path), {"creds": docs})
+    loaded = Snapshot(str(tmp_path))
+    loaded.load()
+    monkeypatch.setattr(snapshot, "snapshot", loaded)
+    return SnapshotCollection("creds")
+
+
+def ids(docs: list[dict]) -> list[str]:
+    return [doc["_id"] for doc in docs]
+
+
+def test_pages_in_id_order(creds):
+    page = asyncio.run(creds.find({"area": "banking"}).sort([("_id", 1)]).limit(3).to_list(None))
+    assert ids(page) == ["c01", "c03", "c05"]
+    after = {"$and": [{"area": "banking"}, {"$or": [{"_id": {"$gt": "c05"}}]}]}  # see pagination.keyset_query
+    page = asyncio.run(creds.find(after).sort([("_id", 1)]).limit(3).to_list(None))
+    assert ids(page) == ["c07", "c09", "c11"]
+    page = asyncio.run(creds.find({"$or": [{"_id": {"$lt": "c05"}}]}).sort("_id", -1).limit(2).to_list(None))
+    assert ids(page) == ["c04", "c03"]
+
+
+def test_reads_only_what_the_page_needs(creds, monkeypatch):
+    read = []
+    original = Snapshot.read
+
+    def counting(view, collection, doc_id):
+        read.append(doc_id)
+        return original(view, collection, doc_id)
+
+    monkeypatch.setattr(Snapshot, "read", staticmethod(counting))
+    asyncio.run(creds.find({"$or": [{"_id": {"$gt": "c10"}}]}).sort([("_id", 1)]).limit(2).to_list(None))
+    assert read == ["c11", "c12"]
+
+
+def test_sort_on_other_fields(creds):
+    page = asyncio.run(creds.find({}, {"username": 1}).sort([("username", -1), ("_id", 1)]).limit(3).to_list(None))
+    assert page == [{"_id": "c02", "username": "user2"}, {"_id": "c05", "username": "user2"},
+                    {"_id": "c08", "username": "user2"}]
+
+
+def test_lookups_by_id(creds):
+    assert asyncio.run(creds.find_one({"_id": "c04"}))["username"] == "user1"
+    assert asyncio.run(creds.find_one({"_id": "nope"})) is None
+    found = asyncio.run(creds.find({"_id": {"$in": ["c02", "nope", "c01"]}}).sort("_id", 1).to_list(None))
+    assert ids(found) == ["c01", "c02"]
@@ -0,0 +1,70 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from pymongo.errors import OperationFailure, ServerSelectionTimeoutError
+
+import main
+import startup
+from startup import warm_up
+
+
+@pytest.fixture
+def prepare(monkeypatch):
+    """
+    Stands in for startup.prepare, raising the given errors one per attempt, then succeeding
+    """
+    errors = []
+    attempts = []
+
+    async def failing(app):
+        attempts.append(app)
+        if errors:
+            raise errors.pop(0)
+
+    async def no_backoff(delay):
+        pass
+
+    monkeypatch.setattr(startup, "prepare", failing)
+    monkeypatch.setattr(startup.asyncio, "sleep", no_backoff)
+    return SimpleNamespace(errors=errors, attempts=attempts)
+
+
+def new_app() -> SimpleNamespace:
+    return SimpleNamespace(ready=asyncio.Event(), startup_error=None)
+
+
+def test_retries_while_mongodb_is_unreachable(prepare):
+    prepare.errors.extend([ServerSelectionTimeoutError("no servers"), ServerSelectionTimeoutError("no servers")])
+    app = new_app()
+    asyncio.run(warm_up(app))
+    assert len(prepare.attempts) == 3
+    assert app.ready.is_set() and app.startup_error is None
+
+
+def test_gives_up_on_other_errors(prepare):
+    prepare.errors.append(OperationFailure("bad auth : authentication failed"))
+    app = new_app()
+    asyncio.run(warm_up(app))
+    assert len(prepare.attempts) == 1
+    assert not app.ready.is_set()
+    assert app.startup_error == "OperationFailure: bad auth : authentication failed"
+
+
+def test_held_requests_are_refused_once_startup_gives_up(prepare, monkeypatch):
+    prepare.errors.append(OperationFailure("bad auth : authentication failed"))
+    monkeypatch.setattr(main.app, "ready", asyncio.Event(), raising=False)
+    monkeypatch.setattr(main.app, "startup_error", None, raising=False)
+    monkeypatch.setattr(startup, "READY_WAIT_MS", 60000)
+
+    async def run():
+        monkeypatch.setattr(main.app, "warm_up", asyncio.create_task(warm_up(main.app)), raising=False)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+            held = await asyncio.wait_for(client.get("/cred/"), 5)
+            return held, await client.get("/health/live"), await client.get("/health/ready")
+
+    held, live, ready = asyncio.run(run())
+    assert held.status_code == 503 and held.json() == {"detail": "Startup failed"}
+    assert live.status_code == 503 and "authentication failed" in live.json()["detail"]
+    assert ready.status_code == 503 and ready.json()["detail"].startswith("Startup failed")
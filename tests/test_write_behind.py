@@ -0,0 +1,147 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import httpx
+import orjson
+import pytest
+from pymongo.errors import ConnectionFailure
+
+import main
+import write_behind
+from benchmarks.fake_mongo import FakeCollection
+from search import SearchIndex, credential_index
+from write_behind import Journal, WriteBehindQueue, credential_queue, read_segments
+
+
+@pytest.fixture
+def journal_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(write_behind, "JOURNAL_DIR", str(tmp_path))
+    return tmp_path
+
+
+def test_settle_writes_queued_update_first(database, journal_dir):
+    async def run():
+        await database["creds"].insert_one({"_id": "c1", "username": "alice", "revision": 0})
+        queue = WriteBehindQueue("creds", SearchIndex(("username",)))
+        await queue.start(database)
+        await queue.update("c1", {"username": "queued"})
+        await queue.settle("c1")  # as a conditional PUT does before writing directly
+        assert "c1" not in queue.pending
+        assert (await database["creds"].find_one({"_id": "c1"}))["username"] == "queued"
+        await database["creds"].update_one({"_id": "c1"}, {"$set": {"username": "direct"}})
+        await queue.stop()
+        return await database["creds"].find_one({"_id": "c1"})
+
+    assert asyncio.run(run())["username"] == "direct"
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def write_segment(path, entries: list[dict], tail: bytes = b""):
+    path.write_bytes(b"".join(orjson.dumps(entry) + b"\n" for entry in entries) + tail)
+
+
+def test_read_segments_merges_in_order(tmp_path):
+    first, second = tmp_path / "1-1.ndjson", tmp_path / "1-2.ndjson"
+    write_segment(first, [{"_id": "c1", "fields": {"password": "a", "username": "alice"}},
+                          {"_id": "c2", "fields": {"password": "b"}}])
+    write_segment(second, [{"_id": "c1", "fields": {"password": "c"}}], tail=b'{"_id": "c2", "fie')  # cut short
+    assert read_segments([str(first), str(second)]) == {"c1": {"password": "c", "username": "alice"},
+                                                        "c2": {"password": "b"}}
+
+
+def test_journal_appends_and_rotates(journal_dir):
+    async def run():
+        journal = Journal(str(journal_dir))
+        await asyncio.gather(*(journal.append({"_id": f"c{i}", "fields": {"n": i}}) for i in range(5)))
+        async with journal.lock:
+            journal.rotate()
+        await journal.append({"_id": "c0", "fields": {"n": 5}})
+        return journal
+
+    journal = asyncio.run(run())
+    assert len(journal.sealed) == 1
+    assert read_segments(journal.sealed)["c4"] == {"n": 4}
+    journal.delete_sealed()
+    journal.file.flush()
+    assert read_segments([journal.file.name]) == {"c0": {"n": 5}}
+    journal.close()
+    assert list(journal_dir.iterdir()) == []
+
+
+def test_start_replays_segments_of_crashed_workers(database, journal_dir):
+    crashed = dead_pid()
+    write_segment(journal_dir / f"{crashed}-1.ndjson", [{"_id": "c1", "fields": {"password": "old"}}])
+    write_segment(journal_dir / f"{crashed}-2.ndjson", [{"_id": "c1", "fields": {"password": "new"}},
+                                                        {"_id": "c2", "fields": {"username": "bob"}}],
+                  tail=b'{"_id": "c1"')  # crashed mid-append
+    # a replay the previous worker claimed but didn't finish before it crashed too
+    write_segment(journal_dir / f"{crashed}-replay-{crashed}-0.ndjson", [{"_id": "c2", "fields": {"area": "x"}}])
+    alive = journal_dir / f"{os.getppid()}-1.ndjson"  # another worker, still running
+    write_segment(alive, [{"_id": "c1", "fields": {"password": "theirs"}}])
+
+    async def run():
+        await database["creds"].insert_many([{"_id": "c1", "password": "stored", "revision": 1},
+                                             {"_id": "c2", "username": "alice", "revision": 1}])
+        queue = WriteBehindQueue("creds", SearchIndex(("username",)))
+        await queue.start(database)
+        await queue.stop()
+        return await database["creds"].find({}, {"modified_at": 0}).sort("_id").to_list(None)
+
+    assert asyncio.run(run()) == [{"_id": "c1", "password": "new", "revision": 2},
+                                  {"_id": "c2", "username": "bob", "area": "x", "revision": 2}]
+    assert sorted(path.name for path in journal_dir.iterdir()) == [alive.name]
+
+
+def test_failed_flush_keeps_updates_under_newer_ones(database, journal_dir):
+    queue = WriteBehindQueue("creds", SearchIndex(("username",)))
+
+    async def failing(updates):
+        raise ConnectionFailure("Atlas is unreachable")
+
+    async def run():
+        await queue.start(database)
+        queue.flusher.cancel()  # flush by hand only
+        await queue.update("c1", {"username": "first", "password": "a"})
+        queue.write = failing
+        with pytest.raises(ConnectionFailure):
+            await queue.flush()
+        await queue.update("c1", {"username": "second"})
+        return dict(queue.pending)
+
+    assert asyncio.run(run()) == {"c1": {"username": "second", "password": "a"}}
+    assert read_segments(queue.journal.sealed + [queue.journal.file.name]) == {"c1": {"username": "second",
+                                                                                      "password": "a"}}
+
+
+def test_queued_put_checks_the_index_not_the_database(database, journal_dir, monkeypatch):
+    monkeypatch.setattr(main.app, "database", database, raising=False)
+    ready = asyncio.Event()
+    ready.set()
+    monkeypatch.setattr(main.app, "ready", ready, raising=False)
+    credential_index.add({"_id": "c1", "username": "alice"})
+
+    async def find_one(self, *args, **kwargs):
+        raise AssertionError("queued updates shouldn't read the database")
+
+    async def run():
+        await database["creds"].insert_one({"_id": "c1", "username": "alice", "revision": 0})
+        await credential_queue.start(database)
+        monkeypatch.setattr(FakeCollection, "find_one", find_one, raising=False)
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+                return await client.put("/cred/c1", json={"username": "bob"}), \
+                    await client.put("/cred/missing", json={"username": "bob"})
+        finally:
+            await credential_queue.stop()
+            credential_index.remove("c1")
+
+    queued, missing = asyncio.run(run())
+    assert queued.status_code == 202 and queued.json() == {"_id": "c1", "queued": ["username"]}
+    assert missing.status_code == 404
@@ -0,0 +1,296 @@
+import asyncio
+import glob
+import os
+from typing import Optional
+import orjson
+from fastapi import HTTPException, status
+from pymongo import UpdateOne
+
+from cache import versions
+from database import config, config_bool, config_int
+from history import history_enabled, update_many_with_history
+from models import versioned
+from search import SearchIndex, credential_index
+
+# Optional write-behind mode for PUT /cred/{id}, for clients (e.g. password rotation jobs) that update credentials
+# faster than one round trip to Atlas per update allows. An update is acknowledged as soon as it is in the local
+# journal (written and fsynced, so it survives a crash), and is otherwise only held in memory:
+#
+# - Updates to the same credential are merged, so a credential updated 10 times between flushes is written once.
+# - Pending updates are flushed with one unordered bulk_write when BATCH_SIZE credentials are pending, or every
+#   INTERVAL_MS, whichever comes first.
+# - At most MAX_PENDING credentials can be pending. Further updates wait for a flush (backpressure), and are refused
+#   with 503 if that takes longer than MAX_WAIT_MS.
+# - Reads through this worker see the pending updates (overlay); other workers see them once they are flushed.
+# - Updates that bypass the queue (conditional ones) first flush a pending update of the same document (settle), so
+#   it can't be written over them afterwards.
+#
+# The journal is a directory of NDJSON segments, one per flush interval and worker ("<pid>-<n>.ndjson"). A segment is
+# deleted once everything in it has been flushed, and segments left behind by a crashed worker are replayed at startup.
+WRITE_BEHIND = config_bool("WRITE_BEHIND")
+JOURNAL_DIR = config.get("WRITE_BEHIND_DIR") or "write_behind"
+BATCH_SIZE = config_int("WRITE_BEHIND_BATCH_SIZE", 500)
+INTERVAL_MS = config_int("WRITE_BEHIND_INTERVAL_MS", 100)
+MAX_PENDING = config_int("WRITE_BEHIND_MAX_PENDING", 10000)
+MAX_WAIT_MS = config_int("WRITE_BEHIND_MAX_WAIT_MS", 5000)
+
+
+def write_behind_enabled() -> bool:
+    return WRITE_BEHIND
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # exists, but belongs to someone else
+        return True
+    return True
+
+
+class Journal:
+    """
+    Append-only log of queued updates. Appends are group-committed: everything appended while the previous fsync was
+    running is written and fsynced together, so the cost of an fsync is shared by all the updates waiting on it
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.sequence = 0
+        self.file = None
+        self.sealed: list[str] = []  # segments closed by rotate() whose updates haven't been flushed yet
+        self.waiting: list[tuple[bytes, asyncio.Future]] = []
+        self.writer: Optional[asyncio.Task] = None
+        self.lock = asyncio.Lock()  # held while writing, so rotate() never closes a segment mid-write
+        self.open()
+
+    def open(self):
+        self.sequence += 1
+        self.file = open(os.path.join(self.directory, f"{os.getpid()}-{self.sequence}.ndjson"), "ab")
+
+    def rotate(self):
+        """
+        Seal the current segment and start a new one. Call with the lock held
+        """
+        self.file.close()
+        self.sealed.append(self.file.name)
+        self.open()
+
+    def delete_sealed(self):
+        for path in self.sealed:
+            os.remove(path)
+        self.sealed.clear()
+
+    async def append(self, entry: dict):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.append((orjson.dumps(entry) + b"\n", future))
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.create_task(self.write_waiting())
+        await future
+
+    def write(self, data: bytes):
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    async def write_waiting(self):
+        while self.waiting:
+            batch, self.waiting = self.waiting, []
+            try:
+                async with self.lock:
+                    await asyncio.to_thread(self.write, b"".join(line for line, _ in batch))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for _, future in batch:
+                    future.set_result(None)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.file.name)  # only called once everything has been flushed
+            self.file = None
+
+
+def read_segments(paths: list[str]) -> dict[str, dict]:
+    """
+    Merge the updates in journal segments (oldest first) into one update per credential
+    """
+    updates: dict[str, dict] = {}
+    for path in paths:
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:  # the last line of a crashed worker's segment may be cut short
+                    continue
+                updates.setdefault(entry["_id"], {}).update(entry["fields"])
+    return updates
+
+
+class WriteBehindQueue:
+    """
+    Pending updates to one collection, merged per document and flushed in batches (see above). The search index of
+    the collection is brought up to date after each flush. With record_history, each flush is written together with
+    the history entries of the documents it changes (see history.py)
+    """
+    def __init__(self, collection: str, search_index: SearchIndex, record_history: bool = False):
+        self.collection = collection
+        self.search_index = search_index
+        self.record_history = record_history
+        self.pending: dict[str, dict] = {}  # _id -> fields to $set
+        self.writing: set[str] = set()  # _ids in the batch being written
+        self.database = None
+        self.journal: Optional[Journal] = None
+        self.flusher: Optional[asyncio.Task] = None
+        self.wake: Optional[asyncio.Event] = None  # set to flush now instead of waiting for the interval
+        self.drained: Optional[asyncio.Event] = None  # set whenever there is room for more pending updates
+        self.flushing: Optional[asyncio.Lock] = None  # held for the whole of a flush, so flushes don't overlap
+        self.flushed = 0
+        self.flushes = 0
+
+    @property
+    def running(self) -> bool:
+        return self.flusher is not None
+
+    async def start(self, database):
+        """
+        Replay whatever crashed workers left in the journal, then start flushing in the background
+        """
+        self.database = database
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        claimed = []
+        for path in sorted(glob.glob(os.path.join(JOURNAL_DIR, "*.ndjson")), key=os.path.getmtime):
+            name = os.path.basename(path)
+            if (pid := int(name.split("-")[0])) != os.getpid() and process_alive(pid):
+                continue  # a segment another worker is still using
+            # several workers may start at once; whoever renames a segment first replays it. The new name starts
+            # with our PID, so if we crash before finishing, the next worker to start replays it instead
+            claimed_path = os.path.join(JOURNAL_DIR, f"{os.getpid()}-replay-{name}")
+            try:
+                os.rename(path, claimed_path)
+            except FileNotFoundError:
+                continue
+            claimed.append(claimed_path)
+        if replayed := read_segments(claimed):
+            await self.write(replayed)
+            print(f"Replayed {len(replayed)} journalled updates to {self.collection}")
+        for path in claimed:
+            os.remove(path)
+
+        self.journal = Journal(JOURNAL_DIR)
+        self.wake = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self.flushing = asyncio.Lock()
+        self.flusher = asyncio.create_task(self.flush_loop())
+
+    async def stop(self):
+        """
+        Flush whatever is pending. If that fails, the journal is left for the next start to replay
+        """
+        if self.flusher is None:
+            return
+        self.flusher.cancel()
+        try:
+            await self.flusher
+        except asyncio.CancelledError:
+            pass
+        self.flusher = None
+        await self.flush()
+        self.journal.close()
+
+    async def update(self, doc_id: str, fields: dict):
+        """
+        Queue a $set of fields on a document. Returns once the update is in the journal
+        """
+        while len(self.pending) >= MAX_PENDING and doc_id not in self.pending:
+            self.drained.clear()
+            self.wake.set()
+            try:
+                await asyncio.wait_for(self.drained.wait(), MAX_WAIT_MS / 1000)
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                    detail="Too many updates waiting to be written, try again later",
+                                    headers={"Retry-After": "1"})
+        self.pending.setdefault(doc_id, {}).update(fields)
+        if len(self.pending) >= BATCH_SIZE:
+            self.wake.set()
+        await self.journal.append({"_id": doc_id, "fields": fields})
+
+    def overlay(self, doc: dict, projection: Optional[dict] = None) -> dict:
+        """
+        A document as it will be once its pending update is flushed, so reads see their own writes. With a projection,
+        only the projected fields are overlaid
+        """
+        if (fields := self.pending.get(doc["_id"])) is None:
+            return doc
+        if projection is not None:
+            fields = {k: v for k, v in fields.items() if k in projection}
+        return {**doc, **fields}
+
+    async def settle(self, doc_id: str):
+        """
+        Write out the queued update of a document, if it has one, before a write that doesn't go through the queue.
+        Otherwise the queued update would be flushed later, over the newer write
+        """
+        if doc_id in self.pending or doc_id in self.writing:
+            await self.flush()  # waits for a flush already writing the document to finish first
+
+    def discard(self, doc_id: str):
+        # the document is being deleted, so its pending update no longer matters
+        self.pending.pop(doc_id, None)
+
+    async def write(self, updates: dict[str, dict]):
+        if self.record_history and history_enabled():
+            await update_many_with_history(self.database, updates)
+        else:
+            requests = [UpdateOne({"_id": doc_id}, versioned({"$set": fields})) for doc_id, fields in updates.items()]
+            await self.database[self.collection].bulk_write(requests, ordered=False)
+        for doc_id in updates:
+            versions[self.collection].invalidate(doc_id)  # the revision has changed
+        await self.search_index.refresh(self.database[self.collection], list(updates))
+
+    async def flush(self):
+        async with self.flushing:
+            if not self.pending:
+                return
+            async with self.journal.lock:
+                # everything in the sealed segment was added to pending before this point, so it is all in batch
+                batch, self.pending = self.pending, {}
+                self.journal.rotate()
+            self.drained.set()
+            self.writing = set(batch)
+            try:
+                await self.write(batch)
+            except BaseException:  # including being cancelled mid-write
+                for doc_id, fields in batch.items():  # put them back, under any newer updates to the same documents
+                    self.pending[doc_id] = {**fields, **self.pending.get(doc_id, {})}
+                raise
+            finally:
+                self.writing = set()
+            self.journal.delete_sealed()  # including segments from earlier flushes that failed, now written too
+            self.flushed += len(batch)
+            self.flushes += 1
+
+    async def flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), INTERVAL_MS / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Write-behind flush to {self.collection} failed ({e}), retrying")
+                await asyncio.sleep(1)
+
+    def stats(self) -> dict:
+        return {"pending": len(self.pending), "flushed": self.flushed, "flushes": self.flushes}
+
+
+credential_queue = WriteBehindQueue("creds", credential_index, record_history=True)